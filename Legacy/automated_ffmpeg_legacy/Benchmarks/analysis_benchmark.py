@@ -0,0 +1,322 @@
+from argparse import ArgumentParser
+import hashlib
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from encode_data import *
+from video_analysis import *
+
+#### DICTIONARIES/STATICS ####
+DEFAULT_MEDIA_DIR = '/tmp/automated_ffmpeg/benchmark_media'
+RESULTS_VERSION = 1
+
+# Output arguments for every clip so the same ffmpeg build always writes the same bytes
+# (before the clip's own args; clips that set -flags:v include +bitexact themselves)
+BITEXACT_ARGS = ['-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact', '-map_metadata', '-1']
+
+HDR10_X265_PARAMS = 'hdr10=1:repeat-headers=1:master-display=G(13250,34500)B(7500,3000)R(34000,16000)WP(15635,16450)L(10000000,1):max-cll=1000,400'
+
+SUBTITLES_SRT = '1\n00:00:01,000 --> 00:00:04,000\nBenchmark subtitle\n\n2\n00:00:06,000 --> 00:00:09,000\nSecond line\n'
+
+# name => clip: lavfi sources, extra inputs (subtitle files), output args, encoders needed
+# and what the analysis should find (checked after every run).
+# Clips are generated once into the media dir and reused (file name has a hash of the spec).
+CLIPS = {
+	'letterboxed' : {
+		'inputs' : ['testsrc2=size=1920x800:rate=24000/1001,pad=1920:1080:0:140:black', 'sine=frequency=440:sample_rate=48000,aformat=channel_layouts=stereo'],
+		'subtitles' : [],
+		'args' : ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-c:a', 'ac3', '-b:a', '192k'],
+		'encoders' : ['libx264', 'ac3'],
+		'expected' : {'crop' : 'crop=1920:800:0:140', 'scan' : VideoScan.PROGRESSIVE, 'audio_streams' : 1, 'subtitle_streams' : 0, 'hdr' : False},
+	},
+	'interlaced_tff' : {
+		'inputs' : ['testsrc2=size=1920x1080:rate=60000/1001,tinterlace=merge,setfield=tff', 'sine=frequency=440:sample_rate=48000,aformat=channel_layouts=stereo'],
+		'subtitles' : [],
+		'args' : ['-c:v', 'mpeg2video', '-b:v', '15M', '-flags:v', '+ilme+ildct+bitexact', '-top', '1', '-c:a', 'ac3', '-b:a', '192k'],
+		'encoders' : ['mpeg2video', 'ac3'],
+		'expected' : {'crop' : 'crop=1920:1072:0:4', 'scan' : VideoScan.INTERLACED_TFF, 'audio_streams' : 1, 'subtitle_streams' : 0, 'hdr' : False},
+	},
+	'interlaced_bff' : {
+		'inputs' : ['testsrc2=size=1920x1080:rate=60000/1001,tinterlace=merge,setfield=tff,fieldorder=bff', 'sine=frequency=440:sample_rate=48000,aformat=channel_layouts=stereo'],
+		'subtitles' : [],
+		'args' : ['-c:v', 'mpeg2video', '-b:v', '15M', '-flags:v', '+ilme+ildct+bitexact', '-top', '0', '-c:a', 'ac3', '-b:a', '192k'],
+		'encoders' : ['mpeg2video', 'ac3'],
+		'expected' : {'crop' : 'crop=1920:1072:0:4', 'scan' : VideoScan.INTERLACED_BFF, 'audio_streams' : 1, 'subtitle_streams' : 0, 'hdr' : False},
+	},
+	'hdr10' : {
+		'inputs' : ['testsrc2=size=3840x2160:rate=24000/1001,format=yuv420p10le', 'sine=frequency=440:sample_rate=48000,aformat=channel_layouts=5.1'],
+		'subtitles' : [],
+		'args' : ['-c:v', 'libx265', '-preset', 'ultrafast', '-crf', '28', '-x265-params', HDR10_X265_PARAMS,
+			'-color_primaries', 'bt2020', '-color_trc', 'smpte2084', '-colorspace', 'bt2020nc', '-c:a', 'ac3', '-b:a', '448k'],
+		'encoders' : ['libx265', 'ac3'],
+		'expected' : {'crop' : 'crop=3840:2160:0:0', 'scan' : VideoScan.PROGRESSIVE, 'audio_streams' : 1, 'subtitle_streams' : 0, 'hdr' : True},
+	},
+	'multi_audio_subtitles' : {
+		'inputs' : ['testsrc2=size=1920x1080:rate=24000/1001', 'sine=frequency=440:sample_rate=48000,aformat=channel_layouts=5.1',
+			'sine=frequency=550:sample_rate=48000,aformat=channel_layouts=stereo', 'sine=frequency=660:sample_rate=48000,aformat=channel_layouts=stereo'],
+		'subtitles' : [('eng', 'English', False), ('eng', 'English Forced', True)],
+		'args' : ['-c:v', 'libx264', '-preset', 'ultrafast', '-crf', '23', '-c:a:0', 'pcm_s24le', '-c:a:1', 'ac3', '-c:a:2', 'aac', '-c:s', 'srt',
+			'-metadata:s:a:0', 'language=eng', '-metadata:s:a:1', 'language=spa', '-metadata:s:a:2', 'language=eng', '-metadata:s:a:2', 'title=Director Commentary',
+			'-disposition:s:0', '0', '-disposition:s:1', 'forced'],
+		'encoders' : ['libx264', 'pcm_s24le', 'ac3', 'aac', 'srt'],
+		'expected' : {'crop' : 'crop=1920:1072:0:4', 'scan' : VideoScan.PROGRESSIVE, 'audio_streams' : 3, 'subtitle_streams' : 2, 'hdr' : False},
+	},
+}
+
+#### DICTIONARIES/STATICS ####
+
+### FUNCTIONS ####
+# Returns: Set of the encoders of the installed ffmpeg
+def get_ffmpeg_encoders():
+	output = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+	encoders = set()
+	for line in output.split('\n'):
+		parts = line.split()
+		# Encoder lines look like: V....D libx264  description
+		if (len(parts) >= 2) and (len(parts[0]) == 6) and (parts[0][0] in 'VAS'):
+			encoders.add(parts[1])
+
+	return encoders
+
+# Returns: Path of the clip in media_dir (includes a hash of the spec/seconds so changes regenerate it)
+def get_clip_path(media_dir, name, spec, seconds):
+	digest = hashlib.sha1(json.dumps([spec['inputs'], spec['subtitles'], spec['args'], seconds]).encode('utf-8')).hexdigest()[:10]
+	return os.path.join(media_dir, f'{name}_{seconds}s_{digest}.mkv')
+
+# Generates the clip with ffmpeg lavfi sources (skipped if it already exists)
+# Returns: Tuple(path (None if error), msg)
+def generate_clip(media_dir, name, spec, seconds):
+	path = get_clip_path(media_dir, name, spec, seconds)
+	if os.path.exists(path) == True:
+		return (path, f'Using {path}')
+
+	os.makedirs(media_dir, exist_ok=True)
+	cmd = ['ffmpeg', '-hide_banner', '-nostdin', '-y', '-v', 'error']
+	for source in spec['inputs']:
+		cmd += ['-f', 'lavfi', '-t', str(seconds), '-i', source]
+
+	for n, (language, title, forced) in enumerate(spec['subtitles']):
+		srt_path = os.path.join(media_dir, f'{name}_{n}.srt')
+		with open(srt_path, 'w') as srt_file:
+			srt_file.write(SUBTITLES_SRT)
+		cmd += ['-i', srt_path]
+
+	for n in range(0, len(spec['inputs']) + len(spec['subtitles'])):
+		cmd += ['-map', str(n)]
+	for n, (language, title, forced) in enumerate(spec['subtitles']):
+		cmd += [f'-metadata:s:s:{n}', f'language={language}', f'-metadata:s:s:{n}', f'title={title}']
+
+	partial_path = path + '.partial.mkv'
+	cmd += BITEXACT_ARGS + spec['args'] + ['-t', str(seconds), partial_path]
+	proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True)
+	if proc.returncode != 0:
+		if os.path.exists(partial_path) == True:
+			os.remove(partial_path)
+		return (None, f'Unable to generate {name}: {proc.stderr.strip()}')
+
+	os.rename(partial_path, path)
+	return (path, f'Generated {path}')
+
+# Returns: Settings for the analysis methods (crop, scan) and mode
+def get_settings(crop_method=CropMethod.WINDOW, scan_method=ScanMethod.WINDOW, mode=AnalysisMode.SEPARATE):
+	settings = AnalysisSettings()
+	settings.crop_method = crop_method
+	settings.scan_method = scan_method
+	settings.mode = mode
+	# Clips are short; window from the start
+	settings.window_position = 0.0
+	settings.crop_sample_seconds = 2
+	settings.scan_sample_frames = 200
+	settings.scan_min_frames = 200
+
+	return settings
+
+# Returns: Dict of check => True/False comparing what was found with what the clip should have
+def check_results(expected, crop=None, scan=None, audio_streams=None, subtitle_streams=None, hdr=None):
+	checks = {}
+	if crop != None:
+		checks['crop'] = crop == expected['crop']
+	if scan != None:
+		checks['scan'] = scan == expected['scan']
+	if audio_streams != None:
+		checks['audio_streams'] = audio_streams == expected['audio_streams']
+	if subtitle_streams != None:
+		checks['subtitle_streams'] = subtitle_streams == expected['subtitle_streams']
+	if hdr != None:
+		checks['hdr'] = hdr == expected['hdr']
+
+	return checks
+
+# Returns: List of (function name, function(path, probe) returning checks) that are timed on every clip
+def get_benchmarks(expected):
+	def probe_data(path, probe):
+		result, msg = probe_video_data(path)
+		if result == None:
+			raise RuntimeError(msg)
+		return {}
+
+	def stream_data(path, probe):
+		data, msg = build_stream_data(probe, path, None, get_settings())
+		if data == None:
+			raise RuntimeError(msg)
+		return check_results(expected, data.video_stream.crop, data.video_stream.scan, len(data.audio_streams), len(data.subtitle_streams), data.video_stream.hdr != None)
+
+	def automated_encode_data(path, probe):
+		encode_data, msg = build_automated_encode_data(probe, path, False, None, get_settings())
+		if encode_data == None:
+			raise RuntimeError(msg)
+		return check_results(expected, encode_data.video_data.crop, hdr=encode_data.video_data.hdr != None)
+
+	def crop_scan(settings):
+		def run(path, probe):
+			duration_seconds = int(probe.duration_seconds)
+			crop_scan, msg = detect_crop_and_scan(path, duration_seconds, settings)
+			if crop_scan == None:
+				raise RuntimeError(msg)
+			crop, scan, confidence = crop_scan
+			return check_results(expected, crop if settings.crop_method == CropMethod.WINDOW else None, scan if settings.scan_method == ScanMethod.WINDOW else None)
+		return run
+
+	def crop_sampled(path, probe):
+		duration_seconds = int(probe.duration_seconds)
+		return check_results(expected, crop=detect_crop_sampled(path, duration_seconds, get_settings(CropMethod.SAMPLED)))
+
+	def scan_sampled(path, probe):
+		duration_seconds = int(probe.duration_seconds)
+		scan_confidence, msg = detect_scan_sampled(path, duration_seconds, get_settings(scan_method=ScanMethod.SAMPLED))
+		if scan_confidence == None:
+			raise RuntimeError(msg)
+		scan, confidence = scan_confidence
+		return check_results(expected, scan=scan)
+
+	return [
+		('probe_video_data', probe_data),
+		('build_stream_data', stream_data),
+		('build_automated_encode_data', automated_encode_data),
+		('crop_scan_combined', crop_scan(get_settings(mode=AnalysisMode.COMBINED))),
+		('crop_scan_separate', crop_scan(get_settings())),
+		('crop_sampled', crop_sampled),
+		('scan_sampled', scan_sampled),
+	]
+
+# Returns: Dict describing where the results came from (commit, ffmpeg, python, host)
+def get_environment():
+	repo_dir = os.path.dirname(os.path.abspath(__file__))
+	try:
+		commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.strip()
+	except OSError:
+		commit = None
+	try:
+		ffmpeg_version = subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True).stdout.split('\n')[0]
+	except OSError:
+		ffmpeg_version = None
+
+	return {'commit' : commit or None, 'ffmpeg' : ffmpeg_version, 'python' : platform.python_version(), 'platform' : platform.platform(),
+		'cpu_count' : os.cpu_count(), 'time' : time.strftime('%Y-%m-%dT%H:%M:%S%z')}
+
+# Times every benchmark on the clip repeat times (after one warm up run that fills the page cache)
+# Returns: List of result dicts
+def run_clip(name, path, repeat):
+	expected = CLIPS[name]['expected']
+	probe, msg = probe_video_data(path)
+	if probe == None:
+		return [{'clip' : name, 'function' : 'probe_video_data', 'error' : msg}]
+
+	results = []
+	for function_name, benchmark in get_benchmarks(expected):
+		runs = []
+		checks = {}
+		try:
+			benchmark(path, probe)
+			for n in range(0, repeat):
+				start = time.perf_counter()
+				checks = benchmark(path, probe)
+				runs.append(time.perf_counter() - start)
+		except Exception as error:
+			results.append({'clip' : name, 'function' : function_name, 'error' : str(error)})
+			continue
+
+		results.append({'clip' : name, 'function' : function_name, 'runs' : runs, 'min' : min(runs), 'median' : statistics.median(runs),
+			'mean' : statistics.mean(runs), 'checks' : checks, 'passed' : all(checks.values())})
+
+	return results
+
+# Prints the change in median time of every clip/function between two result files.
+# Returns: Number of regressions (slower by more than threshold percent)
+def compare_results(baseline, current, threshold):
+	baseline_medians = {(result['clip'], result['function']) : result['median'] for result in baseline['results'] if 'median' in result}
+	regressions = 0
+	print(f'\nCOMPARED WITH {baseline["environment"].get("commit") or "baseline"}:')
+	print(f'{"clip":<24}{"function":<30}{"baseline (s)":>13}{"current (s)":>13}{"change":>9}')
+	for result in current['results']:
+		key = (result['clip'], result['function'])
+		if ('median' not in result) or (key not in baseline_medians):
+			continue
+
+		old = baseline_medians[key]
+		change = ((result['median'] - old) / old * 100) if old > 0 else 0.0
+		flag = ''
+		if change > threshold:
+			regressions += 1
+			flag = '  REGRESSION'
+		print(f'{key[0]:<24}{key[1]:<30}{old:>13.3f}{result["median"]:>13.3f}{change:>8.1f}%{flag}')
+
+	return regressions
+
+def main():
+	parser = ArgumentParser(description='Benchmarks the analysis path (probe, stream/encode data, crop and scan detection) on generated test clips.')
+	parser.add_argument('--clips', nargs='+', choices=sorted(CLIPS), default=sorted(CLIPS), help='Clips to benchmark')
+	parser.add_argument('--seconds', type=int, default=30, help='Length of the generated clips')
+	parser.add_argument('--repeat', type=int, default=3, help='Timed runs of every function (after one warm up run)')
+	parser.add_argument('--media-dir', default=DEFAULT_MEDIA_DIR, help='Where the generated clips are kept between runs')
+	parser.add_argument('--output', help='Write the results as JSON to this file')
+	parser.add_argument('--compare', help='Results JSON (from --output) of an earlier run to compare with')
+	parser.add_argument('--threshold', type=float, default=10.0, help='Percent slower than the baseline that counts as a regression')
+	args = parser.parse_args()
+
+	encoders = get_ffmpeg_encoders()
+	results = []
+	for name in args.clips:
+		missing = [encoder for encoder in CLIPS[name]['encoders'] if encoder not in encoders]
+		if missing:
+			print(f'Skipping {name} (ffmpeg is missing encoder(s): {", ".join(missing)})', file=sys.stderr)
+			continue
+
+		path, msg = generate_clip(args.media_dir, name, CLIPS[name], args.seconds)
+		print(msg, file=sys.stderr)
+		if path == None:
+			continue
+
+		results += run_clip(name, path, args.repeat)
+
+	print(f'{"clip":<24}{"function":<30}{"min (s)":>9}{"median (s)":>12}{"mean (s)":>10}  checks')
+	for result in results:
+		if 'error' in result:
+			print(f'{result["clip"]:<24}{result["function"]:<30}  ERROR: {result["error"]}')
+			continue
+
+		failed = [check for check, passed in result['checks'].items() if passed == False]
+		checks = ('FAILED ' + ','.join(failed)) if failed else ('ok' if result['checks'] else '-')
+		print(f'{result["clip"]:<24}{result["function"]:<30}{result["min"]:>9.3f}{result["median"]:>12.3f}{result["mean"]:>10.3f}  {checks}')
+
+	current = {'version' : RESULTS_VERSION, 'environment' : get_environment(), 'seconds' : args.seconds, 'repeat' : args.repeat, 'results' : results}
+	if args.output:
+		with open(args.output, 'w') as output_file:
+			json.dump(current, output_file, indent=2, default=str)
+
+	if args.compare:
+		with open(args.compare, 'r') as baseline_file:
+			baseline = json.load(baseline_file)
+		if compare_results(baseline, current, args.threshold) > 0:
+			sys.exit(1)
+
+### FUNCTIONS ###
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,98 @@
+from argparse import ArgumentParser
+import os
+from pathlib import Path
+import random
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from list_builders import *
+
+#### DICTIONARIES/STATICS ####
+DEFAULT_SIZES = (10000, 50000, 100000, 250000, 500000)
+ENCODED_EXTENSIONS = ('.mkv', '.m4v', '.mp4')
+
+#### DICTIONARIES/STATICS ####
+
+### FUNCTIONS ####
+# build_to_encode_list as it was before the set based diff (list membership + substring scan).
+# Returns: List of new movie files to encode
+def legacy_build_to_encode_list(movie_files, movie_files_base, movie_encoded_files_base):
+	diff_list = [m for m in movie_files_base if m not in movie_encoded_files_base]
+	return [m for m in movie_files if any(f'{sub}.mkv' in m for sub in diff_list)]
+
+# Builds a synthetic library of count movies spread over genre/letter directories
+# (like a real movie tree). new_fraction of the movies have no encoded file yet.
+# Returns: Tuple(source relative paths, encoded relative paths)
+def generate_library(count, new_fraction, seed=0):
+	rng = random.Random(seed)
+	source = []
+	encoded = []
+	for n in range(0, count):
+		title = f'Movie {n:07d} ({1950 + (n % 70)})'
+		relative = f'genre_{n % 20:02d}/{title[6]}/{title}/{title}'
+		source.append(relative + '.mkv')
+		if rng.random() >= new_fraction:
+			encoded.append(relative + rng.choice(ENCODED_EXTENSIONS))
+
+	return (source, encoded)
+
+# Creates empty files for the relative paths under root.
+def create_tree(root, relative_paths):
+	for relative in relative_paths:
+		path = os.path.join(root, relative)
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		open(path, 'w').close()
+
+# Returns: Tuple(result, seconds) of calling func
+def timed(func, *args):
+	start = time.perf_counter()
+	result = func(*args)
+	return (result, time.perf_counter() - start)
+
+def main():
+	parser = ArgumentParser(description='Benchmarks the source/encoded diff (build_to_encode_list) on synthetic libraries.')
+	parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='Number of source movies in each library')
+	parser.add_argument('--new-fraction', type=float, default=0.05, help='Fraction of the movies that have not been encoded')
+	parser.add_argument('--legacy-max', type=int, default=50000, help='Largest library the legacy (quadratic) diff is run on')
+	parser.add_argument('--on-disk', action='store_true', help='Create the trees on disk and also time building the lists with glob')
+	args = parser.parse_args()
+
+	print(f'{"entries":>10} {"new":>8} {"lists (s)":>10} {"diff (s)":>10} {"legacy (s)":>11}')
+	for size in args.sizes:
+		source, encoded = generate_library(size, args.new_fraction)
+
+		if args.on_disk == True:
+			with tempfile.TemporaryDirectory(prefix='diff_benchmark_') as root:
+				source_dir = os.path.join(root, 'movies')
+				encoded_dir = os.path.join(root, 'movies_encoded')
+				create_tree(source_dir, source)
+				create_tree(encoded_dir, encoded)
+
+				start = time.perf_counter()
+				movie_files, movie_files_base = build_movie_lists(source_dir)
+				movie_encoded_files, movie_encoded_files_base = build_movie_encoded_lists(encoded_dir)
+				list_seconds = f'{time.perf_counter() - start:.3f}'
+		else:
+			source_dir = '/movies'
+			movie_files = sorted(f'{source_dir}/{relative}' for relative in source)
+			movie_files_base = sorted(Path(m).stem for m in movie_files)
+			movie_encoded_files_base = [Path(m).stem for m in encoded]
+			list_seconds = '-'
+
+		to_encode, seconds = timed(build_to_encode_list, movie_files, movie_files_base, movie_encoded_files_base)
+
+		legacy_seconds = '-'
+		if size <= args.legacy_max:
+			legacy_to_encode, legacy_time = timed(legacy_build_to_encode_list, movie_files, movie_files_base, movie_encoded_files_base)
+			legacy_seconds = f'{legacy_time:.3f}'
+			if legacy_to_encode != to_encode:
+				print(f'WARNING: legacy diff found {len(legacy_to_encode)} movies, new diff found {len(to_encode)}')
+
+		print(f'{size:>10} {len(to_encode):>8} {list_seconds:>10} {seconds:>10.3f} {legacy_seconds:>11}')
+
+### FUNCTIONS ###
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,206 @@
+import json
+import os
+import sqlite3
+import threading
+
+from encode_data import *
+
+#### DICTIONARIES/STATICS ####
+# Bump this whenever EncodeData/StreamData or the crop/scan detection change.
+# Entries written with a different version are treated as a cache miss.
+CACHE_VERSION = 7
+
+# Shared by automated_ffmpeg and ffmpeg_guided so a title analyzed by one
+# does not have to be analyzed again by the other (when run as the same user).
+DEFAULT_CACHE_PATH = '/var/cache/automated_ffmpeg/analysis_cache.db'
+# Per user ({uid}) so no other user can get at it
+FALLBACK_CACHE_PATH = '/tmp/automated_ffmpeg_cache_{uid}/analysis_cache.db'
+
+# Columns of the analysis table (a table with other columns is from an older version and gets dropped)
+CACHE_COLUMNS = ['path', 'settings', 'size', 'mtime_ns', 'inode', 'version', 'crop_scan', 'crop', 'scan', 'scan_confidence', 'encode_data', 'stream_data']
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: AnalysisCache
+# Description: On-disk (sqlite) cache of the results of analyzing a video file
+# (ffprobe data turned into EncodeData/StreamData, stored as JSON, plus the crop/scan results).
+# Entries are keyed on the file path and the settings_key they were analyzed with (see
+# get_analysis_settings_key; crop/scan results depend on the analysis settings), so tools with
+# different analysis settings keep their own entries side by side. Entries are only valid while
+# the size, mtime and inode of the file are unchanged. Entries of a changed file are dropped when
+# looked up and entries of files that no longer exist (or changed) are dropped by evict_missing.
+class AnalysisCache:
+	def __init__(self, db_path, settings_key=''):
+		self.db_path = db_path
+		self.settings_key = settings_key
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+		with self.lock, self.connection:
+			# Caches from older versions are dropped (only holds results that can be computed again)
+			columns = [row[1] for row in self.connection.execute('PRAGMA table_info(analysis)')]
+			if columns and (columns != CACHE_COLUMNS):
+				self.connection.execute('DROP TABLE analysis')
+			self.connection.execute('''CREATE TABLE IF NOT EXISTS analysis (
+				path TEXT NOT NULL,
+				settings TEXT NOT NULL,
+				size INTEGER NOT NULL,
+				mtime_ns INTEGER NOT NULL,
+				inode INTEGER NOT NULL,
+				version INTEGER NOT NULL,
+				crop_scan INTEGER NOT NULL,
+				crop TEXT,
+				scan INTEGER,
+				scan_confidence REAL,
+				encode_data TEXT,
+				stream_data TEXT,
+				PRIMARY KEY (path, settings))''')
+
+	# Gets the values the cache entry of a file is keyed on
+	# Returns: Tuple(size, mtime_ns, inode) or None if the file does not exist
+	def __file_key(self, path):
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+
+		return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+	# Gets the row for the given file and settings_key. Removes the rows (of every settings key) if the
+	# file changed, and this settings key's row if it is from another CACHE_VERSION.
+	# Returns: Tuple(file key, row (None if no valid entry))
+	def __get_row(self, path):
+		key = self.__file_key(path)
+		with self.lock, self.connection:
+			row = self.connection.execute('SELECT size, mtime_ns, inode, version, crop_scan, crop, scan, scan_confidence, encode_data, stream_data FROM analysis WHERE path = ? AND settings = ?',
+				(path, self.settings_key)).fetchone()
+			if row == None:
+				return (key, None)
+
+			if (key == None) or (tuple(row[0:3]) != key):
+				self.connection.execute('DELETE FROM analysis WHERE path = ?', (path,))
+				return (key, None)
+			elif row[3] != CACHE_VERSION:
+				self.connection.execute('DELETE FROM analysis WHERE path = ? AND settings = ?', (path, self.settings_key))
+				return (key, None)
+
+		return (key, row)
+
+	# Writes the given columns for the file, keeping the other columns of a still valid entry.
+	def __set_columns(self, path, **columns):
+		key, row = self.__get_row(path)
+		if key == None:
+			return
+
+		names = ['crop_scan', 'crop', 'scan', 'scan_confidence', 'encode_data', 'stream_data']
+		values = dict(zip(names, row[4:10])) if row != None else dict.fromkeys(names)
+		values['crop_scan'] = values['crop_scan'] or 0
+		values.update(columns)
+
+		with self.lock, self.connection:
+			self.connection.execute(f'INSERT OR REPLACE INTO analysis ({", ".join(CACHE_COLUMNS)}) VALUES ({", ".join("?" * len(CACHE_COLUMNS))})',
+				[path, self.settings_key, key[0], key[1], key[2], CACHE_VERSION] + [values[name] for name in names])
+
+	# Returns: Parsed JSON of the given column of the file's entry (None if not cached or not valid JSON)
+	def __get_json(self, path, index):
+		key, row = self.__get_row(path)
+		if (row == None) or (row[index] == None):
+			return None
+
+		try:
+			return json.loads(row[index])
+		except ValueError:
+			return None
+
+	# Returns: Cached EncodeData for the file (None if not cached)
+	def get_encode_data(self, path):
+		values = self.__get_json(path, 8)
+		return encode_data_from_dict(values, False)[0] if values != None else None
+
+	def set_encode_data(self, path, encode_data):
+		self.__set_columns(path, encode_data=json.dumps(encode_data_to_dict(encode_data)))
+
+	# Returns: Cached StreamData for the file (None if not cached)
+	def get_stream_data(self, path):
+		values = self.__get_json(path, 9)
+		return stream_data_from_dict(values)[0] if values != None else None
+
+	def set_stream_data(self, path, stream_data):
+		self.__set_columns(path, stream_data=json.dumps(stream_data_to_dict(stream_data)))
+
+	# Returns: Tuple(crop, scan, scan confidence) for the file (None if not cached)
+	def get_crop_scan(self, path):
+		key, row = self.__get_row(path)
+		if (row == None) or (row[4] != 1):
+			return None
+
+		try:
+			scan = VideoScan(row[6]) if row[6] != None else None
+		except ValueError:
+			return None
+
+		return (row[5], scan, row[7])
+
+	def set_crop_scan(self, path, crop, scan, scan_confidence=None):
+		self.__set_columns(path, crop_scan=1, crop=crop, scan=int(scan) if scan != None else None, scan_confidence=scan_confidence)
+
+	# Removes entries of files that no longer exist or have changed (of every settings key; entries of
+	# other settings keys are never removed just for that)
+	# Returns: Number of entries removed
+	def evict_missing(self):
+		with self.lock:
+			rows = self.connection.execute('SELECT DISTINCT path, size, mtime_ns, inode FROM analysis').fetchall()
+
+		stale = [tuple(row) for row in rows if self.__file_key(row[0]) != tuple(row[1:4])]
+
+		removed = 0
+		if stale:
+			with self.lock, self.connection:
+				removed = self.connection.executemany('DELETE FROM analysis WHERE path = ? AND size = ? AND mtime_ns = ? AND inode = ?', stale).rowcount
+
+		return removed
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Sets the mode of path (the cache directory or file, e.g. left 0o777 by an older version) if it belongs to this user
+# Returns: Error msg if it belongs to another user (None if ok)
+def __make_private(path, mode):
+	if os.stat(path).st_uid != os.geteuid():
+		return f'{path} belongs to another user.'
+
+	os.chmod(path, mode)
+	return None
+
+# Opens the analysis cache. If no path is given, uses DEFAULT_CACHE_PATH if it is writable
+# and FALLBACK_CACHE_PATH otherwise. settings_key identifies the analysis settings the
+# results are computed with (see get_analysis_settings_key).
+# The directory is made 0o700 and the file 0o600; the cache is not used if either one belongs to another user.
+# Returns: Tuple(AnalysisCache (None if error), msg)
+def open_analysis_cache(db_path=None, settings_key=''):
+	if not db_path:
+		cache_dir = os.path.dirname(DEFAULT_CACHE_PATH)
+		parent_dir = os.path.dirname(cache_dir)
+		db_path = DEFAULT_CACHE_PATH if (os.access(cache_dir, os.W_OK) or os.access(parent_dir, os.W_OK)) else FALLBACK_CACHE_PATH.format(uid=os.geteuid())
+
+	try:
+		cache_dir = os.path.dirname(os.path.abspath(db_path))
+		os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+		msg = __make_private(cache_dir, 0o700)
+		if msg == None:
+			os.close(os.open(db_path, os.O_RDWR | os.O_CREAT, 0o600))
+			msg = __make_private(db_path, 0o600)
+		if msg != None:
+			return (None, f'Not using analysis cache {db_path}: {msg}')
+
+		analysis_cache = AnalysisCache(db_path, settings_key)
+	except Exception as error:
+		return (None, f'Unable to open analysis cache {db_path}: {error}')
+
+	return (analysis_cache, f'Using analysis cache {db_path}')
+
+### FUNCTIONS ###
@@ -0,0 +1,149 @@
+from decimal import Decimal, InvalidOperation
+import hashlib
+import os
+import shutil
+from subprocess import Popen
+import subprocess
+import traceback
+
+from encode_data import *
+
+#### DICTIONARIES/STATICS ####
+# ffprobe arguments used to list the keyframes of the first video stream (read intervals and file path get appended).
+# Only demuxes (packet flags), nothing is decoded.
+KEYFRAME_PROBE_ARGS = ['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_entries', 'packet=pts_time,flags', '-of', 'csv=p=0']
+# Seconds of packets read after each planned chunk boundary to find the keyframe the chunk starts at
+# (longer than the keyframe interval of any sane encode)
+KEYFRAME_WINDOW_SECONDS = 20
+# Name of the chunk directory of every source file starts with this
+CHUNK_DIR_PREFIX = 'chunks_'
+# Directory created next to each movie_encoded directory for the chunks if no chunk_dir is configured
+DEFAULT_CHUNK_ROOT_NAME = 'automated_ffmpeg_chunks'
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: ChunkPlan
+# Description: Commands of a chunked encode (see build_chunk_plan). The chunk commands can run
+# in parallel (up to workers at a time); concat_cmd runs once all of them succeeded.
+# chunk_dir holds the encoded chunks and is removed once the encode is done.
+class ChunkPlan:
+	__slots__ = ['chunk_cmds', 'concat_cmd', 'chunk_dir', 'workers']
+	def __init__(self, chunk_cmds, concat_cmd, chunk_dir, workers=4):
+		self.chunk_cmds = chunk_cmds
+		self.concat_cmd = concat_cmd
+		self.chunk_dir = chunk_dir
+		self.workers = max(workers, 1)
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Lists the keyframes of the first video stream near the chunk boundaries of the file: only the packets
+# of the first KEYFRAME_WINDOW_SECONDS of the file and after every chunk_seconds from start_seconds
+# (the start time of the file) are read (ffprobe seeks to each one), not the whole file.
+# Returns: Tuple(sorted list of keyframe times (Decimal seconds) (None if error), msg)
+def probe_keyframes(video_full_path, duration_seconds, chunk_seconds, start_seconds=0):
+	intervals = [f'%+{KEYFRAME_WINDOW_SECONDS}']
+	boundary = chunk_seconds
+	while boundary < (duration_seconds or 0):
+		intervals.append(f'{start_seconds + boundary:.3f}%+{KEYFRAME_WINDOW_SECONDS}')
+		boundary += chunk_seconds
+
+	try:
+		proc = Popen(KEYFRAME_PROBE_ARGS + ['-read_intervals', ','.join(intervals), video_full_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+		# Only a few packets per boundary, so both outputs are small enough to read at once
+		stdout, stderr = proc.communicate()
+	except OSError as error:
+		return (None, [f'Error running ffprobe for keyframes of {video_full_path}. Details below.'] + traceback.format_exc().split('\n'))
+
+	if proc.returncode != 0:
+		msg = [f'Error running ffprobe for keyframes of {video_full_path}. Details below.'] + stderr.decode('utf-8', errors='replace').split('\n')
+		return (None, msg)
+
+	keyframes = set()
+	for line in stdout.decode('utf-8', errors='replace').split('\n'):
+		fields = line.strip().split(',')
+		if (len(fields) < 2) or ('K' not in fields[1]):
+			continue
+
+		try:
+			keyframes.add(Decimal(fields[0]))
+		except InvalidOperation:
+			continue
+
+	return (sorted(keyframes), f'Found {len(keyframes)} keyframes near the chunk boundaries of {os.path.basename(video_full_path)}')
+
+# Splits the video into chunks that start at the first keyframe at or after every chunk_seconds from the
+# first keyframe (so the boundaries don't drift by a keyframe interval per chunk). keyframes only has to hold
+# the keyframes near those boundaries (see probe_keyframes); a boundary without one is skipped.
+# Returns: List of Tuple(start, duration) (strings, seconds; duration is None for the last chunk)
+def plan_chunks(keyframes, chunk_seconds):
+	if not keyframes:
+		return []
+
+	first = keyframes[0]
+	starts = [first]
+	next_start = first + chunk_seconds
+	for keyframe in keyframes[1:]:
+		if keyframe >= next_start:
+			starts.append(keyframe)
+			next_start = first + (int((keyframe - first) / chunk_seconds) + 1) * chunk_seconds
+
+	chunks = [(str(start), str(end - start)) for start, end in zip(starts, starts[1:])]
+	chunks.append((str(starts[-1]), None))
+
+	return chunks
+
+# Returns: Directory under chunk_root for the chunks of the given source file
+def get_chunk_dir(chunk_root, video_full_path):
+	return os.path.join(chunk_root, CHUNK_DIR_PREFIX + hashlib.md5(video_full_path.encode('utf-8')).hexdigest())
+
+# Returns: Directory the chunks of movies encoded to movie_encoded_dir go in when no chunk_dir is configured
+# (next to movie_encoded_dir, so the chunks are on the same disk as the encoded movies instead of in /tmp)
+def get_default_chunk_root(movie_encoded_dir):
+	return os.path.join(os.path.dirname(os.path.normpath(movie_encoded_dir)), DEFAULT_CHUNK_ROOT_NAME)
+
+# Removes the chunk directories (see get_chunk_dir) left in chunk_root by chunked encodes that were running
+# when the program was terminated. Anything else in chunk_root is left alone.
+# Returns: List of the chunk directories that were removed
+def remove_chunk_dirs(chunk_root):
+	removed = []
+	if not os.path.isdir(chunk_root):
+		return removed
+
+	for entry in os.scandir(chunk_root):
+		if entry.name.startswith(CHUNK_DIR_PREFIX) and entry.is_dir(follow_symlinks=False):
+			shutil.rmtree(entry.path, ignore_errors=True)
+			removed.append(entry.path)
+
+	return removed
+
+# Plans a chunked encode of the file: finds its keyframes, splits it into chunks of about chunk_seconds
+# and builds the ffmpeg commands (see build_chunked_encode_commands). The chunks go in a directory
+# under chunk_root (see get_chunk_dir). threads is per chunk.
+# Returns: Tuple(ChunkPlan (None if error or the video is too short to split), encoded_file_destination_path, msg)
+def build_chunk_plan(encode_data, source_dir, dest_dir, chunk_root, chunk_seconds=300, workers=4, threads=0):
+	start_seconds = Decimal(str(encode_data.start_seconds or 0))
+	keyframes, msg = probe_keyframes(encode_data.source_file_full_path, encode_data.duration_seconds, chunk_seconds, start_seconds)
+	if keyframes == None:
+		return (None, None, msg)
+
+	chunks = plan_chunks(keyframes, chunk_seconds)
+	if len(chunks) < 2:
+		return (None, None, f'{os.path.basename(encode_data.source_file_full_path)} is too short to split into chunks of {chunk_seconds} seconds.')
+
+	# The joined chunks start at 0; shift them to where the first chunk starts in the source (relative to
+	# its start time, like the audio/subtitles muxed in from it) to keep them in sync
+	video_offset = Decimal(chunks[0][0]) - start_seconds
+	chunk_dir = get_chunk_dir(chunk_root, encode_data.source_file_full_path)
+	try:
+		chunk_cmds, concat_cmd, dest_path, msg = build_chunked_encode_commands(encode_data, source_dir, dest_dir, chunks, chunk_dir, threads, str(video_offset))
+	except Exception as error:
+		return (None, None, [f'Error creating chunk directory {chunk_dir}. Details below.'] + traceback.format_exc().split('\n'))
+
+	if chunk_cmds == None:
+		return (None, dest_path, msg)
+
+	return (ChunkPlan(chunk_cmds, concat_cmd, chunk_dir, workers), dest_path, msg)
+
+### FUNCTIONS ###
@@ -0,0 +1,243 @@
+import errno
+import os
+import queue
+import shutil
+import threading
+import time
+import traceback
+
+#### DICTIONARIES/STATICS ####
+# Bytes handed to the kernel per copy call (and per bandwidth reservation)
+COPY_BUFFER_SIZE = 64 * 1024 * 1024
+# Smallest chunk copied at a time while throttled
+MIN_THROTTLED_CHUNK = 1024 * 1024
+
+# Errors meaning the copy method can't be used for these files (the next one is tried)
+UNSUPPORTED_ERRNOS = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF)
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: CopyCancelled
+# Description: Raised by copy_file when the copy was cancelled (see CopyEngine.cancel_all)
+class CopyCancelled(Exception):
+	pass
+
+# Class: BandwidthLimiter
+# Description: Limits the combined throughput of every copy sharing it to bytes_per_second
+# (0 = unlimited). Each chunk reserves its share of time before it is copied.
+class BandwidthLimiter:
+	def __init__(self, bytes_per_second=0):
+		self.bytes_per_second = max(bytes_per_second, 0)
+		self.lock = threading.Lock()
+		self.next_time = time.monotonic()
+
+	# Returns: Number of bytes to copy at a time with the given buffer size
+	def chunk_size(self, buffer_size):
+		if self.bytes_per_second <= 0:
+			return buffer_size
+
+		# Keep the bursts to a quarter of a second
+		return max(min(buffer_size, self.bytes_per_second // 4), MIN_THROTTLED_CHUNK)
+
+	# Blocks until nbytes can be copied without going over the limit
+	def throttle(self, nbytes):
+		if self.bytes_per_second <= 0:
+			return
+
+		with self.lock:
+			now = time.monotonic()
+			start = max(self.next_time, now)
+			self.next_time = start + (nbytes / self.bytes_per_second)
+
+		if start > now:
+			time.sleep(start - now)
+
+# Class: CopyTask
+# Description: A file copied by a CopyEngine. dest is the full path of the copy. context is
+# whatever the caller wants back in on_complete. Once done, bytes/seconds/method (copy_file_range,
+# sendfile or read_write) are set, or error (traceback lines) if the copy failed.
+class CopyTask:
+	__slots__ = ['source', 'dest', 'context', 'bytes', 'start', 'end', 'method', 'error', 'done']
+	def __init__(self, source, dest, context=None):
+		self.source = source
+		self.dest = dest
+		self.context = context
+		self.bytes = 0
+		self.start = None
+		self.end = None
+		self.method = None
+		self.error = None
+		self.done = threading.Event()
+
+	# Returns: Seconds the copy took (None if not finished)
+	def seconds(self):
+		if (self.start == None) or (self.end == None):
+			return None
+
+		return self.end - self.start
+
+	# Blocks until the copy is done
+	# Returns: True if the copy succeeded
+	def wait(self, timeout=None):
+		self.done.wait(timeout)
+		return self.done.is_set() and (self.error == None)
+
+# Class: CopyEngine
+# Description: Copies files in the background on worker_count threads (see copy_file), so the
+# caller can go on (e.g. with the next encode) while the copies run. The throughput of all copies
+# together is limited to bytes_per_second (0 = unlimited) so they don't starve the reads of running
+# encodes. on_complete(task) is called on the worker thread once a copy is done.
+class CopyEngine:
+	def __init__(self, worker_count=2, buffer_size=COPY_BUFFER_SIZE, bytes_per_second=0, on_complete=None):
+		self.worker_count = max(worker_count, 1)
+		self.buffer_size = max(buffer_size, MIN_THROTTLED_CHUNK)
+		self.limiter = BandwidthLimiter(bytes_per_second)
+		self.on_complete = on_complete
+		self.lock = threading.Lock()
+		self.task_queue = queue.Queue()
+		# Tasks queued/being copied
+		self.active = []
+		self.cancelled = threading.Event()
+
+		for i in range(0, self.worker_count):
+			worker = threading.Thread(target=self.__worker, name=f'copy_worker_{i}', daemon=True)
+			worker.start()
+
+	def __worker(self):
+		while True:
+			task = self.task_queue.get()
+			task.start = time.time()
+			try:
+				if self.cancelled.is_set():
+					raise CopyCancelled(f'Copy of {task.source} was cancelled.')
+				task.bytes, task.method = copy_file(task.source, task.dest, self.buffer_size, self.limiter, self.cancelled)
+			except Exception:
+				task.error = traceback.format_exc().split('\n')
+			finally:
+				task.end = time.time()
+				with self.lock:
+					self.active.remove(task)
+				task.done.set()
+
+			if self.on_complete != None:
+				try:
+					self.on_complete(task)
+				except Exception:
+					pass
+
+	# Queues a copy of source to dest (full path of the copy, or a directory to copy it into).
+	# Returns: CopyTask
+	def submit(self, source, dest, context=None):
+		if os.path.isdir(dest):
+			dest = os.path.join(dest, os.path.basename(source))
+
+		task = CopyTask(source, dest, context)
+		with self.lock:
+			self.active.append(task)
+		self.task_queue.put(task)
+		return task
+
+	# Returns: List of the tasks queued/being copied
+	def pending(self):
+		with self.lock:
+			return list(self.active)
+
+	# Returns: Number of tasks queued/being copied
+	def pending_count(self):
+		with self.lock:
+			return len(self.active)
+
+	# Stops every copy (their partial files are removed) and fails the queued ones.
+	# Returns: List of the tasks that were not done
+	def cancel_all(self):
+		self.cancelled.set()
+		tasks = self.pending()
+		for task in tasks:
+			try:
+				os.remove(get_partial_path(task.dest))
+			except OSError:
+				pass
+
+		return tasks
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Returns: Path the copy to dest is written to until it is complete
+def get_partial_path(dest):
+	return os.path.join(os.path.dirname(dest), f'.{os.path.basename(dest)}.partial')
+
+# Copies count bytes at offset from in_fd to out_fd with the given method (the kernel copies
+# the data without it going through python if possible).
+# Returns: Number of bytes copied (0 at the end of the file)
+def __copy_chunk(method, in_fd, out_fd, offset, count):
+	if method == 'copy_file_range':
+		return os.copy_file_range(in_fd, out_fd, count, offset, offset)
+	elif method == 'sendfile':
+		os.lseek(out_fd, offset, os.SEEK_SET)
+		return os.sendfile(out_fd, in_fd, offset, count)
+
+	data = os.pread(in_fd, count, offset)
+	return os.pwrite(out_fd, data, offset) if data else 0
+
+# Copies source to dest (a full path) like shutil.copy2 (data, permissions and times) using
+# os.copy_file_range (reflinks/server side copies where the filesystem supports them) or
+# os.sendfile, falling back to plain reads/writes if neither works for these files. The copy is
+# written next to dest and renamed once complete so a partial file is never seen as the movie.
+# Every chunk (buffer_size bytes at most) goes through the limiter if given. If cancelled
+# (threading.Event) gets set, the copy stops and raises CopyCancelled.
+# Returns: Tuple(bytes copied, method used)
+def copy_file(source, dest, buffer_size=COPY_BUFFER_SIZE, limiter=None, cancelled=None):
+	methods = ['copy_file_range', 'sendfile', 'read_write']
+	if not hasattr(os, 'copy_file_range'):
+		methods.remove('copy_file_range')
+	if not hasattr(os, 'sendfile'):
+		methods.remove('sendfile')
+
+	chunk_size = limiter.chunk_size(buffer_size) if limiter != None else buffer_size
+	partial_path = get_partial_path(dest)
+	try:
+		with open(source, 'rb') as source_file, open(partial_path, 'wb') as dest_file:
+			in_fd = source_file.fileno()
+			out_fd = dest_file.fileno()
+			size = os.fstat(in_fd).st_size
+			copied = 0
+			while copied < size:
+				if (cancelled != None) and cancelled.is_set():
+					raise CopyCancelled(f'Copy of {source} was cancelled.')
+
+				count = min(chunk_size, size - copied)
+				if limiter != None:
+					limiter.throttle(count)
+
+				try:
+					written = __copy_chunk(methods[0], in_fd, out_fd, copied, count)
+				except OSError as error:
+					# Only switch methods before anything was copied with this one
+					if (copied > 0) or (error.errno not in UNSUPPORTED_ERRNOS) or (len(methods) == 1):
+						raise
+					methods.pop(0)
+					continue
+
+				if written == 0:
+					# copy_file_range can copy nothing instead of failing (e.g. files on some
+					# network/virtual filesystems); try the next method before giving up
+					if (copied == 0) and (len(methods) > 1):
+						methods.pop(0)
+						continue
+					raise OSError(f'{source} got shorter while it was copied ({copied} of {size} bytes).')
+				copied += written
+
+		shutil.copystat(source, partial_path)
+		os.replace(partial_path, dest)
+	except BaseException:
+		try:
+			os.remove(partial_path)
+		except OSError:
+			pass
+		raise
+
+	return (copied, methods[0])
+
+### FUNCTIONS ###
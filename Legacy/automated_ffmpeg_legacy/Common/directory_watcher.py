@@ -0,0 +1,194 @@
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import threading
+import time
+
+#### DICTIONARIES/STATICS ####
+# inotify constants (sys/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+
+# struct inotify_event { int wd; uint32_t mask; uint32_t cookie; uint32_t len; char name[]; }
+INOTIFY_EVENT = struct.Struct('iIII')
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: InotifyWatcher
+# Description: Watches directories (recursively) with inotify for files that were
+# finished being written (IN_CLOSE_WRITE) or moved in (IN_MOVED_TO).
+# Only files with one of the given extensions are reported. Raises OSError if
+# inotify is not available or the directories can't be watched.
+class InotifyWatcher:
+	def __init__(self, directories, extensions=('.mkv',), debounce_seconds=2):
+		self.extensions = tuple(extensions)
+		self.debounce_seconds = debounce_seconds
+		self.watches = {}
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+		self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, f'inotify_init1 failed: {os.strerror(error)}')
+
+		self.wake_read, self.wake_write = os.pipe()
+		os.set_blocking(self.wake_read, False)
+
+		try:
+			for directory in directories:
+				self.__add_watch_recursive(directory)
+		except OSError:
+			self.close()
+			raise
+
+	def __add_watch(self, path):
+		wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+		if wd < 0:
+			error = ctypes.get_errno()
+			raise OSError(error, f'inotify_add_watch failed for {path}: {os.strerror(error)}')
+
+		self.watches[wd] = path
+
+	# Adds a watch for the directory and every directory under it.
+	# Returns: List of the files already in those directories (with a watched extension)
+	def __add_watch_recursive(self, directory):
+		files = []
+		for root, dirs, file_names in os.walk(directory):
+			self.__add_watch(root)
+			files.extend(os.path.join(root, name) for name in file_names if name.endswith(self.extensions))
+
+		return files
+
+	# Reads all pending events
+	# Returns: List of changed files
+	def __read_events(self):
+		changed = []
+		while True:
+			try:
+				buffer = os.read(self.fd, 65536)
+			except BlockingIOError:
+				break
+
+			offset = 0
+			while offset < len(buffer):
+				wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(buffer, offset)
+				name = os.fsdecode(buffer[offset + INOTIFY_EVENT.size:offset + INOTIFY_EVENT.size + length].rstrip(b'\0'))
+				offset += INOTIFY_EVENT.size + length
+
+				if mask & IN_IGNORED:
+					self.watches.pop(wd, None)
+					continue
+
+				directory = self.watches.get(wd)
+				if (directory == None) or (not name):
+					continue
+
+				path = os.path.join(directory, name)
+				if mask & IN_ISDIR:
+					if mask & (IN_CREATE | IN_MOVED_TO):
+						try:
+							changed.extend(self.__add_watch_recursive(path))
+						except OSError:
+							pass
+				elif name.endswith(self.extensions):
+					changed.append(path)
+
+		return changed
+
+	# Blocks until a watched file changes, wake is called or timeout seconds pass.
+	# Events arriving within debounce_seconds of the first one are returned together.
+	# Returns: List of changed files (empty if timed out/woken up)
+	def wait(self, timeout):
+		readable, _, _ = select.select([self.fd, self.wake_read], [], [], timeout)
+		if self.wake_read in readable:
+			try:
+				while os.read(self.wake_read, 512):
+					pass
+			except BlockingIOError:
+				pass
+			return []
+
+		changed = []
+		deadline = time.monotonic() + self.debounce_seconds
+		while readable:
+			changed.extend(self.__read_events())
+			remaining = deadline - time.monotonic()
+			if remaining <= 0:
+				break
+			readable, _, _ = select.select([self.fd], [], [], remaining)
+
+		return sorted(set(changed))
+
+	# Makes wait return right away (safe to call from other threads)
+	def wake(self):
+		os.write(self.wake_write, b'\0')
+
+	# Nothing to reset; inotify waits cost nothing.
+	def reset(self):
+		pass
+
+	def close(self):
+		for fd in (self.fd, self.wake_read, self.wake_write):
+			try:
+				os.close(fd)
+			except OSError:
+				pass
+
+# Class: PollingWatcher
+# Description: Fallback for when inotify can't be used. wait just sleeps, starting at
+# min_interval and doubling every idle wait up to max_interval. reset goes back to
+# min_interval (call it when work was found).
+class PollingWatcher:
+	def __init__(self, min_interval=60, max_interval=1800):
+		self.min_interval = max(min_interval, 1)
+		self.max_interval = max(max_interval, self.min_interval)
+		self.interval = self.min_interval
+		self.wake_event = threading.Event()
+
+	# Returns: Empty list (polling can't tell what changed)
+	def wait(self, timeout):
+		self.wake_event.wait(min(self.interval, timeout))
+		self.wake_event.clear()
+		self.interval = min(self.interval * 2, self.max_interval)
+		return []
+
+	def wake(self):
+		self.wake_event.set()
+
+	def reset(self):
+		self.interval = self.min_interval
+
+	def close(self):
+		pass
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Creates an InotifyWatcher for the directories if use_inotify is True and inotify
+# is usable, otherwise a PollingWatcher.
+# Returns: Tuple(watcher, msg)
+def create_directory_watcher(directories, use_inotify=True, min_interval=60, max_interval=1800, extensions=('.mkv',)):
+	if use_inotify == True:
+		try:
+			watcher = InotifyWatcher(directories, extensions)
+		except (OSError, AttributeError) as error:
+			msg = f'Unable to watch directories with inotify ({error}). Falling back to polling every {min_interval} - {max_interval} seconds.'
+		else:
+			return (watcher, f'Watching {len(watcher.watches)} directories with inotify.')
+	else:
+		msg = f'Polling directories every {min_interval} - {max_interval} seconds.'
+
+	return (PollingWatcher(min_interval, max_interval), msg)
+
+### FUNCTIONS ###
@@ -1,12 +1,13 @@
-from enum import Enum, IntEnum
+from enum import Enum
 import itertools
 import os
-from subprocess import Popen
-import subprocess
 import traceback
-import xml.etree.ElementTree as ET
 
-from ffmpeg_tools_utilities import convert_seconds_to_timestamp
+from ffmpeg_progress import *
+from metrics import metrics
+from probe_model import *
+from tracing import *
+from video_analysis import *
 
 #### DICTIONARIES/STATICS ####
 # The min value to use x265 for video encoding
@@ -29,6 +30,12 @@ audio_codec_priority = {
 		'ac3' : 1
 }
 
+# VideoEncoder name => (preset, crf) the video is encoded with
+VIDEO_ENCODER_SETTINGS = {
+		'LIBX265' : ('slow', 20),
+		'LIBX264' : ('veryslow', 16)
+}
+
 #### DICTIONARIES/STATICS ####
 
 #### CLASSES ####
@@ -41,11 +48,6 @@ class AudioEncodeProcess(Enum):
 	COPY_WITH_AAC_STEREO = 2
 	AAC_STEREO = 3
 
-class VideoScan(IntEnum):
-	INTERLACED_TFF = 0
-	INTERLACED_BFF = 1
-	PROGRESSIVE = 2
-
 class HDRData:
 	__slots__ = ['red_x', 'red_y', 'green_x', 'green_y', 'blue_x', 'blue_y', 'white_point_x', 'white_point_y', 'min_luminance', 'max_luminance']
 	def __init__(self):
@@ -61,7 +63,7 @@ class HDRData:
 		self.max_luminance = ""
 
 class VideoData:
-	__slots__ = ['hdr', 'crop', 'encoder', 'orig_resolution', 'color_space', 'color_primaries', 'color_transfer', 'max_cll', 'chroma_location', 'animated', 'scan']
+	__slots__ = ['hdr', 'crop', 'encoder', 'orig_resolution', 'color_space', 'color_primaries', 'color_transfer', 'max_cll', 'chroma_location', 'animated', 'scan', 'scan_confidence']
 	def __init__(self):
 		self.hdr = None
 		self.crop = ""
@@ -74,6 +76,7 @@ class VideoData:
 		self.chroma_location = None
 		self.animated = False
 		self.scan = None
+		self.scan_confidence = None
 
 class AudioData:
 	__slots__ = ['index', 'stream_index', 'descriptor', 'language', 'channels', 'channel_layout', 'priority', 'commentary', 'encode_process']
@@ -98,18 +101,22 @@ class SubtitleData:
 		self.forced = False
 
 class EncodeData:
-	__slots__ = ['source_file_full_path', 'video_data', 'audio_data', 'subtitle_data', 'subtitle_forced_data']
+	__slots__ = ['source_file_full_path', 'duration_seconds', 'start_seconds', 'video_data', 'audio_data', 'subtitle_data', 'subtitle_forced_data']
 	def __init__(self):
 		self.source_file_full_path = ""
+		self.duration_seconds = None
+		self.start_seconds = 0.0
 		self.video_data = VideoData()
 		self.audio_data = []
 		self.subtitle_data = None
 		self.subtitle_forced_data = None
 
 class StreamData:
-	__slots__ = ['source_file_full_path', 'video_stream', 'audio_streams', 'subtitle_streams']
+	__slots__ = ['source_file_full_path', 'duration_seconds', 'start_seconds', 'video_stream', 'audio_streams', 'subtitle_streams']
 	def __init__(self):
 		self.source_file_full_path = ""
+		self.duration_seconds = None
+		self.start_seconds = 0.0
 		self.video_stream = VideoData()
 		self.audio_streams = []
 		self.subtitle_streams = []
@@ -134,8 +141,10 @@ def __build_encode_data_log_msg(encode_data):
 		scan = 'Progressive'
 	elif encode_data.video_data.scan == VideoScan.INTERLACED_TFF:
 		scan = '(Interlaced TFF => Progressive)'
-	elif encode_data.video_data.scan == VideoScan.INTERLACED_TFF:
+	elif encode_data.video_data.scan == VideoScan.INTERLACED_BFF:
 		scan = '(Interlaced BFF => Progressive)'
+	if encode_data.video_data.scan_confidence != None:
+		scan += f' [{encode_data.video_data.scan_confidence:.1%}]'
 	video_str = f'Video: {encode_data.video_data.orig_resolution} {scan} {hdr}{crop} {video_encoder}'
 	msg.append(video_str)
 
@@ -168,423 +177,266 @@ def __build_encode_data_log_msg(encode_data):
 
 	return msg
 
-# Gets HDR data from xml file (xml_root)
-# Returns: Tuple (HDRData, max_cll)
-def __get_xml_hdr(xml_root):
-	hdr = None
-	max_cll = None
-	for frame in xml_root.findall('packets_and_frames/frame'):
-		side_data_list = frame.find('side_data_list') #.find('side_data').get('side_data_type')
-		if side_data_list != None:
-			side_data = side_data_list.findall('side_data')
-			for data in side_data:
-				side_data_type = data.get('side_data_type')
-				if side_data_type == 'Mastering display metadata':
-					hdr = HDRData()
-					hdr.red_x = data.get('red_x').split('/')[0]
-					hdr.red_y = data.get('red_y').split('/')[0]
-					hdr.green_x = data.get('green_x').split('/')[0]
-					hdr.green_y = data.get('green_y').split('/')[0]
-					hdr.blue_x = data.get('blue_x').split('/')[0]
-					hdr.blue_y = data.get('blue_y').split('/')[0]
-					hdr.white_point_x = data.get('white_point_x').split('/')[0]
-					hdr.white_point_y = data.get('white_point_y').split('/')[0]
-					hdr.min_luminance = data.get('min_luminance').split('/')[0]
-					hdr.max_luminance = data.get('max_luminance').split('/')[0]
-				elif side_data_type == 'Content light level metadata':
-					max_content = data.get('max_content')
-					if max_content == None:
-						max_content = '0'
-
-					max_avg = data.get('max_average')
-					if max_avg == None:
-						max_avg = '0'
-
-					max_cll = f"'{max_content},{max_avg}'"
-				else:
-					continue
-			else:
-				continue
-		else:
-			continue
-
-	return (hdr, max_cll)
-
-def __get_crop(video_full_path, start_timestamp):
-	crop = subprocess.check_output("""ffmpeg -i "%s" -ss %s -t 00:02:00 -vf cropdetect -f null - 2>&1 | awk '/crop/ { print $NF }' | tail -1""" % (video_full_path, start_timestamp), shell=True, encoding='UTF-8')
-	return crop.strip('\r\n')
-
-def __get_scan(video_full_path):
-	scan_raw = subprocess.check_output("""ffmpeg -filter:v idet -frames:v 10000 -an -f rawvideo -y /dev/null -i "%s" 2>&1 | awk '/frame detection/ {print $8, $10, $12}'""" % (video_full_path), shell=True, encoding='UTF-8')
-	scan = list(filter(None, scan_raw.split('\n')))
-	frame_totals = [0, 0, 0]
-
-	for frames in scan:
-		counts = frames.split(' ')
-		# Should always be the order of: TFF, BFF, PROG
-		frame_totals[VideoScan.INTERLACED_TFF] += int(counts[0])
-		frame_totals[VideoScan.INTERLACED_BFF] += int(counts[1])
-		frame_totals[VideoScan.PROGRESSIVE] += int(counts[2])
-
-	video_scan = VideoScan(frame_totals.index(max(frame_totals)))
-	return video_scan
-
-# Runs a subprocess of ffprobe to create an xml file with data on the given video file
-# Assumes /tmp/automated_ffmpeg/ exists and is writable
-# Returns: Tuple(the path of the xml file which is based on the name of the video file (None if error), msg)
-def create_video_data_xml(video_full_path):
-	xml_file_path = f'/tmp/automated_ffmpeg/{os.path.basename(video_full_path)}.xml'
-	proc = subprocess.run('ffprobe -v quiet -read_intervals "%+#2" -print_format xml -show_format -show_streams -show_entries side_data "{}" > "{}"'.format(video_full_path, xml_file_path), shell=True, stderr=subprocess.PIPE)
-
-	if proc.returncode != 0:
-		error_msg = proc.stderr.decode('utf-8').split('\n')
-		msg = f'Error running ffprobe for {video_full_path}. Details below.'
-		error_msg.insert(0, msg)
-		return (None, error_msg)
+# Returns: HDRData from the MasteringDisplay of a ProbeModel
+def __build_hdr_data(mastering_display):
+	hdr = HDRData()
+	for field, value in zip(mastering_display._fields, mastering_display):
+		setattr(hdr, field, value)
+
+	return hdr
+
+# Builds the video data (resolution, encoder, color, HDR) shared by the automated and guided paths
+# from the last video stream of the probe (like the xml parsing before the probe model, where each
+# video stream overwrote the previous one).
+# Returns: VideoData object (crop/scan not set)
+def __build_video_data(probe):
+	video_data = VideoData()
+	if probe.mastering_display != None:
+		video_data.hdr = __build_hdr_data(probe.mastering_display)
+
+	if probe.content_light_level != None:
+		video_data.max_cll = f"'{probe.content_light_level.max_content},{probe.content_light_level.max_average}'"
+
+	if not probe.video_streams:
+		return video_data
+
+	stream = probe.video_streams[-1]
+	video_data.orig_resolution = f'{stream.width}x{stream.height}'
+	resolution_val = stream.width * stream.height
+	if resolution_val >= MIN_X265_RES_VALUE:
+		video_data.encoder = VideoEncoder.LIBX265
+		video_data.color_space = stream.color_space if stream.color_space != None else 'bt709'
+		video_data.color_transfer = stream.color_transfer if stream.color_transfer != None else 'bt709'
+		video_data.color_primaries = stream.color_primaries if stream.color_primaries != None else 'bt709'
+
+		if stream.chroma_location != None:
+			if stream.chroma_location == 'topleft':
+				video_data.chroma_location = '2'
+			elif stream.chroma_location == 'left':
+				video_data.chroma_location = '1'
+			else: # Default?
+				video_data.chroma_location = '1'
 	else:
-		return (xml_file_path, f'Created xml file to be analyzed for {os.path.basename(video_full_path)} (XML File Location: {xml_file_path})')
-
-# Compiles data from all streams in given xml_file
-# Returns: StreamData object
-def build_stream_data(xml_file_path, video_full_path):
-	xml_file = ET.parse(xml_file_path)
-	xml_root = xml_file.getroot()
+		video_data.encoder = VideoEncoder.LIBX264
+
+	return video_data
+
+# Builds the AudioData picked by the automated path for an audio stream of the probe
+# Returns: AudioData object
+def __build_automated_audio_data(stream, codec_name, codec_priority, commentary=False):
+	audio_data = AudioData()
+	audio_data.index = stream.audio_index
+	audio_data.descriptor = codec_name
+	audio_data.language = stream.language
+	audio_data.priority = codec_priority
+	audio_data.channels = stream.channels
+	audio_data.commentary = commentary
+
+	if stream.channel_layout != None:
+		audio_data.channel_layout = stream.channel_layout
+	elif (stream.title != None) and (commentary == False):
+		audio_data.channel_layout = stream.title
+	else:
+		audio_data.channel_layout = f'{stream.channels}-channel(s)'
 
+	if commentary == True:
+		audio_data.encode_process = AudioEncodeProcess.COPY
+	elif (codec_priority <= 1) and (stream.channels <= 2):
+		audio_data.encode_process = AudioEncodeProcess.AAC_STEREO
+	else:
+		audio_data.encode_process = AudioEncodeProcess.COPY_WITH_AAC_STEREO
+
+	return audio_data
+
+# Gets crop and scan of the video file. Uses the analysis cache (if given) to skip
+# the decode pass for files that were already analyzed. Failed analyses are not cached.
+# Returns: Tuple(Tuple(crop, VideoScan, scan confidence) (None if error), msg)
+def __get_crop_and_scan(video_full_path, duration_seconds, analysis_cache=None, analysis_settings=None):
+	if analysis_cache != None:
+		crop_scan = analysis_cache.get_crop_scan(video_full_path)
+		if crop_scan != None:
+			return (crop_scan, None)
+
+	crop_scan, msg = detect_crop_and_scan(video_full_path, duration_seconds, analysis_settings)
+
+	if (crop_scan != None) and (analysis_cache != None):
+		analysis_cache.set_crop_scan(video_full_path, *crop_scan)
+
+	return (crop_scan, msg)
+
+# Runs ffprobe on the given video file and builds the ProbeModel (see probe_model.py) that
+# build_stream_data and build_automated_encode_data work from.
+# Returns: Tuple(ProbeModel (None if error), msg)
+def probe_video_data(video_full_path):
+	with metrics.time('automated_ffmpeg_analysis_stage_seconds', {'stage' : 'ffprobe'}), tracer.span('ffprobe', video_full_path) as span:
+		probe, msg = probe_video_model(video_full_path)
+		if probe == None:
+			span.outcome = OUTCOME_FAILED
+		elif os.path.exists(video_full_path) == True:
+			span.bytes = os.path.getsize(video_full_path)
+
+		return (probe, msg)
+
+# Compiles data from all streams of the probe (ProbeModel from probe_video_data) for the guided menus
+# If an AnalysisCache is given, crop/scan results are taken from/stored in it.
+# analysis_settings (AnalysisSettings) control the crop/scan decode pass (None for defaults).
+# Returns: Tuple(StreamData object (None if error), msg)
+def build_stream_data(probe, video_full_path, analysis_cache=None, analysis_settings=None):
 	stream_data = StreamData()
 	stream_data.source_file_full_path = video_full_path
+	stream_data.video_stream = __build_video_data(probe)
+
+	for stream in probe.audio_streams:
+		audio_stream = AudioData()
+		audio_stream.stream_index = stream.index
+		audio_stream.index = stream.audio_index
+		audio_stream.descriptor = f'{stream.codec_name}/{stream.profile}' if stream.codec_name == 'dts' else stream.codec_name
+		audio_stream.channels = stream.channels
+		audio_stream.language = stream.language if stream.language != None else 'Unknown'
+		audio_stream.commentary = (stream.title != None) and ("Commentary" in stream.title)
+
+		if stream.channel_layout != None:
+			audio_stream.channel_layout = stream.channel_layout
+		elif stream.title != None:
+			audio_stream.channel_layout = stream.title
+		else:
+			audio_stream.channel_layout = f'{stream.channels}-channel(s)'
 
-	hdr, max_cll = __get_xml_hdr(xml_root)
-
-	if hdr != None:
-		stream_data.video_stream.hdr = hdr
-
-	if max_cll != None:
-		stream_data.video_stream.max_cll = max_cll
-
-	# Streams (Video, Audio, Subtitles)
-	audio_index = 0
-	subtitle_index = 0 # Used to keep track of index to use in ffmpeg command for subtitles (in case more than one subtitle stream is found)
-	for stream in xml_root.findall('streams/stream'):
-		codec_type = stream.get('codec_type')
-		if codec_type == 'video':
-			width = int(stream.get('width'))
-			height = int(stream.get('height'))
-			stream_data.video_stream.orig_resolution = f'{width}x{height}'
-			resolution_val = width * height
-			if resolution_val >= MIN_X265_RES_VALUE:
-				stream_data.video_stream.encoder = VideoEncoder.LIBX265
-
-				color_space = stream.get('color_space')
-				stream_data.video_stream.color_space = color_space if color_space != None else 'bt709'
-
-				color_transfer = stream.get('color_transfer')
-				stream_data.video_stream.color_transfer = color_transfer if color_transfer != None else 'bt709'
-
-				color_primaries = stream.get('color_primaries')
-				stream_data.video_stream.color_primaries = color_primaries if color_primaries != None else 'bt709'
-
-				chroma_location = stream.get('chroma_location')
-				if chroma_location != None:
-					if chroma_location == 'topleft':
-						stream_data.video_stream.chroma_location = '2'
-					elif chroma_location == 'left':
-						stream_data.video_stream.chroma_location = '1'
-					else: # Default?
-						stream_data.video_stream.chroma_location = '1'
-			else:
-				stream_data.video_stream.encoder = VideoEncoder.LIBX264
-
-		elif codec_type == 'audio':
-			audio_stream = AudioData()
-			audio_stream.stream_index = int(stream.get('index'))
-			audio_stream.index = audio_index
-			codec_name = stream.get('codec_name')
-			if codec_name == 'dts':
-				profile = stream.get('profile')
-				codec_name = f'{codec_name}/{profile}'
-
-			audio_stream.descriptor = codec_name
-			audio_stream.channels = int(stream.get('channels'))
-
-			tags = stream.findall('tag')
-			language = None
-			title = None
-			for tag in tags:
-				key = tag.get('key')
-				if key == 'language':
-					language = tag.get('value')
-				elif key == 'title':
-					title = tag.get('value')
-				elif (title != None) and (language != None):
-					break
-
-			if language == None:
-				language = 'Unknown'
-			audio_stream.language = language
-
-			if (title != None) and ("Commentary" in title):
-				audio_stream.commentary = True
-
-			channel_layout = stream.get('channel_layout')
-			if channel_layout != None:
-				audio_stream.channel_layout = channel_layout
-			elif title != None:
-				audio_stream.channel_layout = title
-			else:
-				audio_stream.channel_layout = f'{audio_stream.channels}-channel(s)'
-
-			stream_data.audio_streams.append(audio_stream)
-			audio_index += 1
-		elif codec_type == 'subtitle':
-			subtitle_stream = SubtitleData()
-			subtitle_stream.stream_index = int(stream.get('index'))
-			subtitle_stream.index = subtitle_index
-			subtitle_stream.descriptor = stream.get('codec_name')
-
-			language = None
-			tags = stream.findall('tag')
-			for tag in tags:
-				key = tag.get('key')
-				if key == 'language':
-					language = tag.get('value')
-
-			subtitle_stream.language = language
-
-			disposition = stream.find('disposition')
-			default = disposition.get('default')
-			forced = disposition.get('forced')
-
-			if (default == '1') or (forced == '1'):
-				subtitle_stream.forced = True
+		stream_data.audio_streams.append(audio_stream)
 
-			stream_data.subtitle_streams.append(subtitle_stream)
-			subtitle_index += 1
+	for stream in probe.subtitle_streams:
+		subtitle_stream = SubtitleData()
+		subtitle_stream.stream_index = stream.index
+		subtitle_stream.index = stream.subtitle_index
+		subtitle_stream.descriptor = stream.codec_name
+		subtitle_stream.language = stream.language
+		subtitle_stream.forced = (stream.default == True) or (stream.forced == True)
+		stream_data.subtitle_streams.append(subtitle_stream)
 
-	format_section = xml_root.find('format')
-	duration_seconds = int(float(format_section.get('duration')))
-	duration_half = int(duration_seconds / 2)
-	timestamp_half = convert_seconds_to_timestamp(duration_half)
+	stream_data.duration_seconds = probe.duration_seconds
+	stream_data.start_seconds = probe.start_seconds
+	duration_seconds = int(stream_data.duration_seconds)
 
 	# Crop, Scan
-	#crop = subprocess.check_output("""ffmpeg -i "%s" -ss %s -t 00:02:00 -vf cropdetect -f null - 2>&1 | awk '/crop/ { print $NF }' | tail -1""" % (video_full_path, timestamp_half), shell=True, encoding='UTF-8')
-	#stream_data.video_stream.crop = crop.strip('\r\n')
-	stream_data.video_stream.crop = __get_crop(video_full_path, timestamp_half)
-	stream_data.video_stream.scan = __get_scan(video_full_path)
+	crop_scan, msg = __get_crop_and_scan(video_full_path, duration_seconds, analysis_cache, analysis_settings)
+	if crop_scan == None:
+		return (None, msg)
+	stream_data.video_stream.crop, stream_data.video_stream.scan, stream_data.video_stream.scan_confidence = crop_scan
 
-	return stream_data
+	return (stream_data, None)
 
-# Analyzes ffprobe xml output of file and builds a EncodeData object with details needed to run ffmpeg.
-# Takes in the xml_root object (not the file object)
+# Picks the streams/settings to encode the file with from its probe (ProbeModel from probe_video_data)
+# and builds a EncodeData object with details needed to run ffmpeg.
+# If an AnalysisCache is given, crop/scan results are taken from/stored in it.
+# analysis_settings (AnalysisSettings) control the crop/scan decode pass (None for defaults).
 # Returns: Tuple(EncodeData object (or None if error), message)
-def build_automated_encode_data(xml_file_path, movie_full_path, animated=False):
-	xml_file = ET.parse(xml_file_path)
-	xml_root = xml_file.getroot()
-
+def build_automated_encode_data(probe, movie_full_path, animated=False, analysis_cache=None, analysis_settings=None):
 	encode_data = EncodeData()
 	encode_data.source_file_full_path = movie_full_path
 
-	hdr, max_cll = __get_xml_hdr(xml_root)
-
-	if hdr != None:
-		encode_data.video_data.hdr = hdr
-
-	if max_cll != None:
-		encode_data.video_data.max_cll = max_cll
+	if probe.other_streams:
+		msg = f'Unable to identify stream/codec type for stream {probe.other_streams[0].index}.'
+		return (None, msg)
 
+	encode_data.video_data = __build_video_data(probe)
 	encode_data.video_data.animated = animated
 
-	# Streams (Video, Audio, Subtitles)
-	audio_index = 0
-	subtitle_index = 0 # Used to keep track of index to use in ffmpeg command for subtitles (in case more than one subtitle stream is found)
+	# Audio
 	primary_audio_language = ''
-	for stream in xml_root.findall('streams/stream'):
-		codec_type = stream.get('codec_type')
-		if codec_type == 'video':
-			width = int(stream.get('width'))
-			height = int(stream.get('height'))
-			encode_data.video_data.orig_resolution = f'{width}x{height}'
-			resolution_val = width * height
-			if resolution_val >= MIN_X265_RES_VALUE:
-				encode_data.video_data.encoder = VideoEncoder.LIBX265
-
-				color_space = stream.get('color_space')
-				encode_data.video_data.color_space = color_space if color_space != None else 'bt709'
-
-				color_transfer = stream.get('color_transfer')
-				encode_data.video_data.color_transfer = color_transfer if color_transfer != None else 'bt709'
-
-				color_primaries = stream.get('color_primaries')
-				encode_data.video_data.color_primaries = color_primaries if color_primaries != None else 'bt709'
-
-				chroma_location = stream.get('chroma_location')
-				if chroma_location != None:
-					if chroma_location == 'topleft':
-						encode_data.video_data.chroma_location = '2'
-					elif chroma_location == 'left':
-						encode_data.video_data.chroma_location = '1'
-					else: # Default?
-						encode_data.video_data.chroma_location = '1'
-			else:
-				encode_data.video_data.encoder = VideoEncoder.LIBX264
-		elif codec_type == 'audio':
-			stream_index = int(stream.get('index'))
-			codec_name = stream.get('codec_name')
-			if codec_name == 'dts':
-				codec_name = stream.get('profile')
-			codec_priority = audio_codec_priority.get(codec_name)
-
-			# Unknown codec; Won't know what to do with it and should be added to dictionary.
-			if codec_priority == None:
-				msg = f'Unknown audio codec type found. Add to dictionary. Codec Type: {codec_name}'
-				return (None, msg)
-
-			tags = stream.findall('tag')
-			language = None
-			title = None
-			for tag in tags:
-				key = tag.get('key')
-				if key == 'language':
-					language = tag.get('value')
-				elif key == 'title':
-					title = tag.get('value')
-				elif (title != None) and (language != None):
-					break
-
-			# Exit if for some reason no language is found.
-			if language == None:
-				msg = f'Unknown language for stream index {stream_index}.'
-				return (None, msg)
-
-			commentary = False
-			if (title != None) and ("Commentary" in title):
-				commentary = True
-
-			def create_audio_data(audio_index, codec_name, language, codec_priority, channels, channel_layout, title, commentary=False):
-				audio_data = AudioData()
-				audio_data.index = audio_index
-				audio_data.descriptor = codec_name
-				audio_data.language = language
-				audio_data.priority = codec_priority
-				audio_data.channels = channels
-				audio_data.commentary = commentary
-
-				if channel_layout != None:
-					audio_data.channel_layout = channel_layout
-				elif (title != None) and (commentary == False):
-					audio_data.channel_layout = title
-				else:
-					audio_data.channel_layout = f'{channels}-channel(s)'
-
-				if commentary == True:
-					audio_data.encode_process = AudioEncodeProcess.COPY
-				elif (codec_priority <= 1) and (channels <= 2):
-					audio_data.encode_process = AudioEncodeProcess.AAC_STEREO
-				else: 
-					audio_data.encode_process = AudioEncodeProcess.COPY_WITH_AAC_STEREO
-
-				return audio_data
-
-			# Check if we have ANY audio streams
-			if (not encode_data.audio_data) and (commentary == False):
-				channels = int(stream.get('channels'))
-				channel_layout = stream.get('channel_layout') 
-				 # audio_index should be 0 - First audio stream found
-				audio_data = create_audio_data(audio_index, codec_name, language, codec_priority, channels, channel_layout, title)
-				encode_data.audio_data.append(audio_data)
-				primary_audio_language = language
-			elif commentary == True:
-				channels = int(stream.get('channels'))
-				channel_layout = stream.get('channel_layout')
-				audio_data = create_audio_data(audio_index, codec_name, language, codec_priority, channels, channel_layout, title, commentary)
-				encode_data.audio_data.append(audio_data)
-			else:
-				found = False
-				for i in range(0, len(encode_data.audio_data)):
-					if encode_data.audio_data[i].language == language:
-						found = True
-						channels = int(stream.get('channels'))
-						current_priority = audio_codec_priority[encode_data.audio_data[i].descriptor]
-						current_channels = encode_data.audio_data[i].channels
-						if (codec_priority > current_priority) or ((codec_priority == current_priority) and (channels > current_channels)):
-							channel_layout = stream.get('channel_layout')
-							audio_data = create_audio_data(audio_index, codec_name, language, codec_priority, channels, channel_layout, title)
-							encode_data.audio_data[i] = audio_data
-						else:
-							break
-
-				# Didn't find audio data with a matching language, add a new language
-				if found == False:
-					channels = int(stream.get('channels'))
-					channel_layout = stream.get('channel_layout')
-					audio_data = create_audio_data(audio_index, codec_name, language, codec_priority, channels, channel_layout, title)
-					encode_data.audio_data.append(audio_data)
-
-			audio_index += 1
-
-		elif codec_type == 'subtitle':
-			stream_index = int(stream.get('index'))
-			# Only need english subtitles; Should really never have more than 2 subtitle tracks TODO: Forced subtitle tracks?
-			language = None
-			tags = stream.findall('tag')
-			for tag in tags:
-				key = tag.get('key')
-				if key == 'language':
-					language = tag.get('value')
-
-			if language == 'eng':
-				disposition = stream.find('disposition')
-				if disposition != None:
-					default = disposition.get('default')
-					forced = disposition.get('forced')
-
-					# Handle forced/default subtitle track
-					if (forced == '1') and (primary_audio_language == 'eng') :
-						if encode_data.subtitle_forced_data == None:
-							subtitle_forced_data = SubtitleData()
-							subtitle_forced_data.language = language
-							subtitle_forced_data.descriptor = stream.get('codec_name')
-							subtitle_forced_data.index = subtitle_index
-							subtitle_forced_data.forced = True
-							encode_data.subtitle_forced_data = subtitle_forced_data
+	for stream in probe.audio_streams:
+		codec_name = stream.profile if stream.codec_name == 'dts' else stream.codec_name
+		codec_priority = audio_codec_priority.get(codec_name)
 
-					else:
-						if encode_data.subtitle_data == None:
-							subtitle_data = SubtitleData()
-							subtitle_data.language = language
-							subtitle_data.descriptor = stream.get('codec_name')
-							subtitle_data.index = subtitle_index
-							encode_data.subtitle_data = subtitle_data
+		# Unknown codec; Won't know what to do with it and should be added to dictionary.
+		if codec_priority == None:
+			msg = f'Unknown audio codec type found. Add to dictionary. Codec Type: {codec_name}'
+			return (None, msg)
 
-				else:
-					msg = f'English subtitle track found with no disposition section (stream index: {stream_index}).'
-					return (None, msg)
+		# Exit if for some reason no language is found.
+		if stream.language == None:
+			msg = f'Unknown language for stream index {stream.index}.'
+			return (None, msg)
 
-			subtitle_index += 1
+		commentary = (stream.title != None) and ("Commentary" in stream.title)
 
+		# Check if we have ANY audio streams
+		if (not encode_data.audio_data) and (commentary == False):
+			encode_data.audio_data.append(__build_automated_audio_data(stream, codec_name, codec_priority))
+			primary_audio_language = stream.language
+		elif commentary == True:
+			encode_data.audio_data.append(__build_automated_audio_data(stream, codec_name, codec_priority, commentary))
 		else:
-			index = stream.get('index')
-			msg = f'Unable to identify stream/codec type for stream {index}.'
+			found = False
+			for i in range(0, len(encode_data.audio_data)):
+				if encode_data.audio_data[i].language == stream.language:
+					found = True
+					current_priority = audio_codec_priority[encode_data.audio_data[i].descriptor]
+					current_channels = encode_data.audio_data[i].channels
+					if (codec_priority > current_priority) or ((codec_priority == current_priority) and (stream.channels > current_channels)):
+						encode_data.audio_data[i] = __build_automated_audio_data(stream, codec_name, codec_priority)
+					else:
+						break
+
+			# Didn't find audio data with a matching language, add a new language
+			if found == False:
+				encode_data.audio_data.append(__build_automated_audio_data(stream, codec_name, codec_priority))
+
+	# Subtitles: Only need english subtitles; Should really never have more than 2 subtitle tracks
+	for stream in probe.subtitle_streams:
+		if stream.language != 'eng':
+			continue
+
+		if stream.forced == None:
+			msg = f'English subtitle track found with no disposition section (stream index: {stream.index}).'
 			return (None, msg)
 
-	format_section = xml_root.find('format')
-	duration_seconds = int(float(format_section.get('duration')))
-	duration_half = int(duration_seconds / 2)
-	timestamp_half = convert_seconds_to_timestamp(duration_half)
+		# Handle forced/default subtitle track
+		if (stream.forced == True) and (primary_audio_language == 'eng'):
+			if encode_data.subtitle_forced_data == None:
+				subtitle_forced_data = SubtitleData()
+				subtitle_forced_data.language = stream.language
+				subtitle_forced_data.descriptor = stream.codec_name
+				subtitle_forced_data.index = stream.subtitle_index
+				subtitle_forced_data.forced = True
+				encode_data.subtitle_forced_data = subtitle_forced_data
+		elif encode_data.subtitle_data == None:
+			subtitle_data = SubtitleData()
+			subtitle_data.language = stream.language
+			subtitle_data.descriptor = stream.codec_name
+			subtitle_data.index = stream.subtitle_index
+			encode_data.subtitle_data = subtitle_data
+
+	encode_data.duration_seconds = probe.duration_seconds
+	encode_data.start_seconds = probe.start_seconds
+	duration_seconds = int(encode_data.duration_seconds)
 
-	# Crop
-	#crop = subprocess.check_output("""ffmpeg -i "%s" -ss %s -t 00:02:00 -vf cropdetect -f null - 2>&1 | awk '/crop/ { print $NF }' | tail -1""" % (movie_full_path, timestamp_half), shell=True, encoding='UTF-8')
-	#encode_data.video_data.crop = crop.strip('\r\n')
-	encode_data.video_data.crop = __get_crop(movie_full_path, timestamp_half)
-	encode_data.video_data.scan = __get_scan(movie_full_path)
+	# Crop, Scan
+	crop_scan, msg = __get_crop_and_scan(movie_full_path, duration_seconds, analysis_cache, analysis_settings)
+	if crop_scan == None:
+		return (None, msg)
+	encode_data.video_data.crop, encode_data.video_data.scan, encode_data.video_data.scan_confidence = crop_scan
 
 	msg = [f'Built encode data for {movie_full_path}'] + __build_encode_data_log_msg(encode_data)
 
 	return (encode_data, msg)
 
-# Creates ffmpeg command
+# Gets previously built encode data of the movie from the analysis cache.
+# The animated flag comes from the config so it is always taken from the caller.
+# Returns: Tuple(EncodeData object (or None if not cached), message)
+def get_cached_encode_data(analysis_cache, movie_full_path, animated=False):
+	encode_data = analysis_cache.get_encode_data(movie_full_path)
+	if encode_data == None:
+		return (None, None)
+
+	encode_data.video_data.animated = animated
+	msg = [f'Using cached encode data for {movie_full_path}'] + __build_encode_data_log_msg(encode_data)
+
+	return (encode_data, msg)
+
+# Gets where the encoded file goes (same relative path under dest_dir), creating its directory.
 # Only returns a msg if there is an error.
-# Returns: Tuple(ffmpeg command string, encoded_file_destination_path, msg)
-def build_encode_command(encode_data, source_dir, dest_dir):
+# Returns: Tuple(encoded_file_destination_path, msg)
+def __get_dest_path(encode_data, source_dir, dest_dir):
 	dest_path = encode_data.source_file_full_path.replace(source_dir, dest_dir, 1)
 	vid_dir = dest_path.replace(os.path.basename(encode_data.source_file_full_path), '')
 	msg = None
@@ -596,24 +448,32 @@ def build_encode_command(encode_data, source_dir, dest_dir):
 		dest_path = f'{dest_dir}/{os.path.basename(encode_data.source_file_full_path)}'
 		msg = [f'Error creating directory {vid_dir}. Defaulting ffmpeg output to {dest_dir}.'] + traceback.format_exc().split('\n')
 
-	audio_list = encode_data.audio_data
-	video_data = encode_data.video_data
+	return (dest_path, msg)
+
+# Builds the -map options. The video comes from input video_input and the audio/subtitles from input other_input.
+# Returns: Map options string
+def __build_map_str(encode_data, video_input=0, other_input=0):
 	subtitle_data = encode_data.subtitle_data
 	subtitle_forced_data = encode_data.subtitle_forced_data
 
-	# Map section
-	map_str = '-map 0:v:0 '
-	for audio in audio_list:
+	map_str = f'-map {video_input}:v:0 '
+	for audio in encode_data.audio_data:
 		if audio.encode_process != AudioEncodeProcess.COPY_WITH_AAC_STEREO:
-			map_str += f'-map 0:a:{audio.index} '
+			map_str += f'-map {other_input}:a:{audio.index} '
 		else:
-			map_str += f'-map 0:a:{audio.index} -map 0:a:{audio.index} '
+			map_str += f'-map {other_input}:a:{audio.index} -map {other_input}:a:{audio.index} '
 	if subtitle_data != None:
-		map_str += f'-map 0:s:{subtitle_data.index} '
+		map_str += f'-map {other_input}:s:{subtitle_data.index} '
 	if subtitle_forced_data != None:
-		map_str += f'-map 0:s:{subtitle_forced_data.index} '
+		map_str += f'-map {other_input}:s:{subtitle_forced_data.index} '
 
-	# Video section
+	return map_str
+
+# Builds the video filter/encoder options
+# repeat_headers puts the x264 headers in front of every keyframe (x265 always does), which the chunks of
+# a chunked encode need to be joined without re-encoding.
+# Returns: Tuple(video options string (None if error), error msg)
+def __build_video_settings_str(video_data, threads=0, repeat_headers=False):
 	crop = ''
 	convert = ''
 	# Crop
@@ -632,8 +492,9 @@ def build_encode_command(encode_data, source_dir, dest_dir):
 	b_frames_str = 'bframes=6' if video_data.animated == False else 'bframes=8'
 
 	if video_data.encoder == VideoEncoder.LIBX265:
+		preset, crf = VIDEO_ENCODER_SETTINGS[video_data.encoder.name]
 		video_settings_str = (	f'-pix_fmt yuv420p10le -vcodec libx265 {video_filter_str}'
-								f'-x265-params "preset=slow:keyint=60:{b_frames_str}:repeat-headers=1:colorprim={video_data.color_primaries}:transfer={video_data.color_transfer}:colormatrix={video_data.color_space}')
+								f'-x265-params "preset={preset}:keyint=60:{b_frames_str}:repeat-headers=1:colorprim={video_data.color_primaries}:transfer={video_data.color_transfer}:colormatrix={video_data.color_space}')
 		if video_data.hdr != None:
 			hdr = video_data.hdr
 			master_display_str = f":hdr10-opt=1:master-display='G({hdr.green_x},{hdr.green_y})B({hdr.blue_x},{hdr.blue_y})R({hdr.red_x},{hdr.red_y})WP({hdr.white_point_x},{hdr.white_point_y})L({hdr.max_luminance},{hdr.min_luminance})'"
@@ -644,17 +505,24 @@ def build_encode_command(encode_data, source_dir, dest_dir):
 		if video_data.chroma_location != None:
 			chroma_location_str = f':chromaloc={video_data.chroma_location}'
 			video_settings_str += chroma_location_str
+		if threads > 0:
+			video_settings_str += f':pools={threads}'
 
-		video_settings_str += '" -crf 20 '
+		video_settings_str += f'" -crf {crf} '
 
 	elif video_data.encoder == VideoEncoder.LIBX264:
-		video_settings_str = f'-pix_fmt yuv420p -vcodec libx264 {video_filter_str}-x264-params "preset=veryslow:bframes=16:b-adapt=2:b-pyramid=normal:partitions=all" -crf 16 '
+		preset, crf = VIDEO_ENCODER_SETTINGS[video_data.encoder.name]
+		threads_str = f':threads={threads}' if threads > 0 else ''
+		repeat_headers_str = ':repeat-headers=1' if repeat_headers == True else ''
+		video_settings_str = f'-pix_fmt yuv420p -vcodec libx264 {video_filter_str}-x264-params "preset={preset}:bframes=16:b-adapt=2:b-pyramid=normal:partitions=all{repeat_headers_str}{threads_str}" -crf {crf} '
 	else:
-		error_msg = f'Invalid VideoEncoder: {video_data.encoder}. Either not handled or a bizarre issue happened.'
-		msg = error_msg if msg == None else msg.append(error_msg)
-		return (None, dest_path, msg)
+		return (None, f'Invalid VideoEncoder: {video_data.encoder}. Either not handled or a bizarre issue happened.')
+
+	return (video_settings_str, None)
 
-	# Audio section
+# Builds the audio encoder options
+# Returns: Tuple(audio options string (None if error), error msg)
+def __build_audio_settings_str(audio_list):
 	audio_settings_str = ''
 	audio_count = 0
 	for audio in audio_list:
@@ -673,11 +541,13 @@ def build_encode_command(encode_data, source_dir, dest_dir):
 				audio_settings_str += f'-c:a:{audio_count} copy '
 			audio_count += 1
 		else: # Should never really happen
-			error_msg = f'Invalid AudioEncodeProcess: {audio.encode_process}. Either not handled or a bizarre issue happened.'
-			msg = error_msg if msg == None else msg.append(error_msg)
-			return (None, dest_path, msg)
-	
-	# Subtitle section
+			return (None, f'Invalid AudioEncodeProcess: {audio.encode_process}. Either not handled or a bizarre issue happened.')
+
+	return (audio_settings_str, None)
+
+# Builds the subtitle options
+# Returns: Subtitle options string
+def __build_subtitle_settings_str(subtitle_data, subtitle_forced_data):
 	subtitle_settings_str = ''
 	subtitle_count = 0
 	if subtitle_data != None:
@@ -687,8 +557,167 @@ def build_encode_command(encode_data, source_dir, dest_dir):
 		subtitle_settings_str += f'-c:s:{subtitle_count} copy -disposition:s:{subtitle_count} forced '
 		subtitle_count += 1
 
-	cmd = f'ffmpeg -y -i "{encode_data.source_file_full_path}" {map_str}{video_settings_str}{audio_settings_str}{subtitle_settings_str}-max_muxing_queue_size 9999 "{dest_path}"'
+	return subtitle_settings_str
+
+# Creates ffmpeg command
+# Only returns a msg if there is an error.
+# threads limits the threads used by the video encoder (x265 pools/x264 threads); 0 lets the encoder decide.
+# Returns: Tuple(ffmpeg command string, encoded_file_destination_path, msg)
+def build_encode_command(encode_data, source_dir, dest_dir, threads=0):
+	dest_path, msg = __get_dest_path(encode_data, source_dir, dest_dir)
+
+	cmd, error_msg = build_encode_command_for_path(encode_data, dest_path, threads)
+	if cmd == None:
+		msg = error_msg if msg == None else msg + [error_msg]
 
 	return (cmd, dest_path, msg)
 
-### FUNCTIONS ###
\ No newline at end of file
+# Creates the ffmpeg command encoding to the given path (its directory has to exist), e.g. on a farm worker
+# that got the encode data and path from the coordinator (see encode_data_from_dict).
+# Returns: Tuple(ffmpeg command string (None if error), error msg)
+def build_encode_command_for_path(encode_data, dest_path, threads=0):
+	map_str = __build_map_str(encode_data)
+
+	video_settings_str, error_msg = __build_video_settings_str(encode_data.video_data, threads)
+	if video_settings_str == None:
+		return (None, error_msg)
+
+	audio_settings_str, error_msg = __build_audio_settings_str(encode_data.audio_data)
+	if audio_settings_str == None:
+		return (None, error_msg)
+
+	subtitle_settings_str = __build_subtitle_settings_str(encode_data.subtitle_data, encode_data.subtitle_forced_data)
+
+	cmd = f'ffmpeg -y {FFMPEG_PROGRESS_ARGS} -i "{encode_data.source_file_full_path}" {map_str}{video_settings_str}{audio_settings_str}{subtitle_settings_str}-max_muxing_queue_size 9999 "{dest_path}"'
+
+	return (cmd, None)
+
+# Creates the ffmpeg commands of a chunked encode. Each chunk (Tuple(start, duration), times as strings
+# in seconds, duration None for the last chunk) is encoded on its own with the same video settings as
+# build_encode_command (chunks should start at keyframes). The concat command then joins the encoded
+# chunks without re-encoding (concat demuxer) and muxes in the audio/subtitles from the source.
+# chunk_dir is created and gets the encoded chunks and the concat list. video_offset (seconds, string) is where
+# the first chunk starts relative to the start time of the source; the joined chunks are shifted by it so the
+# video stays in sync with the audio/subtitles.
+# Only returns a msg if there is an error.
+# Returns: Tuple(list of chunk ffmpeg command strings (None if error), concat ffmpeg command string, encoded_file_destination_path, msg)
+def build_chunked_encode_commands(encode_data, source_dir, dest_dir, chunks, chunk_dir, threads=0, video_offset=None):
+	dest_path, msg = __get_dest_path(encode_data, source_dir, dest_dir)
+
+	video_settings_str, error_msg = __build_video_settings_str(encode_data.video_data, threads, True)
+	if video_settings_str == None:
+		msg = error_msg if msg == None else msg + [error_msg]
+		return (None, None, dest_path, msg)
+
+	audio_settings_str, error_msg = __build_audio_settings_str(encode_data.audio_data)
+	if audio_settings_str == None:
+		msg = error_msg if msg == None else msg + [error_msg]
+		return (None, None, dest_path, msg)
+
+	subtitle_settings_str = __build_subtitle_settings_str(encode_data.subtitle_data, encode_data.subtitle_forced_data)
+
+	os.makedirs(chunk_dir, mode=0o777, exist_ok=True)
+	chunk_cmds = []
+	chunk_files = []
+	for i, (start, duration) in enumerate(chunks):
+		chunk_file = os.path.join(chunk_dir, f'chunk_{i:04d}.mkv')
+		duration_str = f'-t {duration} ' if duration != None else ''
+		# -seek_timestamp: start is the keyframe's timestamp (not offset by the start time of the file)
+		chunk_cmds.append(f'ffmpeg -y {FFMPEG_PROGRESS_ARGS} -seek_timestamp 1 -ss {start} {duration_str}-i "{encode_data.source_file_full_path}" -map 0:v:0 {video_settings_str}-an -sn -dn -max_muxing_queue_size 9999 "{chunk_file}"')
+		chunk_files.append(chunk_file)
+
+	concat_list = os.path.join(chunk_dir, 'chunks.txt')
+	with open(concat_list, 'w') as f:
+		for chunk_file in chunk_files:
+			escaped = chunk_file.replace("'", "'\\''")
+			f.write(f"file '{escaped}'\n")
+
+	map_str = __build_map_str(encode_data, 0, 1)
+	offset_str = f'-itsoffset {video_offset} ' if (video_offset != None) and (float(video_offset) != 0) else ''
+	concat_cmd = (	f'ffmpeg -y {FFMPEG_PROGRESS_ARGS} {offset_str}-f concat -safe 0 -i "{concat_list}" -i "{encode_data.source_file_full_path}" {map_str}-c:v copy '
+					f'{audio_settings_str}{subtitle_settings_str}-max_muxing_queue_size 9999 "{dest_path}"')
+
+	return (chunk_cmds, concat_cmd, dest_path, msg)
+
+# Returns: True if the string can go in a (double quoted) option of an ffmpeg command
+def is_command_safe(value):
+	return not any((c in '"\\') or (ord(c) < 32) for c in value)
+
+# Returns: JSON value (dicts/lists/plain values) of the given EncodeData/StreamData or anything in it
+def __to_json_value(value):
+	if isinstance(value, Enum):
+		return {'enum' : type(value).__name__, 'name' : value.name}
+	elif isinstance(value, (EncodeData, StreamData, VideoData, AudioData, SubtitleData, HDRData)):
+		return {'class' : type(value).__name__, 'fields' : {field : __to_json_value(getattr(value, field)) for field in value.__slots__}}
+	elif isinstance(value, list):
+		return [__to_json_value(item) for item in value]
+
+	return value
+
+# Returns: EncodeData/StreamData or anything in it built from its JSON value. Raises ValueError if it is not
+# something they are made of (or, if command_safe, has a string that would not stay inside its quotes in the ffmpeg command).
+def __from_json_value(value, command_safe=True):
+	if isinstance(value, dict):
+		if 'enum' in value:
+			enum = {cls.__name__ : cls for cls in (VideoEncoder, AudioEncodeProcess, VideoScan)}.get(value['enum'])
+			if (enum == None) or (value.get('name') not in enum.__members__):
+				raise ValueError(f'Unknown enum value {value.get("enum")}.{value.get("name")}')
+			return enum[value['name']]
+
+		cls = {cls.__name__ : cls for cls in (EncodeData, StreamData, VideoData, AudioData, SubtitleData, HDRData)}.get(value.get('class'))
+		if cls == None:
+			raise ValueError(f'Unknown class {value.get("class")}')
+		obj = cls()
+		for field, field_value in value.get('fields', {}).items():
+			if field not in cls.__slots__:
+				raise ValueError(f'Unknown field {cls.__name__}.{field}')
+			setattr(obj, field, __from_json_value(field_value, command_safe))
+		return obj
+	elif isinstance(value, list):
+		return [__from_json_value(item, command_safe) for item in value]
+	elif isinstance(value, str):
+		if (command_safe == True) and (not is_command_safe(value)):
+			raise ValueError(f'Invalid characters in {value!r}')
+	elif (value != None) and (not isinstance(value, (bool, int, float))):
+		raise ValueError(f'Invalid value {value!r}')
+
+	return value
+
+# Turns the encode data into plain JSON values (e.g. to send it to a farm worker or store it in the analysis cache)
+# Returns: Dict
+def encode_data_to_dict(encode_data):
+	return __to_json_value(encode_data)
+
+# Builds encode data from encode_data_to_dict's output. Everything is checked, so this can take data from the network
+# (command_safe also rejects strings that would not stay inside their quotes in the ffmpeg command).
+# Returns: Tuple(EncodeData (None if invalid), msg)
+def encode_data_from_dict(values, command_safe=True):
+	try:
+		encode_data = __from_json_value(values, command_safe)
+	except (ValueError, TypeError, AttributeError, KeyError) as error:
+		return (None, f'Invalid encode data: {error}')
+
+	if not isinstance(encode_data, EncodeData):
+		return (None, 'Invalid encode data: not an EncodeData.')
+
+	return (encode_data, None)
+
+# Turns the stream data into plain JSON values (see encode_data_to_dict)
+# Returns: Dict
+def stream_data_to_dict(stream_data):
+	return __to_json_value(stream_data)
+
+# Builds stream data from stream_data_to_dict's output (checked like encode_data_from_dict, without command_safe)
+# Returns: Tuple(StreamData (None if invalid), msg)
+def stream_data_from_dict(values):
+	try:
+		stream_data = __from_json_value(values, False)
+	except (ValueError, TypeError, AttributeError, KeyError) as error:
+		return (None, f'Invalid stream data: {error}')
+
+	if not isinstance(stream_data, StreamData):
+		return (None, 'Invalid stream data: not a StreamData.')
+
+	return (stream_data, None)
+
+### FUNCTIONS ###
@@ -0,0 +1,399 @@
+from collections import deque
+from datetime import datetime as dt
+import hmac
+import ipaddress
+import itertools
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from encode_data import *
+from ffmpeg_progress import *
+
+#### DICTIONARIES/STATICS ####
+# Protocol: one JSON object per line. The worker sends a message and the coordinator
+# answers every message with one message.
+#   hello       {worker, token, version}                    => welcome {lease_seconds} | error
+#   request_job {}                                          => job {job_id, attempt, source, encoded, encode_data, duration_seconds} | no_job
+#   heartbeat   {jobs : [{job_id, attempt, progress}]}      => ok {cancel : [{job_id, attempt}]} | error (progress from EncodeProgress.to_dict)
+#   result      {job_id, attempt, returncode, error_msg}    => ok {accepted} | error
+# A job carries the encode data (encode_data_to_dict), not a command; the worker builds the ffmpeg
+# command itself (see build_farm_job_command).
+# Every lease of a job gets a new attempt number. Heartbeats and results of an attempt that is no longer
+# leased (its lease expired and the job was requeued) are rejected, and the worker writes each attempt to
+# its own file (see get_farm_attempt_path) that is only renamed to the encoded file once it succeeded.
+FARM_PROTOCOL_VERSION = 3
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: FarmConnection
+# Description: Worker side connection to the EncodeFarmCoordinator. call sends a message and
+# returns the reply, (re)connecting and saying hello first if needed. Raises OSError/ValueError
+# if the coordinator can't be reached or rejects the worker.
+class FarmConnection:
+	def __init__(self, address, worker_name, token=None, timeout=30):
+		self.address = address
+		self.worker_name = worker_name
+		self.token = token
+		self.timeout = timeout
+		self.lock = threading.Lock()
+		self.sock = None
+		self.reader = None
+		self.lease_seconds = None
+
+	def __connect(self):
+		family, address = parse_farm_address(self.address)
+		self.sock = socket.socket(family, socket.SOCK_STREAM)
+		self.sock.settimeout(self.timeout)
+		self.sock.connect(address)
+		self.reader = self.sock.makefile('rb')
+
+		reply = self.__send({'type' : 'hello', 'worker' : self.worker_name, 'token' : self.token, 'version' : FARM_PROTOCOL_VERSION})
+		if reply.get('type') != 'welcome':
+			self.close()
+			raise ValueError(f'Coordinator rejected worker: {reply.get("error", reply)}')
+
+		self.lease_seconds = reply.get('lease_seconds')
+
+	def __send(self, msg):
+		self.sock.sendall((json.dumps(msg) + '\n').encode('utf-8'))
+		line = self.reader.readline()
+		if not line:
+			raise ConnectionError('Coordinator closed the connection.')
+
+		return json.loads(line.decode('utf-8'))
+
+	# Returns: Reply (dict) of the coordinator
+	def call(self, msg):
+		with self.lock:
+			if self.sock == None:
+				self.__connect()
+
+			try:
+				return self.__send(msg)
+			except (OSError, ValueError):
+				self.close()
+				raise
+
+	def close(self):
+		if self.sock != None:
+			try:
+				self.reader.close()
+				self.sock.close()
+			except OSError:
+				pass
+
+		self.sock = None
+		self.reader = None
+
+# Class: FarmRequestHandler
+# Description: Handles the connection of one worker (see the protocol above)
+class FarmRequestHandler(socketserver.StreamRequestHandler):
+	def handle(self):
+		coordinator = self.server.coordinator
+		worker = None
+		for line in self.rfile:
+			try:
+				msg = json.loads(line.decode('utf-8'))
+			except ValueError:
+				self.__reply({'type' : 'error', 'error' : 'Invalid message.'})
+				return
+
+			if worker == None:
+				if (msg.get('type') != 'hello') or (coordinator.is_authorized(msg.get('token')) == False):
+					self.__reply({'type' : 'error', 'error' : 'Not authorized.'})
+					return
+				if msg.get('version') != FARM_PROTOCOL_VERSION:
+					self.__reply({'type' : 'error', 'error' : f'Unsupported protocol version {msg.get("version")} (coordinator uses {FARM_PROTOCOL_VERSION}).'})
+					return
+
+				host = self.client_address[0] if isinstance(self.client_address, tuple) else 'local'
+				worker = f'{msg.get("worker", "worker")}@{host}'
+				self.__reply({'type' : 'welcome', 'lease_seconds' : coordinator.lease_seconds})
+				continue
+
+			self.__reply(coordinator.handle_message(worker, msg))
+
+	def __reply(self, msg):
+		self.wfile.write((json.dumps(msg) + '\n').encode('utf-8'))
+		self.wfile.flush()
+
+class FarmTCPServer(socketserver.ThreadingTCPServer):
+	allow_reuse_address = True
+	daemon_threads = True
+
+class FarmUnixServer(socketserver.ThreadingUnixStreamServer):
+	daemon_threads = True
+
+# Class: EncodeFarmCoordinator
+# Description: Hands EncodeJobs out to farm workers (farm_worker.py) that connect over TCP or a
+# unix socket. Same interface as EncodeWorkerPool so the daemon can use either one. A job handed
+# to a worker is leased for lease_seconds; heartbeats from the worker renew the lease. Jobs of a
+# worker that stops sending heartbeats are put back at the front of the queue.
+# Jobs wait in a queue of up to queue_size jobs (at least 1); submit blocks while it is full.
+# on_start(job) is called when a worker takes a job, on_requeue(job) when its lease expires and
+# on_complete(job) once the worker sends the result (returncode/error_msg set on the job).
+# The source/encoded paths must be the same on the workers (shared storage). Jobs need their encode_data.
+# Without a token it only listens on a unix socket (owner/group only) or a loopback address.
+class EncodeFarmCoordinator:
+	def __init__(self, address, on_complete=None, queue_size=0, on_start=None, lease_seconds=120, token=None, on_requeue=None):
+		self.address = address
+		self.queue_size = max(queue_size, 1)
+		self.lease_seconds = max(lease_seconds, 5)
+		self.token = token
+		self.on_start = on_start
+		self.on_complete = on_complete
+		self.on_requeue = on_requeue
+		self.condition = threading.Condition()
+		self.pending = deque()
+		# job_id => [job, worker, lease expiration (time.monotonic()), attempt]
+		self.leases = {}
+		self.active = {}
+		self.job_ids = itertools.count(1)
+		self.attempts = itertools.count(1)
+		self.stopping = False
+
+		family, server_address = parse_farm_address(address)
+		if family == socket.AF_UNIX:
+			if os.path.exists(server_address):
+				os.remove(server_address)
+			# Never accessible by others, not even between bind and chmod
+			umask = os.umask(0o007)
+			try:
+				self.server = FarmUnixServer(server_address, FarmRequestHandler)
+			finally:
+				os.umask(umask)
+			os.chmod(server_address, 0o770)
+		else:
+			if (not token) and (is_loopback_host(server_address[0]) == False):
+				raise ValueError(f'Refusing to listen on {address} without a token (set a token or listen on a loopback address/unix socket).')
+			self.server = FarmTCPServer(server_address, FarmRequestHandler)
+		self.server.coordinator = self
+
+		threading.Thread(target=self.server.serve_forever, name='farm_server', daemon=True).start()
+		threading.Thread(target=self.__reaper, name='farm_reaper', daemon=True).start()
+
+	# Puts jobs whose lease expired back in the queue
+	def __reaper(self):
+		while True:
+			time.sleep(max(self.lease_seconds / 4, 1))
+			now = time.monotonic()
+			expired = []
+			with self.condition:
+				for job_id, (job, worker, expires, attempt) in list(self.leases.items()):
+					if expires < now:
+						del self.leases[job_id]
+						job.worker = None
+						job.start_time = None
+						self.pending.appendleft(job)
+						expired.append(job)
+				if expired:
+					self.condition.notify_all()
+
+			for job in expired:
+				self.__callback(self.on_requeue, job)
+
+	# Returns: True if the token a worker sent matches the token of the coordinator (always if it has none)
+	def is_authorized(self, token):
+		if not self.token:
+			return True
+
+		return hmac.compare_digest(str(token or '').encode('utf-8'), self.token.encode('utf-8'))
+
+	def __callback(self, callback, job):
+		if callback != None:
+			try:
+				callback(job)
+			except BaseException:
+				pass
+
+	def __complete(self, job, returncode, error_msg):
+		job.returncode = returncode
+		job.error_msg = error_msg
+		job.stop_time = dt.now()
+		with self.condition:
+			self.active.pop(job.source_file_full_path, None)
+			self.condition.notify_all()
+
+		self.__callback(self.on_complete, job)
+
+	# Returns: The lease of the given attempt of a job if the worker still holds it, otherwise None
+	# (call with the condition held)
+	def __get_lease(self, worker, job_id, attempt):
+		lease = self.leases.get(job_id)
+		if (lease == None) or (lease[1] != worker) or (lease[3] != attempt):
+			return None
+
+		return lease
+
+	# Handles a message from a worker (called on the connection's thread)
+	# Returns: Reply message
+	def handle_message(self, worker, msg):
+		msg_type = msg.get('type')
+		if msg_type == 'request_job':
+			return self.__lease_job(worker)
+
+		elif msg_type == 'heartbeat':
+			jobs = msg.get('jobs', [])
+			if (not isinstance(jobs, list)) or (not all(isinstance(job, dict) and is_job_attempt(job) for job in jobs)):
+				return {'type' : 'error', 'error' : 'Invalid heartbeat: jobs must be a list of {job_id, attempt, progress}.'}
+
+			cancel = []
+			expires = time.monotonic() + self.lease_seconds
+			with self.condition:
+				for job in jobs:
+					lease = self.__get_lease(worker, job['job_id'], job['attempt'])
+					if (lease == None) or (self.stopping == True):
+						cancel.append({'job_id' : job['job_id'], 'attempt' : job['attempt']})
+						continue
+					lease[2] = expires
+					progress = job.get('progress')
+					if isinstance(progress, dict):
+						lease[0].progress = EncodeProgress.from_dict(progress)
+
+			return {'type' : 'ok', 'cancel' : cancel}
+
+		elif msg_type == 'result':
+			if (is_job_attempt(msg) == False) or (not isinstance(msg.get('returncode'), int)):
+				return {'type' : 'error', 'error' : 'Invalid result: job_id, attempt and returncode must be integers.'}
+			error_msg = msg.get('error_msg', [])
+			error_msg = [str(line) for line in error_msg] if isinstance(error_msg, list) else [str(error_msg)]
+
+			with self.condition:
+				lease = self.__get_lease(worker, msg['job_id'], msg['attempt'])
+				if lease == None:
+					# Lease expired (job was requeued); drop the stale result
+					return {'type' : 'ok', 'accepted' : False}
+				del self.leases[msg['job_id']]
+
+			# on_complete may take a while (copying the encoded file); don't hold up the worker
+			threading.Thread(target=self.__complete, args=(lease[0], msg['returncode'], error_msg), daemon=True).start()
+			return {'type' : 'ok', 'accepted' : True}
+
+		return {'type' : 'error', 'error' : f'Unknown message type: {msg_type}'}
+
+	# Returns: job message for the next queued job (no_job if none)
+	def __lease_job(self, worker):
+		while True:
+			with self.condition:
+				if (self.stopping == True) or (not self.pending):
+					return {'type' : 'no_job'}
+
+				job = self.pending.popleft()
+				self.condition.notify_all()
+				if job.encode_data == None:
+					error_msg = [f'No encode data for {job.source_file_full_path}; farm workers build the command from it.']
+				elif os.path.exists(job.source_file_full_path) == False:
+					# The job may have waited in the queue for a while
+					error_msg = [f'Source file {job.source_file_full_path} no longer exists.']
+				else:
+					job.worker = worker
+					job.start_time = dt.now()
+					attempt = next(self.attempts)
+					self.leases[job.job_id] = [job, worker, time.monotonic() + self.lease_seconds, attempt]
+					break
+
+			self.__complete(job, -1, error_msg)
+
+		self.__callback(self.on_start, job)
+		return {'type' : 'job', 'job_id' : job.job_id, 'attempt' : attempt, 'source' : job.source_file_full_path, 'encoded' : job.encoded_file_full_path,
+			'encode_data' : encode_data_to_dict(job.encode_data), 'duration_seconds' : job.encode_data.duration_seconds}
+
+	# Queues the job to be encoded. Blocks while the queue is full.
+	# Returns: The job (with job_id set)
+	def submit(self, job):
+		with self.condition:
+			while (len(self.pending) >= self.queue_size) and (self.stopping == False):
+				self.condition.wait()
+
+			job.job_id = next(self.job_ids)
+			self.active[job.source_file_full_path] = job
+			self.pending.append(job)
+
+		return job
+
+	# Returns: True if the given source file is queued/being encoded
+	def is_active(self, source_file_full_path):
+		with self.condition:
+			return source_file_full_path in self.active
+
+	# Returns: List of jobs queued/being encoded
+	def active_jobs(self):
+		with self.condition:
+			return list(self.active.values())
+
+	# Returns: Number of jobs waiting for a worker
+	def queued_count(self):
+		with self.condition:
+			return len(self.pending)
+
+	# Stops handing out jobs; workers kill their encodes on their next heartbeat.
+	def kill_all(self):
+		with self.condition:
+			self.stopping = True
+			self.condition.notify_all()
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Parses a farm address: unix:/path/to/socket or host:port
+# Returns: Tuple(socket family, address)
+def parse_farm_address(address):
+	if address.startswith('unix:'):
+		return (socket.AF_UNIX, address[len('unix:'):])
+
+	host, sep, port = address.rpartition(':')
+	if not sep:
+		raise ValueError(f'Invalid farm address {address} (expected host:port or unix:/path)')
+
+	return (socket.AF_INET, (host or '127.0.0.1', int(port)))
+
+# Returns: True if the host name/address is (resolves to) a loopback address
+def is_loopback_host(host):
+	try:
+		return ipaddress.ip_address(socket.gethostbyname(host)).is_loopback
+	except (OSError, ValueError):
+		return False
+
+# Returns: True if the message has an integer job_id and attempt (see the protocol above)
+def is_job_attempt(msg):
+	return all(isinstance(msg.get(key), int) and (isinstance(msg.get(key), bool) == False) for key in ('job_id', 'attempt'))
+
+# Returns: Path a farm worker encodes the given attempt of a job to; renamed to the encoded path once
+# the encode succeeded. Hidden (skipped by the directory scans) and next to the encoded file, so the
+# rename stays on the same file system.
+def get_farm_attempt_path(encoded_file_full_path, job_id, attempt):
+	directory, file_name = os.path.split(encoded_file_full_path)
+	name, extension = os.path.splitext(file_name)
+	return os.path.join(directory, f'.{name}.farm_{job_id}_{attempt}{extension}')
+
+# Builds the ffmpeg command of a job message from the coordinator. Nothing of the message is run as is:
+# the encode data and paths are checked (see encode_data_from_dict) and the command is built from them here.
+# The command writes to the attempt's own file (see get_farm_attempt_path).
+# threads is passed on to the video encoder (see build_encode_command).
+# Returns: Tuple(ffmpeg command string (None if error), path the command writes to, msg)
+def build_farm_job_command(reply, threads=0):
+	if is_job_attempt(reply) == False:
+		return (None, None, f'Invalid job_id/attempt in farm job: {reply.get("job_id")!r}/{reply.get("attempt")!r}')
+
+	source = reply.get('source')
+	encoded = reply.get('encoded')
+	for path in (source, encoded):
+		if (not isinstance(path, str)) or (os.path.isabs(path) == False) or (is_command_safe(path) == False):
+			return (None, None, f'Invalid path in farm job: {path!r}')
+
+	encode_data, msg = encode_data_from_dict(reply.get('encode_data'))
+	if encode_data == None:
+		return (None, None, msg)
+	if encode_data.source_file_full_path != source:
+		return (None, None, f'Farm job source {source} does not match its encode data ({encode_data.source_file_full_path}).')
+
+	attempt_path = get_farm_attempt_path(encoded, reply['job_id'], reply['attempt'])
+	cmd, msg = build_encode_command_for_path(encode_data, attempt_path, threads)
+	return (cmd, attempt_path, msg)
+
+### FUNCTIONS ###
@@ -0,0 +1,270 @@
+import os
+import sqlite3
+import statistics
+import threading
+import time
+
+from encode_data import *
+
+#### DICTIONARIES/STATICS ####
+DEFAULT_HISTORY_PATH = '/var/cache/automated_ffmpeg/encode_history.db'
+FALLBACK_HISTORY_PATH = '/tmp/automated_ffmpeg/encode_history.db'
+
+# Number of the most recent similar encodes a prediction is based on
+PREDICTION_SAMPLES = 50
+
+# Columns of the history table (same order as EncodeRecord.__slots__)
+HISTORY_COLUMNS = ['finished', 'source_path', 'source_size', 'duration_seconds', 'width', 'height', 'encoder', 'preset', 'crf',
+	'hdr', 'animated', 'interlaced', 'frames', 'fps', 'output_size', 'encode_seconds', 'chunks', 'worker', 'returncode']
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: EncodeRecord
+# Description: One finished encode. width/height are after cropping; fps is the measured
+# average (frames / encode_seconds). finished is epoch seconds.
+class EncodeRecord:
+	__slots__ = HISTORY_COLUMNS
+	def __init__(self):
+		self.finished = None
+		self.source_path = ''
+		self.source_size = 0
+		self.duration_seconds = None
+		self.width = 0
+		self.height = 0
+		self.encoder = ''
+		self.preset = ''
+		self.crf = None
+		self.hdr = False
+		self.animated = False
+		self.interlaced = False
+		self.frames = 0
+		self.fps = 0.0
+		self.output_size = 0
+		self.encode_seconds = 0.0
+		self.chunks = 0
+		self.worker = None
+		self.returncode = 0
+
+	# Returns: Megapixels encoded per second (pixels of the duration of the video / encode time)
+	def megapixels_per_second(self):
+		if (not self.encode_seconds) or (not self.duration_seconds):
+			return None
+
+		return self.width * self.height * self.duration_seconds / self.encode_seconds / 1000000
+
+# Class: EncodePrediction
+# Description: Estimated encode time and output size of a queued encode, from the throughput
+# of the samples most similar past encodes (basis says which ones: encoder/hdr/animated, encoder or all).
+class EncodePrediction:
+	__slots__ = ['seconds', 'output_size', 'samples', 'basis']
+	def __init__(self, seconds, output_size, samples, basis):
+		self.seconds = seconds
+		self.output_size = output_size
+		self.samples = samples
+		self.basis = basis
+
+	# Returns: One line summary of the prediction
+	def summary(self):
+		seconds = int(self.seconds)
+		return f'estimated {seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}, ~{self.output_size / 1073741824:.1f} GiB (from {self.samples} {self.basis} encode(s))'
+
+# Class: EncodeHistory
+# Description: On-disk (sqlite) history of finished encodes (EncodeRecord). predict estimates
+# how long a queued EncodeData will take and how big the output will be from the history.
+class EncodeHistory:
+	def __init__(self, db_path):
+		self.db_path = db_path
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+		with self.lock, self.connection:
+			self.connection.execute('''CREATE TABLE IF NOT EXISTS history (
+				id INTEGER PRIMARY KEY AUTOINCREMENT,
+				finished REAL NOT NULL,
+				source_path TEXT NOT NULL,
+				source_size INTEGER,
+				duration_seconds REAL,
+				width INTEGER,
+				height INTEGER,
+				encoder TEXT,
+				preset TEXT,
+				crf INTEGER,
+				hdr INTEGER,
+				animated INTEGER,
+				interlaced INTEGER,
+				frames INTEGER,
+				fps REAL,
+				output_size INTEGER,
+				encode_seconds REAL,
+				chunks INTEGER,
+				worker TEXT,
+				returncode INTEGER)''')
+			self.connection.execute('CREATE INDEX IF NOT EXISTS history_similar ON history (encoder, hdr, animated, finished)')
+
+	def add(self, record):
+		with self.lock, self.connection:
+			self.connection.execute(f'INSERT INTO history ({", ".join(HISTORY_COLUMNS)}) VALUES ({", ".join("?" * len(HISTORY_COLUMNS))})',
+				[getattr(record, column) for column in HISTORY_COLUMNS])
+
+	# Returns: List of EncodeRecords (oldest first), optionally only those finished since (epoch seconds)
+	# with the given encoder / only successful ones
+	def records(self, since=None, encoder=None, successful_only=False):
+		conditions = []
+		values = []
+		if since != None:
+			conditions.append('finished >= ?')
+			values.append(since)
+		if encoder != None:
+			conditions.append('encoder = ?')
+			values.append(encoder)
+		if successful_only == True:
+			conditions.append('returncode = 0')
+		where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+
+		with self.lock:
+			rows = self.connection.execute(f'SELECT {", ".join(HISTORY_COLUMNS)} FROM history{where} ORDER BY finished', values).fetchall()
+
+		return [self.__to_record(row) for row in rows]
+
+	@staticmethod
+	def __to_record(row):
+		record = EncodeRecord()
+		for column, value in zip(HISTORY_COLUMNS, row):
+			setattr(record, column, value)
+		record.hdr = record.hdr == 1
+		record.animated = record.animated == 1
+		record.interlaced = record.interlaced == 1
+
+		return record
+
+	# Returns: Rows (megapixels/s, output bytes per megapixel-second) of the most recent successful
+	# encodes matching the conditions
+	def __samples(self, conditions, values):
+		where = ' AND '.join(['returncode = 0', 'encode_seconds > 0', 'duration_seconds > 0', 'width > 0', 'height > 0'] + conditions)
+		with self.lock:
+			rows = self.connection.execute(f'SELECT width, height, duration_seconds, encode_seconds, output_size FROM history WHERE {where} ORDER BY finished DESC LIMIT ?',
+				values + [PREDICTION_SAMPLES]).fetchall()
+
+		samples = []
+		for width, height, duration_seconds, encode_seconds, output_size in rows:
+			megapixel_seconds = width * height * duration_seconds / 1000000
+			samples.append((megapixel_seconds / encode_seconds, (output_size or 0) / megapixel_seconds))
+
+		return samples
+
+	# Estimates how long encoding the EncodeData will take and how big the output will be, from
+	# the median throughput of the most recent similar encodes (same encoder/hdr/animated, falling
+	# back to the same encoder, then to every encode).
+	# Returns: EncodePrediction (None if there is no history or the duration/resolution is unknown)
+	def predict(self, encode_data):
+		width, height = get_video_dimensions(encode_data.video_data)
+		if (not encode_data.duration_seconds) or (width == 0) or (height == 0):
+			return None
+
+		encoder = get_encoder_name(encode_data.video_data.encoder)
+		hdr = 1 if encode_data.video_data.hdr != None else 0
+		animated = 1 if encode_data.video_data.animated == True else 0
+		candidates = [
+			('similar', ['encoder = ?', 'hdr = ?', 'animated = ?'], [encoder, hdr, animated]),
+			(encoder, ['encoder = ?'], [encoder]),
+			('past', [], []),
+		]
+		for basis, conditions, values in candidates:
+			samples = self.__samples(conditions, values)
+			if samples:
+				break
+		else:
+			return None
+
+		megapixel_seconds = width * height * encode_data.duration_seconds / 1000000
+		seconds = megapixel_seconds / statistics.median(sample[0] for sample in samples)
+		output_size = megapixel_seconds * statistics.median(sample[1] for sample in samples)
+
+		return EncodePrediction(seconds, int(output_size), len(samples), basis)
+
+	# Estimates how long encoding a source file of source_size bytes will take from the median encode
+	# time per source byte of the most recent encodes (for movies that were not analyzed yet).
+	# Returns: Seconds (None if there is no history)
+	def predict_seconds_from_size(self, source_size):
+		with self.lock:
+			rows = self.connection.execute('SELECT encode_seconds, source_size FROM history WHERE returncode = 0 AND encode_seconds > 0 AND source_size > 0 ORDER BY finished DESC LIMIT ?',
+				[PREDICTION_SAMPLES]).fetchall()
+
+		if not rows:
+			return None
+
+		return source_size * statistics.median(encode_seconds / size for encode_seconds, size in rows)
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Returns: Name of the VideoEncoder (as ffmpeg calls it, e.g. libx265; '' if None)
+def get_encoder_name(encoder):
+	return encoder.name.lower() if encoder != None else ''
+
+# Returns: Tuple(width, height) of the video after cropping ((0, 0) if unknown)
+def get_video_dimensions(video_data):
+	crop = (video_data.crop or '').replace('crop=', '').split(':')
+	try:
+		if len(crop) >= 2:
+			return (int(crop[0]), int(crop[1]))
+
+		width, height = video_data.orig_resolution.split('x')
+		return (int(width), int(height))
+	except ValueError:
+		return (0, 0)
+
+# Builds the history record of a finished EncodeJob (output_size of 0 if the encoded file is missing)
+# Returns: EncodeRecord
+def build_encode_record(job):
+	record = EncodeRecord()
+	record.finished = time.time()
+	record.source_path = job.source_file_full_path
+	record.source_size = os.path.getsize(job.source_file_full_path) if os.path.exists(job.source_file_full_path) == True else 0
+	record.output_size = os.path.getsize(job.encoded_file_full_path) if (job.returncode == 0) and (os.path.exists(job.encoded_file_full_path) == True) else 0
+	elapsed_time = job.elapsed_time()
+	record.encode_seconds = elapsed_time.total_seconds() if elapsed_time != None else 0.0
+	record.chunks = len(job.chunk_plan.chunk_cmds) if job.chunk_plan != None else 0
+	record.worker = job.worker
+	record.returncode = job.returncode
+
+	if job.encode_data != None:
+		video_data = job.encode_data.video_data
+		record.duration_seconds = job.encode_data.duration_seconds
+		record.width, record.height = get_video_dimensions(video_data)
+		record.encoder = get_encoder_name(video_data.encoder)
+		record.preset, record.crf = VIDEO_ENCODER_SETTINGS.get(video_data.encoder.name, ('', None)) if video_data.encoder != None else ('', None)
+		record.hdr = video_data.hdr != None
+		record.animated = video_data.animated == True
+		record.interlaced = (video_data.scan != None) and (video_data.scan != VideoScan.PROGRESSIVE)
+
+	if job.progress != None:
+		record.frames = job.progress.frame
+	if record.encode_seconds > 0:
+		record.fps = record.frames / record.encode_seconds
+
+	return record
+
+# Opens the encode history. If no path is given, uses DEFAULT_HISTORY_PATH if it is writable
+# and FALLBACK_HISTORY_PATH otherwise.
+# Returns: Tuple(EncodeHistory (None if error), msg)
+def open_encode_history(db_path=None):
+	if not db_path:
+		history_dir = os.path.dirname(DEFAULT_HISTORY_PATH)
+		parent_dir = os.path.dirname(history_dir)
+		db_path = DEFAULT_HISTORY_PATH if (os.access(history_dir, os.W_OK) or os.access(parent_dir, os.W_OK)) else FALLBACK_HISTORY_PATH
+
+	try:
+		os.umask(0)
+		os.makedirs(os.path.dirname(db_path), mode=0o777, exist_ok=True)
+		encode_history = EncodeHistory(db_path)
+	except Exception as error:
+		return (None, f'Unable to open encode history {db_path}: {error}')
+
+	return (encode_history, f'Using encode history {db_path}')
+
+### FUNCTIONS ###
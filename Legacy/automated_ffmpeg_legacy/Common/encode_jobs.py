@@ -0,0 +1,282 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+import itertools
+import os
+import queue
+import shlex
+import shutil
+import subprocess
+import threading
+import traceback
+
+from ffmpeg_progress import *
+
+#### CLASSES ####
+# Class: EncodeJob
+# Description: State of a single encode (one source file => one ffmpeg command, or the
+# commands of a ChunkPlan if chunk_plan is given; cmd is then only used for logging).
+# dir_index is the index of the configured directory pair the source file came from.
+# progress (EncodeProgress) is updated live while the job is encoded (by the farm worker's heartbeats
+# if the job runs on an encode farm worker, see EncodeFarmCoordinator; worker is set then).
+class EncodeJob:
+	__slots__ = ['job_id', 'source_file_full_path', 'encoded_file_full_path', 'cmd', 'encode_data', 'dir_index', 'chunk_plan', 'procs', 'worker', 'progress', 'start_time', 'stop_time', 'returncode', 'error_msg']
+	def __init__(self, source_file_full_path, encoded_file_full_path, cmd, encode_data=None, dir_index=0, chunk_plan=None):
+		self.job_id = None
+		self.source_file_full_path = source_file_full_path
+		self.encoded_file_full_path = encoded_file_full_path
+		self.cmd = cmd
+		self.encode_data = encode_data
+		self.dir_index = dir_index
+		self.chunk_plan = chunk_plan
+		self.procs = []
+		self.worker = None
+		self.progress = None
+		self.start_time = None
+		self.stop_time = None
+		self.returncode = None
+		self.error_msg = []
+
+	# Returns: Time spent encoding (timedelta) or None if not finished
+	def elapsed_time(self):
+		if (self.start_time == None) or (self.stop_time == None):
+			return None
+
+		return self.stop_time - self.start_time
+
+# Class: EncodeWorkerPool
+# Description: Runs EncodeJobs on worker_count worker threads (one ffmpeg process per worker,
+# or up to chunk_plan.workers ffmpeg processes while the chunks of a chunked job encode).
+# Jobs wait in a ready queue of up to queue_size jobs; submit blocks while every worker is
+# busy and the ready queue is full. This lets the caller analyze the next movies while the
+# current ones encode. on_start(job) is called on the worker thread right before ffmpeg is
+# started and on_complete(job) once the ffmpeg process of a job exits (returncode/error_msg
+# set on the job). Errors on the worker threads are reported through the job (error_msg and
+# on_complete); even a callback that exits (SystemExit) does not take its worker down.
+# If on_start fails, the job fails with its error instead of being encoded.
+# While a job runs, the path of its encoded file is kept in a file in working_dir so
+# partially encoded files can be removed after a crash (see remove_partial_encodes).
+# Only the last error_lines lines of ffmpeg's output are kept for the error_msg of a failed job.
+class EncodeWorkerPool:
+	def __init__(self, worker_count, working_dir, on_complete=None, queue_size=0, on_start=None, error_lines=200):
+		self.worker_count = max(worker_count, 1)
+		self.error_lines = max(error_lines, 1)
+		self.queue_size = max(queue_size, 0)
+		self.working_dir = working_dir
+		self.on_start = on_start
+		self.on_complete = on_complete
+		self.lock = threading.Lock()
+		self.slots = threading.Semaphore(self.worker_count + self.queue_size)
+		self.job_queue = queue.Queue()
+		self.active = {}
+		self.job_ids = itertools.count(1)
+		self.stopping = False
+
+		os.umask(0)
+		os.makedirs(self.working_dir, mode=0o777, exist_ok=True)
+
+		for i in range(0, self.worker_count):
+			worker = threading.Thread(target=self.__worker, name=f'encode_worker_{i}', daemon=True)
+			worker.start()
+
+	def __working_file(self, job):
+		return os.path.join(self.working_dir, f'job_{job.job_id}.txt')
+
+	def __worker(self):
+		while True:
+			job = self.job_queue.get()
+			try:
+				self.__run_job(job)
+			except BaseException:
+				job.returncode = -1 if job.returncode == None else job.returncode
+				job.error_msg = traceback.format_exc().split('\n')
+			finally:
+				if job.chunk_plan != None:
+					shutil.rmtree(job.chunk_plan.chunk_dir, ignore_errors=True)
+				with self.lock:
+					self.active.pop(job.source_file_full_path, None)
+				self.slots.release()
+
+			if self.on_complete != None:
+				try:
+					self.on_complete(job)
+				except BaseException:
+					pass
+
+	def __run_job(self, job):
+		if self.stopping == True:
+			job.returncode = -1
+			job.error_msg = ['Encode worker pool is stopping.']
+			return
+
+		# The job may have waited in the ready queue for a while
+		if os.path.exists(job.source_file_full_path) == False:
+			job.returncode = -1
+			job.error_msg = [f'Source file {job.source_file_full_path} no longer exists.']
+			return
+
+		if self.on_start != None:
+			try:
+				self.on_start(job)
+			except BaseException:
+				job.returncode = -1
+				job.error_msg = ['Error before starting the encode.'] + traceback.format_exc().split('\n')
+				return
+
+		working_file = self.__working_file(job)
+		with open(working_file, 'w') as f:
+			f.write(job.encoded_file_full_path)
+
+		if job.progress == None:
+			job.progress = EncodeProgress(job.encode_data.duration_seconds if job.encode_data != None else None)
+
+		try:
+			job.start_time = dt.now()
+			if job.chunk_plan != None:
+				job.returncode, job.error_msg = self.__run_chunked(job)
+			else:
+				job.returncode, job.error_msg = self.__run_cmd(job, job.cmd, job.progress)
+			job.stop_time = dt.now()
+		finally:
+			os.remove(working_file)
+
+	# Runs one ffmpeg command of the job (the process is killed by kill_all). The command is split into
+	# its arguments like a shell would (quotes) but runs without one. Its -progress output (stdout) is read
+	# as it comes in to update progress; on_progress(progress) is called after every update.
+	# Returns: Tuple(returncode, error_msg (last error_lines lines of ffmpeg's output without status lines if it failed))
+	def __run_cmd(self, job, cmd, progress, on_progress=None):
+		proc = subprocess.Popen(shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, errors='replace')
+		with self.lock:
+			job.procs.append(proc)
+
+		stderr_tail = deque(maxlen=self.error_lines)
+		stderr_reader = threading.Thread(target=read_stderr_tail, args=(proc.stderr, stderr_tail), daemon=True)
+		stderr_reader.start()
+		try:
+			read_progress(proc.stdout, progress, on_progress)
+			proc.wait()
+			stderr_reader.join()
+		finally:
+			proc.stdout.close()
+			proc.stderr.close()
+			with self.lock:
+				job.procs.remove(proc)
+
+		if proc.returncode == 0:
+			return (0, [])
+
+		return (proc.returncode, list(stderr_tail))
+
+	# Encodes the chunks of the job in parallel, then joins them into the encoded file.
+	# If a chunk fails, the other chunks are killed and nothing is joined.
+	# Returns: Tuple(returncode, error_msg)
+	def __run_chunked(self, job):
+		plan = job.chunk_plan
+		failed = []
+		chunk_progress = [EncodeProgress() for cmd in plan.chunk_cmds]
+
+		def run_chunk(chunk):
+			i, cmd = chunk
+			if (self.stopping == True) or failed:
+				return
+			returncode, error_msg = self.__run_cmd(job, cmd, chunk_progress[i], lambda updated: job.progress.merge(chunk_progress))
+			if (returncode != 0) and (not failed):
+				failed.append((returncode, [f'Error encoding chunk {i + 1}/{len(plan.chunk_cmds)}: {cmd}'] + error_msg))
+				self.__kill_job(job)
+
+		with ThreadPoolExecutor(max_workers=plan.workers) as executor:
+			list(executor.map(run_chunk, enumerate(plan.chunk_cmds)))
+
+		if failed:
+			return failed[0]
+		elif self.stopping == True:
+			return (-1, ['Encode worker pool is stopping.'])
+
+		returncode, error_msg = self.__run_cmd(job, plan.concat_cmd, EncodeProgress())
+		if returncode != 0:
+			error_msg = [f'Error joining chunks: {plan.concat_cmd}'] + error_msg
+
+		return (returncode, error_msg)
+
+	def __kill_job(self, job):
+		with self.lock:
+			procs = list(job.procs)
+
+		for proc in procs:
+			try:
+				proc.kill()
+			except OSError:
+				pass
+
+	# Queues the job to be encoded. Blocks while every worker is busy and the ready queue is full.
+	# Returns: The job (with job_id set)
+	def submit(self, job):
+		self.slots.acquire()
+		job.job_id = next(self.job_ids)
+		with self.lock:
+			self.active[job.source_file_full_path] = job
+		self.job_queue.put(job)
+		return job
+
+	# Returns: True if the given source file is queued/being encoded
+	def is_active(self, source_file_full_path):
+		with self.lock:
+			return source_file_full_path in self.active
+
+	# Returns: List of jobs queued/being encoded
+	def active_jobs(self):
+		with self.lock:
+			return list(self.active.values())
+
+	# Returns: Number of analyzed jobs waiting for a free worker
+	def queued_count(self):
+		return self.job_queue.qsize()
+
+	# Kills the ffmpeg process(es) of the given source file's job (if being encoded)
+	# Returns: True if the job was found
+	def kill(self, source_file_full_path):
+		with self.lock:
+			job = self.active.get(source_file_full_path)
+
+		if job == None:
+			return False
+
+		self.__kill_job(job)
+		return True
+
+	# Kills the ffmpeg process of every job being encoded and stops queued jobs from starting.
+	def kill_all(self):
+		self.stopping = True
+		for job in self.active_jobs():
+			self.__kill_job(job)
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Removes the partially encoded files left behind by jobs that were running when
+# the program was terminated, along with their working files (and chunk directories).
+# Returns: List of the encoded files that were removed
+def remove_partial_encodes(working_dir):
+	removed = []
+	if not os.path.isdir(working_dir):
+		return removed
+
+	for entry in os.scandir(working_dir):
+		if entry.is_dir(follow_symlinks=False):
+			shutil.rmtree(entry.path, ignore_errors=True)
+			continue
+		elif not entry.is_file():
+			continue
+
+		with open(entry.path, 'r') as f:
+			file_to_delete = f.readline()
+
+		if file_to_delete and os.path.exists(file_to_delete):
+			os.remove(file_to_delete)
+			removed.append(file_to_delete)
+
+		os.remove(entry.path)
+
+	return removed
+
+### FUNCTIONS ###
@@ -0,0 +1,155 @@
+import math
+import os
+import threading
+
+#### DICTIONARIES/STATICS ####
+# Queue policies (order the movies waiting to be analyzed and queued for encoding are taken in, see CandidateQueue)
+# path = directory pair by directory pair, sorted path order within each (how movies were always queued)
+# sjf = shortest estimated encode first
+# oldest = oldest file (mtime) first
+# round_robin = the directory pairs take turns (path order within each)
+QUEUE_POLICIES = ['path', 'sjf', 'oldest', 'round_robin']
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: EncodeScheduler
+# Description: Orders the movies waiting to be analyzed and queued for encoding (list of (movie, dir_index),
+# see CandidateQueue). Movies of directory pairs with a higher priority (priorities,
+# by directory index, 0 if not given) always go first; the policy orders the movies of equal priority.
+# estimate(movie, dir_index) gives the estimated encode seconds used by sjf (None if unknown).
+# Movies without an estimate go after the ones with one, smallest source file first.
+class EncodeScheduler:
+	def __init__(self, policy='path', priorities=None, estimate=None):
+		self.policy = policy
+		self.priorities = priorities or []
+		self.estimate = estimate
+		# Directory pair that gets the first turn of the next round_robin order (rotates every scan)
+		self.next_dir = 0
+
+	# Returns: Priority of the directory pair
+	def priority(self, dir_index):
+		return self.priorities[dir_index] if dir_index < len(self.priorities) else 0
+
+	# Returns: List of (movie, dir_index) in the order they should be encoded
+	def order(self, movies):
+		groups = {}
+		for movie, i in movies:
+			groups.setdefault(self.priority(i), []).append((movie, i))
+
+		ordered = []
+		for priority in sorted(groups, reverse=True):
+			group = groups[priority]
+			if self.policy == 'sjf':
+				ordered.extend(sorted(group, key=self.__sjf_key))
+			elif self.policy == 'oldest':
+				ordered.extend(sorted(group, key=lambda movie: self.__get_stat(movie[0], 'st_mtime')))
+			elif self.policy == 'round_robin':
+				ordered.extend(self.__round_robin(group))
+			else:
+				ordered.extend(sorted(group, key=lambda movie: (movie[1], movie[0])))
+
+		if movies and (self.policy == 'round_robin'):
+			self.next_dir += 1
+
+		return ordered
+
+	def __sjf_key(self, movie):
+		seconds = self.estimate(movie[0], movie[1]) if self.estimate != None else None
+		return (seconds == None, seconds or 0, self.__get_stat(movie[0], 'st_size'))
+
+	@staticmethod
+	def __get_stat(path, attr):
+		try:
+			return getattr(os.stat(path), attr)
+		except OSError:
+			return math.inf
+
+	# Returns: The movies with the directory pairs taking turns (starting with next_dir)
+	def __round_robin(self, movies):
+		by_dir = {}
+		for movie, i in movies:
+			by_dir.setdefault(i, []).append((movie, i))
+
+		dirs = sorted(by_dir)
+		start = self.next_dir % (max(dirs) + 1)
+		dirs = [i for i in dirs if i >= start] + [i for i in dirs if i < start]
+
+		ordered = []
+		turn = 0
+		while len(ordered) < len(movies):
+			for i in dirs:
+				if turn < len(by_dir[i]):
+					ordered.append(by_dir[i][turn])
+			turn += 1
+
+		return ordered
+
+# Class: CandidateQueue
+# Description: Movies (movie, dir_index) waiting to be analyzed and queued for encoding, kept in the
+# order of the scheduler (EncodeScheduler). merge adds the new movies of a scan and orders them along
+# with every movie still waiting, so a movie found by a later scan can go ahead of the ones found before.
+# get blocks until a movie is waiting and takes the first one; it stays queued until done is called for it.
+class CandidateQueue:
+	def __init__(self, scheduler):
+		self.scheduler = scheduler
+		self.condition = threading.Condition()
+		self.pending = []
+		# Movies taken by get that done was not called for yet
+		self.taken = set()
+
+	# Adds the movies that are not queued yet and orders every waiting movie. If ordering fails
+	# (the exception is raised), the new movies wait after the others in the order given.
+	# Returns: List of (movie, dir_index) waiting, in order
+	def merge(self, movies):
+		with self.condition:
+			queued = self.taken.union(movie for movie, i in self.pending)
+			new = [(movie, i) for movie, i in movies if movie not in queued]
+			if new:
+				self.pending.extend(new)
+				self.condition.notify_all()
+				self.pending = self.scheduler.order(self.pending)
+
+			return list(self.pending)
+
+	# Blocks until a movie is waiting.
+	# Returns: The first waiting (movie, dir_index)
+	def get(self):
+		with self.condition:
+			while not self.pending:
+				self.condition.wait()
+
+			movie = self.pending.pop(0)
+			self.taken.add(movie[0])
+			return movie
+
+	# Marks a movie taken by get as handled (analyzed and queued for encoding, or failed)
+	def done(self, movie):
+		with self.condition:
+			self.taken.discard(movie)
+
+	# Returns: True if the movie is waiting or was taken and is not done yet
+	def is_queued(self, movie):
+		with self.condition:
+			return (movie in self.taken) or any(movie == pending for pending, i in self.pending)
+
+	# Returns: Number of movies waiting
+	def queued_count(self):
+		with self.condition:
+			return len(self.pending)
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Parses the comma separated directory pair priorities (empty = all 0)
+# Returns: Tuple(list of priorities (None if error), msg)
+def parse_priorities(value):
+	if not value.strip():
+		return ([], None)
+
+	try:
+		return ([int(priority) if priority.strip() else 0 for priority in value.split(',')], None)
+	except ValueError:
+		return (None, f'Invalid directory priorities "{value}" (comma separated integers). Giving every directory the same priority.')
+
+### FUNCTIONS ###
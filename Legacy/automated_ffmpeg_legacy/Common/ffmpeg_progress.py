@@ -0,0 +1,144 @@
+import threading
+import time
+
+#### DICTIONARIES/STATICS ####
+# Added to ffmpeg commands so ffmpeg writes key=value progress blocks to stdout
+# (ending with progress=continue/end) instead of frame= status lines to stderr.
+FFMPEG_PROGRESS_ARGS = '-progress pipe:1 -nostats'
+
+# stderr lines starting with these are status updates, not worth keeping for error messages
+FFMPEG_STATUS_PREFIXES = ('frame=', 'size=')
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: EncodeProgress
+# Description: Live progress of an ffmpeg encode, updated from its -progress output.
+# duration_seconds is the duration of the source (None if unknown; no percent/ETA then).
+# out_time_seconds is how far into the source the encode is.
+class EncodeProgress:
+	__slots__ = ['duration_seconds', 'frame', 'fps', 'speed', 'bitrate_kbps', 'total_size', 'out_time_seconds', 'finished', 'updated', 'lock']
+	def __init__(self, duration_seconds=None):
+		self.duration_seconds = duration_seconds
+		self.frame = 0
+		self.fps = 0.0
+		self.speed = 0.0
+		self.bitrate_kbps = 0.0
+		self.total_size = 0
+		self.out_time_seconds = 0.0
+		self.finished = False
+		self.updated = None
+		self.lock = threading.Lock()
+
+	# Returns: value converted with convert (default if missing/N/A/invalid)
+	@staticmethod
+	def __to_number(value, convert, default):
+		if value == None:
+			return default
+
+		try:
+			return convert(value.strip())
+		except ValueError:
+			return default
+
+	# Updates the progress from a complete -progress block (dict of key => value)
+	def update(self, block):
+		with self.lock:
+			self.frame = self.__to_number(block.get('frame'), int, self.frame)
+			self.fps = self.__to_number(block.get('fps'), float, self.fps)
+			self.speed = self.__to_number(block.get('speed', '').rstrip('x'), float, self.speed)
+			self.bitrate_kbps = self.__to_number(block.get('bitrate', '').replace('kbits/s', ''), float, self.bitrate_kbps)
+			self.total_size = self.__to_number(block.get('total_size'), int, self.total_size)
+			# out_time_ms is in microseconds as well (long standing ffmpeg quirk)
+			out_time_us = self.__to_number(block.get('out_time_us', block.get('out_time_ms')), int, None)
+			if (out_time_us != None) and (out_time_us >= 0):
+				self.out_time_seconds = out_time_us / 1000000
+			self.finished = block.get('progress') == 'end'
+			self.updated = time.monotonic()
+
+	# Sets the progress to the sum of the given progresses (the chunks of a chunked encode).
+	# speed/fps add up since the chunks are encoded at the same time.
+	def merge(self, parts):
+		with self.lock:
+			self.frame = sum(part.frame for part in parts)
+			self.fps = sum(part.fps for part in parts if part.finished == False)
+			self.speed = sum(part.speed for part in parts if part.finished == False)
+			self.total_size = sum(part.total_size for part in parts)
+			self.out_time_seconds = sum(part.out_time_seconds for part in parts)
+			self.bitrate_kbps = (self.total_size * 8 / 1000 / self.out_time_seconds) if self.out_time_seconds > 0 else 0.0
+			self.finished = all(part.finished for part in parts) if parts else False
+			self.updated = time.monotonic()
+
+	# Returns: Percent (0 - 100) of the source encoded (None if the duration is unknown)
+	def percent(self):
+		if not self.duration_seconds:
+			return None
+
+		return min(self.out_time_seconds / self.duration_seconds * 100, 100.0)
+
+	# Returns: Estimated seconds until the encode finishes (None if unknown)
+	def eta_seconds(self):
+		if (not self.duration_seconds) or (self.speed <= 0):
+			return None
+
+		return max(self.duration_seconds - self.out_time_seconds, 0) / self.speed
+
+	# Returns: Dict of the progress (sent by farm workers with their heartbeats)
+	def to_dict(self):
+		return {'duration_seconds' : self.duration_seconds, 'frame' : self.frame, 'fps' : self.fps, 'speed' : self.speed,
+			'bitrate_kbps' : self.bitrate_kbps, 'total_size' : self.total_size, 'out_time_seconds' : self.out_time_seconds, 'finished' : self.finished}
+
+	# Returns: EncodeProgress from a dict made by to_dict
+	@staticmethod
+	def from_dict(values):
+		progress = EncodeProgress(values.get('duration_seconds'))
+		for key in ('frame', 'fps', 'speed', 'bitrate_kbps', 'total_size', 'out_time_seconds', 'finished'):
+			if key in values:
+				setattr(progress, key, values[key])
+		progress.updated = time.monotonic()
+		return progress
+
+	# Returns: One line summary (frame, fps, speed, bitrate, size, percent, ETA)
+	def summary(self):
+		summary = f'frame={self.frame} fps={self.fps:.2f} speed={self.speed:.3f}x bitrate={self.bitrate_kbps:.1f}kbits/s size={self.total_size / 1048576:.1f}MiB'
+		percent = self.percent()
+		if percent != None:
+			summary += f' {percent:.1f}%'
+		eta = self.eta_seconds()
+		if eta != None:
+			summary += f' ETA {int(eta) // 3600:02d}:{int(eta) % 3600 // 60:02d}:{int(eta) % 60:02d}'
+
+		return summary
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Reads ffmpeg -progress output from stream (lines, bytes or str) until EOF, updating progress
+# after every block. on_update(progress) is called after every update.
+def read_progress(stream, progress, on_update=None):
+	block = {}
+	for line in stream:
+		if isinstance(line, bytes):
+			line = line.decode('utf-8', errors='replace')
+
+		key, sep, value = line.strip().partition('=')
+		if not sep:
+			continue
+
+		block[key] = value
+		if key == 'progress':
+			progress.update(block)
+			block = {}
+			if on_update != None:
+				on_update(progress)
+
+# Reads ffmpeg's stderr (opened in text mode, so \r separated status updates are lines too) until EOF,
+# keeping only the last lines in tail (a deque with a maxlen). Empty and status lines are dropped as
+# they come in, so memory use stays the same however long the encode runs.
+def read_stderr_tail(stream, tail):
+	for line in stream:
+		line = line.rstrip()
+		if line and (not line.startswith(FFMPEG_STATUS_PREFIXES)):
+			tail.append(line)
+
+### FUNCTIONS ###
@@ -1,11 +1,77 @@
 import datetime
 from distutils.util import strtobool
+import os
 from pathlib import Path
+import threading
 import time
 
+#### CLASSES ####
+# Class: FileReadinessTracker
+# Description: Tracks whether files are ready to encode (no longer being written to) across scan cycles
+# without blocking. observe stats all the given files in one pass and remembers their size/mtime.
+# A file is ready once its size/mtime have not changed for quiet_seconds. A file seen for the first time
+# is ready right away if its mtime is already quiet_seconds old (it was finished before the daemon saw it).
+class FileReadinessTracker:
+	def __init__(self, quiet_seconds=30):
+		self.quiet_seconds = max(quiet_seconds, 0)
+		self.lock = threading.Lock()
+		# path => (size, mtime_ns, time.monotonic() of the last change)
+		self.observations = {}
+
+	# Stats the files and updates their observations. Files that can't be stat'ed are dropped.
+	# Returns: Tuple(list of ready files, list of files still being written to)
+	def observe(self, paths):
+		ready = []
+		not_ready = []
+		now = time.monotonic()
+		wall_now = time.time()
+		with self.lock:
+			for path in paths:
+				try:
+					stat = os.stat(path)
+				except OSError:
+					self.observations.pop(path, None)
+					continue
+
+				known = self.observations.get(path)
+				if (known != None) and (known[0] == stat.st_size) and (known[1] == stat.st_mtime_ns):
+					changed_at = known[2]
+				elif known == None:
+					# Treat the mtime as the last change (clamped for clock skew, e.g. NFS)
+					changed_at = now - min(max(wall_now - (stat.st_mtime_ns / 1e9), 0), self.quiet_seconds)
+				else:
+					changed_at = now
+
+				self.observations[path] = (stat.st_size, stat.st_mtime_ns, changed_at)
+				if now - changed_at >= self.quiet_seconds:
+					ready.append(path)
+				else:
+					not_ready.append(path)
+
+		return (ready, not_ready)
+
+	# Returns: Seconds until the next tracked (not ready) file could become ready, None if nothing is waiting
+	def seconds_until_ready(self):
+		now = time.monotonic()
+		with self.lock:
+			remaining = [self.quiet_seconds - (now - changed_at) for size, mtime_ns, changed_at in self.observations.values() if now - changed_at < self.quiet_seconds]
+
+		return max(min(remaining), 0) if remaining else None
+
+	# Drops the observations of every file not in paths (encoded/removed files)
+	def prune(self, paths):
+		keep = set(paths)
+		with self.lock:
+			for path in [path for path in self.observations if path not in keep]:
+				del self.observations[path]
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+
 # Checks the state of the file to see if it is ready to encode
 # Currently checks to see if the file size is changing to see if it is being
-# written to
+# written to (blocks for 5 seconds, see FileReadinessTracker for a non-blocking check)
 # Returns: Tuple(Bool (True if ready to encode, False otherwise), message)
 def check_file_ready(video_full_path):
 	is_ready = False
@@ -33,4 +99,6 @@ def convert_timestamp_to_seconds(timestamp):
 # distutils.utils.strtobool does the heavy lifting
 # This wraps it in bool() to get a proper boolean.
 def convert_to_bool(input):
-	return bool(strtobool(input))
\ No newline at end of file
+	return bool(strtobool(input))
+
+### FUNCTIONS ###
@@ -0,0 +1,181 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import os
+import sqlite3
+import threading
+import time
+
+#### DICTIONARIES/STATICS ####
+DEFAULT_CATALOG_PATH = '/var/cache/automated_ffmpeg/library_catalog.db'
+FALLBACK_CATALOG_PATH = '/tmp/automated_ffmpeg/library_catalog.db'
+# A directory whose mtime is within this many seconds of when it was listed is listed again on the next
+# scan even if its mtime did not change: entries added right after the listing can leave the mtime as is
+# (coarse timestamps), like git's racy-git check.
+RACY_MTIME_SECONDS = 3
+# Columns of the directories table (a table from an older version without them is recreated)
+DIRECTORY_COLUMNS = ['path', 'mtime_ns', 'listed_ns', 'subdirs']
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: LibraryCatalog
+# Description: Persistent (sqlite) catalog of the files under the source/encoded library directories.
+# scan walks a directory tree with os.scandir in a single pass. A directory whose mtime has not
+# changed since the last scan is not listed again (its files/subdirectories come from the catalog);
+# only its subdirectories are checked. The time a directory was listed is stored with it; if its mtime
+# was within RACY_MTIME_SECONDS of that, it is listed again anyway. Subtrees directly under the scanned directory are walked in
+# parallel. Note: a directory's mtime only changes when entries are added/removed/renamed, so size
+# changes of files in an unchanged directory are not picked up by a scan.
+# Hidden files/directories (starting with '.') are skipped like glob does.
+class LibraryCatalog:
+	def __init__(self, db_path, workers=4):
+		self.db_path = db_path
+		self.workers = max(workers, 1)
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+		with self.lock, self.connection:
+			columns = [row[1] for row in self.connection.execute('PRAGMA table_info(directories)')]
+			if columns and (columns != DIRECTORY_COLUMNS):
+				# Every directory gets listed again on the next scan
+				self.connection.execute('DROP TABLE directories')
+			self.connection.execute('''CREATE TABLE IF NOT EXISTS directories (
+				path TEXT PRIMARY KEY,
+				mtime_ns INTEGER NOT NULL,
+				listed_ns INTEGER NOT NULL,
+				subdirs TEXT NOT NULL)''')
+			self.connection.execute('''CREATE TABLE IF NOT EXISTS files (
+				path TEXT PRIMARY KEY,
+				directory TEXT NOT NULL,
+				size INTEGER NOT NULL,
+				mtime_ns INTEGER NOT NULL)''')
+			self.connection.execute('CREATE INDEX IF NOT EXISTS files_directory ON files (directory)')
+
+	# Returns: SQL condition (and its parameters) matching the path column of everything under root
+	def __under(self, root, column='path'):
+		prefix = root.rstrip('/') + '/'
+		return (f'({column} = ? OR substr({column}, 1, ?) = ?)', (root.rstrip('/'), len(prefix), prefix))
+
+	# Walks a directory tree, skipping the listing of directories that have not changed.
+	# If recursive is False, only top itself is checked.
+	# Returns: Tuple(list of directories visited, dict of changed directories => (mtime_ns, listed_ns, subdirs, files))
+	def __walk_tree(self, top, snapshot, recursive=True):
+		visited = []
+		changed = {}
+		stack = [top]
+		while stack:
+			directory = stack.pop()
+			try:
+				mtime_ns = os.stat(directory).st_mtime_ns
+			except OSError:
+				continue
+
+			visited.append(directory)
+			known = snapshot.get(directory)
+			if (known != None) and (known[0] == mtime_ns) and (mtime_ns < known[1] - RACY_MTIME_SECONDS * 1000000000):
+				subdirs = known[2]
+			else:
+				# Taken before listing: anything changed after this shows up on the next scan
+				listed_ns = int(time.time() * 1000000000)
+				subdirs = []
+				files = []
+				try:
+					with os.scandir(directory) as entries:
+						for entry in entries:
+							if entry.name.startswith('.'):
+								continue
+							if entry.is_dir(follow_symlinks=False):
+								subdirs.append(entry.name)
+							elif entry.is_file():
+								stat = entry.stat()
+								files.append((entry.name, stat.st_size, stat.st_mtime_ns))
+				except OSError:
+					visited.pop()
+					continue
+
+				changed[directory] = (mtime_ns, listed_ns, subdirs, files)
+
+			if recursive == True:
+				stack.extend(os.path.join(directory, subdir) for subdir in subdirs)
+
+		return (visited, changed)
+
+	# Brings the catalog of everything under root up to date with the file system.
+	# Returns: Number of directories that had to be listed again
+	def scan(self, root):
+		root = root.rstrip('/')
+		condition, params = self.__under(root)
+		with self.lock:
+			rows = self.connection.execute(f'SELECT path, mtime_ns, listed_ns, subdirs FROM directories WHERE {condition}', params).fetchall()
+		snapshot = {path : (mtime_ns, listed_ns, json.loads(subdirs)) for path, mtime_ns, listed_ns, subdirs in rows}
+
+		# Root first, then every subtree directly under it in parallel
+		visited, changed = self.__walk_tree(root, snapshot, False)
+		if root in changed:
+			subdirs = changed[root][2]
+		elif root in visited:
+			subdirs = snapshot[root][2]
+		else:
+			subdirs = []
+
+		subtrees = [os.path.join(root, subdir) for subdir in subdirs]
+		if subtrees:
+			with ThreadPoolExecutor(max_workers=self.workers) as executor:
+				for subtree_visited, subtree_changed in executor.map(lambda top: self.__walk_tree(top, snapshot), subtrees):
+					visited.extend(subtree_visited)
+					changed.update(subtree_changed)
+
+		removed = [(path,) for path in set(snapshot) - set(visited)]
+		with self.lock, self.connection:
+			self.connection.executemany('DELETE FROM directories WHERE path = ?', removed)
+			self.connection.executemany('DELETE FROM files WHERE directory = ?', removed)
+			for directory, (mtime_ns, listed_ns, subdirs, files) in changed.items():
+				self.connection.execute('INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?)', (directory, mtime_ns, listed_ns, json.dumps(subdirs)))
+				self.connection.execute('DELETE FROM files WHERE directory = ?', (directory,))
+				self.connection.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+					[(os.path.join(directory, name), directory, size, file_mtime_ns) for name, size, file_mtime_ns in files])
+
+		return len(changed)
+
+	# Returns: Sorted list of the cataloged files under root with one of the given extensions
+	def list_files(self, root, extensions):
+		condition, params = self.__under(root, 'directory')
+		with self.lock:
+			rows = self.connection.execute(f'SELECT path FROM files WHERE {condition}', params).fetchall()
+
+		files = [row[0] for row in rows if row[0].endswith(tuple(extensions))]
+		files.sort()
+		return files
+
+	# Returns: Size of the cataloged file (None if not cataloged)
+	def file_size(self, path):
+		with self.lock:
+			row = self.connection.execute('SELECT size FROM files WHERE path = ?', (path,)).fetchone()
+
+		return None if row == None else row[0]
+
+	def close(self):
+		with self.lock:
+			self.connection.close()
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Opens the library catalog. If no path is given, uses DEFAULT_CATALOG_PATH if it is writable
+# and FALLBACK_CATALOG_PATH otherwise.
+# Returns: Tuple(LibraryCatalog (None if error), msg)
+def open_library_catalog(db_path=None, workers=4):
+	if not db_path:
+		catalog_dir = os.path.dirname(DEFAULT_CATALOG_PATH)
+		parent_dir = os.path.dirname(catalog_dir)
+		db_path = DEFAULT_CATALOG_PATH if (os.access(catalog_dir, os.W_OK) or os.access(parent_dir, os.W_OK)) else FALLBACK_CATALOG_PATH
+
+	try:
+		os.umask(0)
+		os.makedirs(os.path.dirname(db_path), mode=0o777, exist_ok=True)
+		catalog = LibraryCatalog(db_path, workers)
+	except Exception as error:
+		return (None, f'Unable to open library catalog {db_path}: {error}')
+
+	return (catalog, f'Using library catalog {db_path}')
+
+### FUNCTIONS ###
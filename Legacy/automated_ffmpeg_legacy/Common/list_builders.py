@@ -56,13 +56,31 @@ def build_movie_encoded_lists(movie_encoded_dir):
 
 	return (movie_encoded_files, movie_encoded_files_base)
 
-# Builds a list of new movie files to encode
+# Same as build_movie_lists (without user_input) but the files come from the library catalog.
+# The catalog should have been brought up to date with catalog.scan(source_dir) first.
+# Returns: Tuple with index 0 being movie files, and index 1 being base filenames
+def build_movie_lists_from_catalog(catalog, source_dir):
+	movie_files = catalog.list_files(source_dir, ('.mkv',))
+	movie_files_base = sorted(Path(m).stem for m in movie_files)
+
+	return (movie_files, movie_files_base)
+
+# Same as build_movie_encoded_lists but the files come from the library catalog (a single
+# lookup for all extensions). The catalog should have been brought up to date with
+# catalog.scan(movie_encoded_dir) first.
+# Returns: Tuple with index 0 being movie files, and index 1 being base filenames
+def build_movie_encoded_lists_from_catalog(catalog, movie_encoded_dir):
+	movie_encoded_files = catalog.list_files(movie_encoded_dir, ('.mkv', '.m4v', '.mp4'))
+	movie_encoded_files_base = [Path(m).stem for m in movie_encoded_files]
+
+	return (movie_encoded_files, movie_encoded_files_base)
+
+# Builds a list of new movie files to encode (source movies with no encoded file of the same base filename).
+# Uses a set of the encoded base filenames so the diff scales linearly with the library size.
+# movie_files_base is not needed anymore (the base filename is taken from each movie file) but is
+# kept so existing callers don't have to change.
 # Returns: List of new movie files to encode
 def build_to_encode_list(movie_files, movie_files_base, movie_encoded_files_base):
-	# List of differences in base file lists
-	diff_list = [m for m in movie_files_base if m not in movie_encoded_files_base]
-
-	# Uses diff_list base file names to find full file path in movie_files
-	to_encode = [m for m in movie_files if any(f'{sub}.mkv' in m for sub in diff_list)]
+	encoded_base = set(movie_encoded_files_base)
 
-	return to_encode
\ No newline at end of file
+	return [m for m in movie_files if os.path.splitext(os.path.basename(m))[0] not in encoded_base]
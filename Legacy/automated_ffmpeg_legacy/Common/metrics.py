@@ -0,0 +1,192 @@
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import socketserver
+import threading
+import time
+
+#### DICTIONARIES/STATICS ####
+# Upper bounds (seconds) of the histogram buckets (+Inf is always added)
+DEFAULT_BUCKETS = (0.1, 0.5, 1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 28800)
+
+# name => (type, help) of the metrics automated_ffmpeg records
+METRIC_DESCRIPTIONS = {
+	'automated_ffmpeg_scan_duration_seconds' : ('histogram', 'Time spent listing the movie/encoded directories of a directory pair'),
+	'automated_ffmpeg_scan_files' : ('gauge', 'Number of files found by the last scan'),
+	'automated_ffmpeg_scan_files_total' : ('counter', 'Number of files found by all scans'),
+	'automated_ffmpeg_analysis_stage_seconds' : ('histogram', 'Time spent in each analysis stage (ffprobe, crop, scan, crop_scan)'),
+	'automated_ffmpeg_queue_depth' : ('gauge', 'Number of analyzed movies waiting for an encode worker'),
+	'automated_ffmpeg_encodes_active' : ('gauge', 'Number of movies being encoded'),
+	'automated_ffmpeg_encode_fps' : ('gauge', 'Frames per second of all running encodes'),
+	'automated_ffmpeg_encode_speed' : ('gauge', 'Speed (x realtime) of all running encodes'),
+	'automated_ffmpeg_encodes_total' : ('counter', 'Number of finished encodes by result'),
+	'automated_ffmpeg_encode_duration_seconds' : ('histogram', 'Time spent encoding a movie'),
+	'automated_ffmpeg_encoded_bytes_total' : ('counter', 'Bytes of encoded movies written'),
+	'automated_ffmpeg_plex_copy_seconds' : ('histogram', 'Time spent copying an encoded movie to plex'),
+	'automated_ffmpeg_plex_copy_bytes_total' : ('counter', 'Bytes copied to plex'),
+	'automated_ffmpeg_plex_copy_bytes_per_second' : ('gauge', 'Throughput of the last copy to plex'),
+	'automated_ffmpeg_plex_copies_pending' : ('gauge', 'Number of encoded movies waiting to be/being copied to plex'),
+	'automated_ffmpeg_plex_scan_seconds' : ('histogram', 'Time plex took to scan the copied movies (only if scan_wait is set)'),
+	'automated_ffmpeg_failures_total' : ('counter', 'Number of failures by stage'),
+}
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: MetricsRegistry
+# Description: Thread safe counters, gauges and histograms rendered in the Prometheus text
+# format. Metrics are created on first use; describe adds the HELP line. Gauges can also be
+# computed when rendered (set_gauge_callback), e.g. for queue depth.
+class MetricsRegistry:
+	def __init__(self):
+		self.lock = threading.Lock()
+		# name => (type, help)
+		self.descriptions = {}
+		# name => {labels (sorted tuple of (key, value)) => value}
+		self.values = {}
+		# name => {labels => [bucket counts, sum, count]}
+		self.histograms = {}
+		self.buckets = {}
+		# name => function returning a value or a dict of labels (dict) => value
+		self.callbacks = {}
+
+	def __labels(self, labels):
+		return tuple(sorted(labels.items())) if labels else ()
+
+	def describe(self, name, metric_type, help_text, buckets=DEFAULT_BUCKETS):
+		with self.lock:
+			self.descriptions[name] = (metric_type, help_text)
+			if metric_type == 'histogram':
+				self.buckets[name] = tuple(buckets)
+
+	# Adds value to a counter
+	def inc(self, name, value=1, labels=None):
+		key = self.__labels(labels)
+		with self.lock:
+			values = self.values.setdefault(name, {})
+			values[key] = values.get(key, 0) + value
+
+	def set(self, name, value, labels=None):
+		with self.lock:
+			self.values.setdefault(name, {})[self.__labels(labels)] = value
+
+	# Adds an observation (e.g. a duration in seconds) to a histogram
+	def observe(self, name, value, labels=None):
+		key = self.__labels(labels)
+		with self.lock:
+			buckets = self.buckets.get(name, DEFAULT_BUCKETS)
+			histogram = self.histograms.setdefault(name, {}).get(key)
+			if histogram == None:
+				histogram = [[0] * len(buckets), 0.0, 0]
+				self.histograms[name][key] = histogram
+
+			for i, bound in enumerate(buckets):
+				if value <= bound:
+					histogram[0][i] += 1
+			histogram[1] += value
+			histogram[2] += 1
+
+	# Observes how long the with block takes (seconds) in a histogram
+	@contextmanager
+	def time(self, name, labels=None):
+		start = time.monotonic()
+		try:
+			yield
+		finally:
+			self.observe(name, time.monotonic() - start, labels)
+
+	def set_gauge_callback(self, name, callback):
+		with self.lock:
+			self.callbacks[name] = callback
+
+	def __format_labels(self, key, extra=()):
+		pairs = list(key) + list(extra)
+		if not pairs:
+			return ''
+
+		escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+		return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+	# Returns: All metrics in the Prometheus text format
+	def render(self):
+		with self.lock:
+			callbacks = dict(self.callbacks)
+
+		callback_values = {}
+		for name, callback in callbacks.items():
+			try:
+				value = callback()
+			except Exception:
+				continue
+			callback_values[name] = {self.__labels(labels) : v for labels, v in value} if isinstance(value, list) else {() : value}
+
+		lines = []
+		with self.lock:
+			values = dict(self.values)
+			values.update(callback_values)
+			for name in sorted(set(values) | set(self.histograms)):
+				metric_type, help_text = self.descriptions.get(name, ('histogram' if name in self.histograms else 'gauge', ''))
+				if help_text:
+					lines.append(f'# HELP {name} {help_text}')
+				lines.append(f'# TYPE {name} {metric_type}')
+
+				if name in self.histograms:
+					buckets = self.buckets.get(name, DEFAULT_BUCKETS)
+					for key, (counts, total, count) in sorted(self.histograms[name].items()):
+						for bound, bucket_count in zip(buckets, counts):
+							lines.append(f'{name}_bucket{self.__format_labels(key, [("le", bound)])} {bucket_count}')
+						lines.append(f'{name}_bucket{self.__format_labels(key, [("le", "+Inf")])} {count}')
+						lines.append(f'{name}_sum{self.__format_labels(key)} {total}')
+						lines.append(f'{name}_count{self.__format_labels(key)} {count}')
+				else:
+					for key, value in sorted(values[name].items()):
+						lines.append(f'{name}{self.__format_labels(key)} {value}')
+
+		return '\n'.join(lines) + '\n'
+
+# Class: MetricsRequestHandler
+# Description: Serves GET /metrics with the registry of the server
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+	def do_GET(self):
+		if self.path.split('?')[0] not in ('/metrics', '/'):
+			self.send_error(404)
+			return
+
+		body = self.server.registry.render().encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+		self.send_header('Content-Length', str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+	# Requests are not logged (stderr is not watched by anyone)
+	def log_message(self, format, *args):
+		pass
+
+class MetricsHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+#### CLASSES ####
+
+#### GLOBALS ####
+# Registry used by all the modules
+metrics = MetricsRegistry()
+for name, (metric_type, help_text) in METRIC_DESCRIPTIONS.items():
+	metrics.describe(name, metric_type, help_text)
+
+#### GLOBALS ####
+
+### FUNCTIONS ####
+# Serves the registry at http://address:port/metrics on a background thread.
+# Returns: Tuple(MetricsHTTPServer (None if error), msg)
+def start_metrics_server(address, port, registry=metrics):
+	try:
+		server = MetricsHTTPServer((address, port), MetricsRequestHandler)
+	except OSError as error:
+		return (None, f'Unable to start metrics endpoint on {address}:{port}: {error}')
+
+	server.registry = registry
+	threading.Thread(target=server.serve_forever, name='metrics_server', daemon=True).start()
+
+	return (server, f'Serving metrics at http://{address}:{server.server_address[1]}/metrics')
+
+### FUNCTIONS ###
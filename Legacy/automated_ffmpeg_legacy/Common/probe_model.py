@@ -0,0 +1,169 @@
+from collections import namedtuple
+import os
+from subprocess import Popen
+import subprocess
+import threading
+import traceback
+import xml.etree.ElementTree as ET
+
+#### DICTIONARIES/STATICS ####
+# ffprobe arguments used to gather data on a video file (file path gets appended)
+# Reads the first 2 packets/frames to get at the side data (HDR)
+FFPROBE_ARGS = ['ffprobe', '-v', 'error', '-read_intervals', '%+#2', '-print_format', 'xml', '-show_format', '-show_streams', '-show_entries', 'side_data']
+
+MASTERING_DISPLAY_SIDE_DATA = 'Mastering display metadata'
+CONTENT_LIGHT_LEVEL_SIDE_DATA = 'Content light level metadata'
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: MasteringDisplay
+# Description: HDR mastering display metadata (numerators of the ffprobe fractions)
+MasteringDisplay = namedtuple('MasteringDisplay', ['red_x', 'red_y', 'green_x', 'green_y', 'blue_x', 'blue_y', 'white_point_x', 'white_point_y', 'min_luminance', 'max_luminance'])
+
+# Class: ContentLightLevel
+# Description: HDR content light level metadata (max_content/max_average are 0 if missing)
+ContentLightLevel = namedtuple('ContentLightLevel', ['max_content', 'max_average'])
+
+# Class: ProbeVideoStream
+# Description: A video stream. Color values are None if ffprobe didn't report them.
+ProbeVideoStream = namedtuple('ProbeVideoStream', ['index', 'codec_name', 'width', 'height', 'color_space', 'color_transfer', 'color_primaries', 'chroma_location'])
+
+# Class: ProbeAudioStream
+# Description: An audio stream. audio_index is its index among the audio streams (ffmpeg's a:N).
+# language/title/channel_layout are None if missing.
+ProbeAudioStream = namedtuple('ProbeAudioStream', ['index', 'audio_index', 'codec_name', 'profile', 'channels', 'channel_layout', 'language', 'title'])
+
+# Class: ProbeSubtitleStream
+# Description: A subtitle stream. subtitle_index is its index among the subtitle streams (ffmpeg's s:N).
+# default/forced are None if the stream has no disposition section.
+ProbeSubtitleStream = namedtuple('ProbeSubtitleStream', ['index', 'subtitle_index', 'codec_name', 'language', 'title', 'default', 'forced'])
+
+# Class: ProbeOtherStream
+# Description: Any other stream (attachments, data)
+ProbeOtherStream = namedtuple('ProbeOtherStream', ['index', 'codec_type', 'codec_name'])
+
+# Class: ProbeModel
+# Description: Everything the automated and guided paths need from ffprobe, built in one pass over
+# its output (probe_video_model). Immutable; the stream lists are tuples in stream order.
+# start_seconds is the start time of the file (0 if ffprobe didn't report one).
+# mastering_display/content_light_level are None if the video has no HDR side data.
+ProbeModel = namedtuple('ProbeModel', ['source_file_full_path', 'duration_seconds', 'start_seconds', 'video_streams', 'audio_streams', 'subtitle_streams', 'other_streams',
+	'mastering_display', 'content_light_level'])
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Returns: Dict of the tag key => value of a stream element
+def __get_tags(stream):
+	return {tag.get('key') : tag.get('value') for tag in stream.findall('tag')}
+
+# Returns: Stream tuple built from a stream element (index of its type = type_counts)
+def __build_stream(stream, type_counts):
+	codec_type = stream.get('codec_type')
+	index = int(stream.get('index'))
+	codec_name = stream.get('codec_name')
+	tags = __get_tags(stream)
+	type_index = type_counts.get(codec_type, 0)
+	type_counts[codec_type] = type_index + 1
+
+	if codec_type == 'video':
+		return ProbeVideoStream(index, codec_name, int(stream.get('width')), int(stream.get('height')), stream.get('color_space'),
+			stream.get('color_transfer'), stream.get('color_primaries'), stream.get('chroma_location'))
+	elif codec_type == 'audio':
+		return ProbeAudioStream(index, type_index, codec_name, stream.get('profile'), int(stream.get('channels')), stream.get('channel_layout'),
+			tags.get('language'), tags.get('title'))
+	elif codec_type == 'subtitle':
+		disposition = stream.find('disposition')
+		default = disposition.get('default') == '1' if disposition != None else None
+		forced = disposition.get('forced') == '1' if disposition != None else None
+		return ProbeSubtitleStream(index, type_index, codec_name, tags.get('language'), tags.get('title'), default, forced)
+
+	return ProbeOtherStream(index, codec_type, codec_name)
+
+# Returns: MasteringDisplay from a side_data element
+def __build_mastering_display(side_data):
+	return MasteringDisplay(*[side_data.get(field).split('/')[0] for field in MasteringDisplay._fields])
+
+# Returns: ContentLightLevel from a side_data element
+def __build_content_light_level(side_data):
+	return ContentLightLevel(side_data.get('max_content') or '0', side_data.get('max_average') or '0')
+
+# Runs ffprobe on the given video file and builds a ProbeModel from its xml output in a single
+# streaming pass: each stream/frame element is turned into the model as soon as it ends and then
+# dropped, and side data is ignored once both HDR mastering and light level data were found.
+# Returns: Tuple(ProbeModel (None if error), msg)
+def probe_video_model(video_full_path):
+	try:
+		proc = Popen(FFPROBE_ARGS + [video_full_path], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+	except OSError as error:
+		return (None, [f'Error running ffprobe for {video_full_path}. Details below.'] + traceback.format_exc().split('\n'))
+
+	streams = []
+	type_counts = {}
+	mastering_display = None
+	content_light_level = None
+	duration_seconds = None
+	start_seconds = 0.0
+	parse_error = None
+	element_stack = []
+	# stderr is drained on its own thread so ffprobe can't block on a full stderr pipe while stdout is parsed
+	stderr_chunks = []
+	stderr_reader = threading.Thread(target=lambda: stderr_chunks.append(proc.stderr.read()), daemon=True)
+	stderr_reader.start()
+	with proc:
+		try:
+			for event, element in ET.iterparse(proc.stdout, events=('start', 'end')):
+				if event == 'start':
+					element_stack.append(element)
+					continue
+
+				element_stack.pop()
+				tag = element.tag
+				if tag == 'side_data':
+					if (mastering_display == None) or (content_light_level == None):
+						side_data_type = element.get('side_data_type')
+						if (side_data_type == MASTERING_DISPLAY_SIDE_DATA) and (mastering_display == None):
+							mastering_display = __build_mastering_display(element)
+						elif (side_data_type == CONTENT_LIGHT_LEVEL_SIDE_DATA) and (content_light_level == None):
+							content_light_level = __build_content_light_level(element)
+					continue
+				elif tag == 'stream':
+					streams.append(__build_stream(element, type_counts))
+				elif tag == 'format':
+					duration = element.get('duration')
+					duration_seconds = float(duration) if duration != None else None
+					start_time = element.get('start_time')
+					start_seconds = float(start_time) if start_time != None else 0.0
+				elif tag not in ('frame', 'packet'):
+					continue
+
+				# Done with the element; don't keep it around
+				if element_stack:
+					element_stack[-1].remove(element)
+		except (ET.ParseError, ValueError, TypeError) as error:
+			parse_error = str(error)
+			proc.kill()
+
+		stderr_reader.join()
+		stderr = b''.join(stderr_chunks)
+
+	if (proc.returncode != 0) or (parse_error != None) or (duration_seconds == None):
+		error_msg = stderr.decode('utf-8', errors='replace').split('\n')
+		if parse_error != None:
+			error_msg.insert(0, f'Unable to parse ffprobe output: {parse_error}')
+		elif (proc.returncode == 0) and (duration_seconds == None):
+			error_msg.insert(0, 'ffprobe output has no duration.')
+		error_msg.insert(0, f'Error running ffprobe for {video_full_path}. Details below.')
+		return (None, error_msg)
+
+	probe = ProbeModel(video_full_path, duration_seconds, start_seconds,
+		tuple(stream for stream in streams if isinstance(stream, ProbeVideoStream)),
+		tuple(stream for stream in streams if isinstance(stream, ProbeAudioStream)),
+		tuple(stream for stream in streams if isinstance(stream, ProbeSubtitleStream)),
+		tuple(stream for stream in streams if isinstance(stream, ProbeOtherStream)),
+		mastering_display, content_light_level)
+
+	return (probe, f'Probed {os.path.basename(video_full_path)} to be analyzed')
+
+### FUNCTIONS ###
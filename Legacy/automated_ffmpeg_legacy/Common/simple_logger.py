@@ -1,7 +1,12 @@
+import atexit
 from datetime import datetime as dt
 from enum import Enum
 import os
 from pathlib import Path
+import queue
+import sys
+import threading
+import time
 
 class Severity(Enum):
 	INFO = 1
@@ -12,27 +17,20 @@ class Severity(Enum):
 # Description: A simple logger (hence the name).
 # Requires a pytz timezone and a log_file name/path passed
 # in. Can log a message string or a list of strings.
-# Uses the Severity Enum
+# Uses the Severity Enum. Safe to use from multiple threads.
 class SimpleLogger:
 	def __init__(self, timezone, log_file):
 		self.timezone = timezone
 		self.log_file = log_file
+		self.lock = threading.RLock()
 
 	def log(self, severity, msg):
 		time_str = dt.now(self.timezone).strftime('%m/%d/%y %H:%M:%S')
+		log_msg = format_log_msg(time_str, severity, msg)
 
-		if isinstance(msg, list):
-			log_msg = f'[{time_str}] - [{severity.name}] : {msg[0]}\n'
-			padding = len(log_msg) - len(msg[0]) - 1
-			
-			for i in range(1, len(msg)):
-				msg[i] = msg[i].rjust(padding + len(msg[i]), ' ') + '\n'
-				log_msg += msg[i]
-		else:
-			log_msg = f'[{time_str}] - [{severity.name}] : {msg}\n'
-
-		with open(self.log_file, 'a') as f:
-			f.write(log_msg)
+		with self.lock:
+			with open(self.log_file, 'a') as f:
+				f.write(log_msg)
 
 # Class: SimpleLoggerWithRollover
 # Description: Inherits from SimpleLogger and adds a manual rollover function.
@@ -51,27 +49,198 @@ class SimpleLoggerWithRollover(SimpleLogger):
 		self.backup_count = backup_count
 
 	def __do_rollover(self):
-		if self.backup_count > 0:
-			for i in range(self.backup_count, 0, -1):
-				file = f'{self.log_file}.{i}'
-				if os.path.exists(file):
-					if i == self.backup_count:
-						os.remove(file)
-					else:
-						os.rename(file, f'{self.log_file}.{i + 1}')
-
-			os.rename(self.log_file, f'{self.log_file}.1')
-			with open(self.log_file, 'w'):
-				pass
-		else:
-			with open(self.log_file, 'w'):
-				pass
+		rotate_log_file(self.log_file, self.backup_count)
 
 	def check_rollover(self):
 		if self.max_bytes >= -1:
-			current_log_file_size = Path(self.log_file).stat().st_size
+			with self.lock:
+				current_log_file_size = Path(self.log_file).stat().st_size
+
+				if current_log_file_size >= self.max_bytes:
+					self.__do_rollover()
+
+# Class: AsyncLogger
+# Description: Same log format/Severity API as SimpleLogger, but log only queues the message
+# (with the time it was logged) and a background thread writes the queue out in batches to a
+# log file it keeps open. The queue holds up to queue_size messages; log blocks while it is full.
+# Rolls the log file over (see SimpleLoggerWithRollover) as soon as it reaches max_bytes
+# (-1 = never), so check_rollover does not need to be called. FATAL messages are written
+# before log returns (the caller usually exits right after); everything else is written
+# at exit (atexit) or when flush/close is called. A message that can't be formatted is written as
+# a line saying so; if the writer thread is gone anyway, log writes to stderr and flush/close return.
+class AsyncLogger:
+	def __init__(self, timezone, log_file, max_bytes=-1, backup_count=0, queue_size=10000, batch_size=500):
+		self.timezone = timezone
+		self.log_file = log_file
+		self.max_bytes = max_bytes
+		self.backup_count = backup_count
+		self.batch_size = max(batch_size, 1)
+		self.queue = queue.Queue(maxsize=max(queue_size, 1))
+		self.file = None
+		self.file_size = 0
+		# Last formatted time (only formatted once per second)
+		self.time_second = None
+		self.time_str = ''
+		self.closed = False
+		self.writer = threading.Thread(target=self.__writer, name='async_logger', daemon=True)
+		self.writer.start()
+		atexit.register(self.close)
+
+	def log(self, severity, msg):
+		if self.closed == True:
+			return
+
+		# Copy lists; the caller may change them before they are written
+		record = (time.time(), severity, list(msg) if isinstance(msg, list) else msg)
+		if self.__put(record) == False:
+			sys.stderr.write(self.__format_record(record))
+
+		if severity == Severity.FATAL:
+			self.flush()
+
+	# Rollover happens as soon as the log file reaches max_bytes; kept so AsyncLogger can
+	# be used in place of SimpleLoggerWithRollover.
+	def check_rollover(self):
+		pass
+
+	# Blocks until every message logged so far is written (or the writer thread is gone)
+	def flush(self):
+		with self.queue.all_tasks_done:
+			while (self.queue.unfinished_tasks > 0) and self.writer.is_alive():
+				self.queue.all_tasks_done.wait(1)
+
+	# Writes the queued messages and stops the writer thread
+	def close(self):
+		if self.closed == True:
+			return
+
+		self.closed = True
+		if self.__put(None) == True:
+			self.writer.join()
+
+	# Queues item unless the writer thread is gone (nothing would take it off a full queue then)
+	# Returns: True if queued
+	def __put(self, item):
+		while self.writer.is_alive():
+			try:
+				self.queue.put(item, timeout=1)
+				return True
+			except queue.Full:
+				continue
+
+		return False
+
+	def __format_time(self, logged):
+		second = int(logged)
+		if second != self.time_second:
+			self.time_second = second
+			self.time_str = dt.fromtimestamp(second, self.timezone).strftime('%m/%d/%y %H:%M:%S')
+
+		return self.time_str
+
+	# Returns: Log message of a queued record (or a line saying it could not be formatted)
+	def __format_record(self, record):
+		logged, severity, msg = record
+		try:
+			return format_log_msg(self.__format_time(logged), severity, msg)
+		except Exception as error:
+			try:
+				msg_str = repr(msg)
+			except Exception:
+				msg_str = f'<{type(msg).__name__}>'
+			return f'[{self.__format_time(logged)}] - [ERROR] : Unable to format log message {msg_str} ({type(error).__name__}: {error})\n'
+
+	def __open(self):
+		self.file = open(self.log_file, 'a')
+		self.file_size = os.path.getsize(self.log_file)
+
+	def __write(self, log_msgs):
+		if self.file == None:
+			self.__open()
+
+		for log_msg in log_msgs:
+			self.file.write(log_msg)
+			self.file_size += len(log_msg.encode('utf-8'))
+			if (self.max_bytes > 0) and (self.file_size >= self.max_bytes):
+				self.file.close()
+				self.file = None
+				rotate_log_file(self.log_file, self.backup_count)
+				self.__open()
+
+		self.file.flush()
+
+	def __writer(self):
+		stopping = False
+		while stopping == False:
+			records = [self.queue.get()]
+			try:
+				while len(records) < self.batch_size:
+					records.append(self.queue.get_nowait())
+			except queue.Empty:
+				pass
+
+			log_msgs = []
+			try:
+				for record in records:
+					if record == None:
+						stopping = True
+						continue
+					log_msgs.append(self.__format_record(record))
+
+				if log_msgs:
+					self.__write(log_msgs)
+			except Exception as error:
+				# Nowhere else to log to
+				print(f'Unable to write to log file {self.log_file}: {error}', file=sys.stderr)
+				sys.stderr.write(''.join(log_msgs))
+				if self.file != None:
+					try:
+						self.file.close()
+					except Exception:
+						pass
+				self.file = None
+			finally:
+				for record in records:
+					self.queue.task_done()
+
+		if self.file != None:
+			self.file.close()
+			self.file = None
+
+### FUNCTIONS ###
+# Formats a log message (string or list of strings; list lines after the first are
+# lined up under the first line's message).
+# Returns: Log message string (newline terminated)
+def format_log_msg(time_str, severity, msg):
+	if isinstance(msg, list):
+		log_msg = f'[{time_str}] - [{severity.name}] : {msg[0]}\n'
+		padding = len(log_msg) - len(msg[0]) - 1
+		lines = [log_msg]
+		for i in range(1, len(msg)):
+			lines.append(msg[i].rjust(padding + len(msg[i]), ' ') + '\n')
+
+		return ''.join(lines)
+
+	return f'[{time_str}] - [{severity.name}] : {msg}\n'
 
-			if current_log_file_size >= self.max_bytes:
-				self.__do_rollover()
+# Renames log_file to log_file.1 (log_file.1 to log_file.2 and so on, dropping the
+# oldest past backup_count) and starts an empty log_file. With a backup_count of 0
+# log_file is just emptied.
+def rotate_log_file(log_file, backup_count):
+	if backup_count > 0:
+		for i in range(backup_count, 0, -1):
+			file = f'{log_file}.{i}'
+			if os.path.exists(file):
+				if i == backup_count:
+					os.remove(file)
+				else:
+					os.rename(file, f'{log_file}.{i + 1}')
 
+		os.rename(log_file, f'{log_file}.1')
+		with open(log_file, 'w'):
+			pass
+	else:
+		with open(log_file, 'w'):
+			pass
 
+### FUNCTIONS ###
@@ -0,0 +1,110 @@
+from contextlib import contextmanager
+import json
+import os
+import threading
+import time
+
+#### DICTIONARIES/STATICS ####
+# Outcomes of a span (a span that raises is an error)
+OUTCOME_OK = 'ok'
+OUTCOME_FAILED = 'failed'
+OUTCOME_ERROR = 'error'
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: TraceSpan
+# Description: Timing of one stage (probe, crop, encode, plex_copy...) of one title.
+# start/end are epoch seconds. bytes and outcome can be set inside the with block;
+# any other details go in attrs.
+class TraceSpan:
+	__slots__ = ['stage', 'title', 'start', 'end', 'bytes', 'outcome', 'attrs']
+	def __init__(self, stage, title, start=None, attrs=None):
+		self.stage = stage
+		self.title = title
+		self.start = start if start != None else time.time()
+		self.end = None
+		self.bytes = None
+		self.outcome = OUTCOME_OK
+		self.attrs = attrs if attrs != None else {}
+
+	# Returns: Dict written as one line of the trace file
+	def to_dict(self):
+		span = {'stage' : self.stage, 'title' : self.title, 'start' : round(self.start, 6), 'end' : round(self.end, 6),
+			'seconds' : round(self.end - self.start, 6), 'outcome' : self.outcome, 'pid' : os.getpid(), 'thread' : threading.current_thread().name}
+		if self.bytes != None:
+			span['bytes'] = self.bytes
+		if self.attrs:
+			span['attrs'] = self.attrs
+
+		return span
+
+# Class: Tracer
+# Description: Appends spans to a JSONL trace file (one JSON object per line). Does nothing
+# until open is called, so modules can trace unconditionally. Thread safe.
+class Tracer:
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.path = None
+		self.file = None
+
+	# Starts writing spans to path (appends if it exists)
+	def open(self, path):
+		with self.lock:
+			if self.file != None:
+				self.file.close()
+			os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+			self.file = open(path, 'a', encoding='utf-8')
+			self.path = path
+
+	def close(self):
+		with self.lock:
+			if self.file != None:
+				self.file.close()
+			self.file = None
+			self.path = None
+
+	def enabled(self):
+		return self.file != None
+
+	# Writes a finished span
+	def write(self, span):
+		if self.file == None:
+			return
+
+		line = json.dumps(span.to_dict()) + '\n'
+		with self.lock:
+			if self.file != None:
+				self.file.write(line)
+				self.file.flush()
+
+	# Times the with block as a span (yielded so bytes/outcome/attrs can be set). An exception
+	# marks the span as an error (and is raised again).
+	@contextmanager
+	def span(self, stage, title, **attrs):
+		span = TraceSpan(stage, title, attrs=attrs)
+		try:
+			yield span
+		except BaseException as error:
+			span.outcome = OUTCOME_ERROR
+			span.attrs['error'] = type(error).__name__
+			raise
+		finally:
+			span.end = time.time()
+			self.write(span)
+
+	# Writes a span that was timed elsewhere (e.g. an encode, from the job's start/stop times)
+	def record(self, stage, title, start, end, outcome=OUTCOME_OK, bytes=None, **attrs):
+		span = TraceSpan(stage, title, start, attrs)
+		span.end = end
+		span.outcome = outcome
+		span.bytes = bytes
+		self.write(span)
+
+#### CLASSES ####
+
+#### GLOBALS ####
+# Tracer used by all the modules (disabled until opened)
+tracer = Tracer()
+
+#### GLOBALS ####
@@ -0,0 +1,297 @@
+from concurrent.futures import ThreadPoolExecutor
+from enum import IntEnum
+import hashlib
+import re
+from subprocess import Popen
+import subprocess
+import threading
+
+from ffmpeg_tools_utilities import convert_seconds_to_timestamp
+from metrics import metrics
+from tracing import OUTCOME_FAILED, tracer
+
+#### DICTIONARIES/STATICS ####
+# Matches the crop value at the end of a cropdetect line (crop=W:H:X:Y)
+CROPDETECT_REGEX = re.compile(r'crop=(-?\d+):(-?\d+):(-?\d+):(-?\d+)')
+# Matches the summary lines of idet (Single and Multi frame detection)
+IDET_REGEX = re.compile(r'frame detection: TFF:\s*(\d+)\s+BFF:\s*(\d+)\s+Progressive:\s*(\d+)')
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+class VideoScan(IntEnum):
+	INTERLACED_TFF = 0
+	INTERLACED_BFF = 1
+	PROGRESSIVE = 2
+
+class AnalysisMode:
+	# cropdetect and idet run together in one decode pass over the analysis window
+	COMBINED = 'combined'
+	# cropdetect runs over the analysis window, idet over the first window_frames frames
+	SEPARATE = 'separate'
+
+class CropMethod:
+	# Last cropdetect result of the analysis window
+	WINDOW = 'window'
+	# Most common cropdetect result over short windows spread across the whole video
+	SAMPLED = 'sampled'
+
+class ScanMethod:
+	# idet over the analysis window
+	WINDOW = 'window'
+	# idet over short windows at several offsets, stopping once confident enough
+	SAMPLED = 'sampled'
+
+# Class: AnalysisSettings
+# Description: Settings for the crop/scan analysis that is done before encoding.
+# window_position is where the analysis window starts (fraction of the duration),
+# window_seconds/window_frames bound how much is decoded.
+# crop_samples/crop_sample_seconds/crop_workers control the SAMPLED crop method;
+# every sample is killed after crop_sample_timeout seconds to bound decode time.
+# scan_samples/scan_sample_frames control the SAMPLED scan method which stops once
+# at least scan_min_frames were checked and the winning share reaches scan_confidence.
+class AnalysisSettings:
+	__slots__ = ['mode', 'window_position', 'window_seconds', 'window_frames', 'crop_method', 'crop_samples', 'crop_sample_seconds', 'crop_workers', 'crop_sample_timeout',
+		'scan_method', 'scan_samples', 'scan_sample_frames', 'scan_min_frames', 'scan_confidence']
+	def __init__(self):
+		self.mode = AnalysisMode.SEPARATE
+		self.window_position = 0.5
+		self.window_seconds = 120
+		self.window_frames = 10000
+		self.crop_method = CropMethod.WINDOW
+		self.crop_samples = 8
+		self.crop_sample_seconds = 10
+		self.crop_workers = 4
+		self.crop_sample_timeout = 120
+		self.scan_method = ScanMethod.WINDOW
+		self.scan_samples = 6
+		self.scan_sample_frames = 500
+		self.scan_min_frames = 1000
+		self.scan_confidence = 0.95
+
+#### CLASSES ####
+
+### FUNCTIONS ####
+# Builds AnalysisSettings from the [Analysis] section of a config file (ConfigParser).
+# Missing section/values use the defaults.
+# Returns: AnalysisSettings
+def load_analysis_settings(config):
+	settings = AnalysisSettings()
+	if not config.has_section('Analysis'):
+		return settings
+
+	section = config['Analysis']
+	mode = section.get('mode', settings.mode).strip().lower()
+	if mode in (AnalysisMode.COMBINED, AnalysisMode.SEPARATE):
+		settings.mode = mode
+	settings.window_position = min(max(section.getfloat('window_position', settings.window_position), 0.0), 0.95)
+	settings.window_seconds = section.getint('window_seconds', settings.window_seconds)
+	settings.window_frames = section.getint('window_frames', settings.window_frames)
+	crop_method = section.get('crop_method', settings.crop_method).strip().lower()
+	if crop_method in (CropMethod.WINDOW, CropMethod.SAMPLED):
+		settings.crop_method = crop_method
+	settings.crop_samples = max(section.getint('crop_samples', settings.crop_samples), 1)
+	settings.crop_sample_seconds = max(section.getint('crop_sample_seconds', settings.crop_sample_seconds), 1)
+	settings.crop_workers = max(section.getint('crop_workers', settings.crop_workers), 1)
+	settings.crop_sample_timeout = max(section.getint('crop_sample_timeout', settings.crop_sample_timeout), 1)
+	scan_method = section.get('scan_method', settings.scan_method).strip().lower()
+	if scan_method in (ScanMethod.WINDOW, ScanMethod.SAMPLED):
+		settings.scan_method = scan_method
+	settings.scan_samples = max(section.getint('scan_samples', settings.scan_samples), 1)
+	settings.scan_sample_frames = max(section.getint('scan_sample_frames', settings.scan_sample_frames), 1)
+	settings.scan_min_frames = max(section.getint('scan_min_frames', settings.scan_min_frames), 0)
+	settings.scan_confidence = min(max(section.getfloat('scan_confidence', settings.scan_confidence), 0.0), 1.0)
+
+	return settings
+
+# Returns: Short hash of the settings that change the crop/scan results (crop_workers only changes
+# how fast they are found). Tells apart results analyzed with different settings (see AnalysisCache).
+def get_analysis_settings_key(settings=None):
+	settings = AnalysisSettings() if settings == None else settings
+	values = [(name, getattr(settings, name)) for name in AnalysisSettings.__slots__ if name != 'crop_workers']
+	return hashlib.sha1(repr(values).encode('utf-8')).hexdigest()[:16]
+
+# Runs a single ffmpeg decode pass with the given video filters and parses
+# the cropdetect/idet results from its stderr as it is written.
+# start_seconds/seconds/frames of None mean no limit.
+# Returns: Tuple(last crop found (None if none found), list of idet frame totals [TFF, BFF, PROG], error msg (None if ffmpeg succeeded))
+def __run_analysis_pass(video_full_path, video_filters, start_seconds=None, seconds=None, frames=None):
+	args = ['ffmpeg', '-hide_banner', '-nostats']
+	if start_seconds:
+		args += ['-ss', convert_seconds_to_timestamp(start_seconds)]
+	args += ['-i', video_full_path, '-map', '0:v:0']
+	if seconds:
+		args += ['-t', str(seconds)]
+	if frames:
+		args += ['-frames:v', str(frames)]
+	args += ['-vf', ','.join(video_filters), '-an', '-sn', '-dn', '-f', 'null', '-']
+
+	crop = None
+	frame_totals = [0, 0, 0]
+	# Everything that is not a cropdetect/idet result, for the error msg
+	other_lines = []
+	with Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, errors='replace') as proc:
+		for line in proc.stderr:
+			if 'crop=' in line:
+				match = CROPDETECT_REGEX.search(line)
+				if match != None:
+					crop = f'crop={match.group(1)}:{match.group(2)}:{match.group(3)}:{match.group(4)}'
+			elif 'frame detection' in line:
+				match = IDET_REGEX.search(line)
+				if match != None:
+					# Should always be the order of: TFF, BFF, PROG
+					frame_totals[VideoScan.INTERLACED_TFF] += int(match.group(1))
+					frame_totals[VideoScan.INTERLACED_BFF] += int(match.group(2))
+					frame_totals[VideoScan.PROGRESSIVE] += int(match.group(3))
+			else:
+				other_lines.append(line.rstrip('\n'))
+
+	if proc.returncode != 0:
+		error_msg = other_lines
+		error_msg.insert(0, f'Failed to analyze ({", ".join(video_filters)}) {video_full_path}. ffmpeg returned {proc.returncode}.')
+		return (None, frame_totals, error_msg)
+
+	return (crop, frame_totals, None)
+
+# Picks the scan type with the most frames detected. Confidence is the share of
+# frames that agree with it. If idet did not classify any frames, the video is
+# treated as progressive with a confidence of 0.
+# Returns: Tuple(VideoScan, confidence (0.0 - 1.0))
+def __scan_from_frame_totals(frame_totals):
+	total = sum(frame_totals)
+	if total == 0:
+		return (VideoScan.PROGRESSIVE, 0.0)
+
+	most_frames = max(frame_totals)
+	return (VideoScan(frame_totals.index(most_frames)), most_frames / total)
+
+# Runs cropdetect over a short window of the video file (input seek, so only the window is decoded)
+# The ffmpeg process is killed if it runs longer than timeout seconds.
+# Returns: List of every crop rectangle (W, H, X, Y) found in the window
+def __run_crop_sample(video_full_path, start_seconds, seconds, timeout):
+	args = ['ffmpeg', '-hide_banner', '-nostats', '-ss', convert_seconds_to_timestamp(start_seconds), '-i', video_full_path,
+		'-map', '0:v:0', '-t', str(seconds), '-vf', 'cropdetect', '-an', '-sn', '-dn', '-f', 'null', '-']
+
+	rectangles = []
+	with Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, universal_newlines=True, errors='replace') as proc:
+		timer = threading.Timer(timeout, proc.kill)
+		timer.start()
+		try:
+			for line in proc.stderr:
+				if 'crop=' in line:
+					match = CROPDETECT_REGEX.search(line)
+					if match != None:
+						rectangles.append(tuple(int(value) for value in match.groups()))
+		finally:
+			timer.cancel()
+
+	return rectangles
+
+# Picks a crop from every crop rectangle found. Rectangles that are not valid
+# (black frames can give negative sizes) are ignored. The most common rectangle
+# wins; ties go to the rectangle with the largest area (crops the least).
+# Returns: crop string (crop=W:H:X:Y) or None if no valid rectangles
+def select_crop(rectangles):
+	# Only needed by the sampled crop method
+	import numpy as np
+
+	crops = np.array(rectangles, dtype=np.int64).reshape(-1, 4)
+	crops = crops[(crops[:, 0] > 0) & (crops[:, 1] > 0) & (crops[:, 2] >= 0) & (crops[:, 3] >= 0)]
+	if crops.shape[0] == 0:
+		return None
+
+	unique_crops, counts = np.unique(crops, axis=0, return_counts=True)
+	areas = unique_crops[:, 0] * unique_crops[:, 1]
+	width, height, x, y = unique_crops[np.lexsort((areas, counts))[-1]]
+
+	return f'crop={width}:{height}:{x}:{y}'
+
+# Detects crop by running cropdetect over crop_samples short windows spread evenly
+# across the video, crop_workers at a time.
+# Returns: crop string (crop=W:H:X:Y) or None if nothing was detected
+def detect_crop_sampled(video_full_path, duration_seconds, settings=None):
+	settings = AnalysisSettings() if settings == None else settings
+	last_start = max(duration_seconds - settings.crop_sample_seconds, 0)
+	starts = sorted(set(int(last_start * (i + 1) / (settings.crop_samples + 1)) for i in range(0, settings.crop_samples)))
+
+	with ThreadPoolExecutor(max_workers=settings.crop_workers) as executor:
+		samples = executor.map(lambda start: __run_crop_sample(video_full_path, start, settings.crop_sample_seconds, settings.crop_sample_timeout), starts)
+		rectangles = [rectangle for sample in samples for rectangle in sample]
+
+	return select_crop(rectangles)
+
+# Detects the scan type by running idet over scan_sample_frames frames at up to
+# scan_samples offsets (10% - 90% of the duration). Stops as soon as enough frames
+# were checked and the winning scan type reaches the confidence threshold.
+# Returns: Tuple(Tuple(VideoScan, confidence (0.0 - 1.0)) (None if error), msg)
+def detect_scan_sampled(video_full_path, duration_seconds, settings=None):
+	settings = AnalysisSettings() if settings == None else settings
+	if settings.scan_samples > 1:
+		positions = [0.1 + (0.8 * i / (settings.scan_samples - 1)) for i in range(0, settings.scan_samples)]
+	else:
+		positions = [0.5]
+
+	frame_totals = [0, 0, 0]
+	for position in positions:
+		_, sample_totals, error_msg = __run_analysis_pass(video_full_path, ['idet'], int(duration_seconds * position), frames=settings.scan_sample_frames)
+		if error_msg != None:
+			return (None, error_msg)
+		frame_totals = [total + sample for total, sample in zip(frame_totals, sample_totals)]
+
+		scan, confidence = __scan_from_frame_totals(frame_totals)
+		if (sum(frame_totals) >= settings.scan_min_frames) and (confidence >= settings.scan_confidence):
+			break
+
+	return (__scan_from_frame_totals(frame_totals), None)
+
+# Detects the crop and scan type of a video file.
+# In COMBINED mode, cropdetect and idet share a single decode pass over the analysis window.
+# Filters whose SAMPLED method is used are left out of that pass.
+# Returns: Tuple(Tuple(crop string (crop=W:H:X:Y, empty if not found), VideoScan, scan confidence (0.0 - 1.0)) (None if error), msg)
+def detect_crop_and_scan(video_full_path, duration_seconds, settings=None):
+	settings = AnalysisSettings() if settings == None else settings
+	start_seconds = int(duration_seconds * settings.window_position)
+	crop_filters = ['cropdetect'] if settings.crop_method == CropMethod.WINDOW else []
+	scan_filters = ['idet'] if settings.scan_method == ScanMethod.WINDOW else []
+
+	crop = None
+	frame_totals = [0, 0, 0]
+	if settings.mode == AnalysisMode.SEPARATE:
+		if crop_filters:
+			with metrics.time('automated_ffmpeg_analysis_stage_seconds', {'stage' : 'crop'}), tracer.span('crop', video_full_path) as span:
+				crop, _, error_msg = __run_analysis_pass(video_full_path, crop_filters, start_seconds, settings.window_seconds)
+				if error_msg != None:
+					span.outcome = OUTCOME_FAILED
+					return (None, error_msg)
+		if scan_filters:
+			with metrics.time('automated_ffmpeg_analysis_stage_seconds', {'stage' : 'scan'}), tracer.span('scan', video_full_path) as span:
+				_, frame_totals, error_msg = __run_analysis_pass(video_full_path, scan_filters, frames=settings.window_frames)
+				if error_msg != None:
+					span.outcome = OUTCOME_FAILED
+					return (None, error_msg)
+	elif crop_filters or scan_filters:
+		# One decode pass for both
+		stage = 'crop_scan' if (crop_filters and scan_filters) else ('crop' if crop_filters else 'scan')
+		with metrics.time('automated_ffmpeg_analysis_stage_seconds', {'stage' : stage}), tracer.span(stage, video_full_path) as span:
+			crop, frame_totals, error_msg = __run_analysis_pass(video_full_path, crop_filters + scan_filters, start_seconds, settings.window_seconds, settings.window_frames)
+			if error_msg != None:
+				span.outcome = OUTCOME_FAILED
+				return (None, error_msg)
+
+	if settings.crop_method == CropMethod.SAMPLED:
+		with metrics.time('automated_ffmpeg_analysis_stage_seconds', {'stage' : 'crop'}), tracer.span('crop', video_full_path):
+			crop = detect_crop_sampled(video_full_path, duration_seconds, settings)
+
+	if settings.scan_method == ScanMethod.SAMPLED:
+		with metrics.time('automated_ffmpeg_analysis_stage_seconds', {'stage' : 'scan'}), tracer.span('scan', video_full_path) as span:
+			scan_confidence, error_msg = detect_scan_sampled(video_full_path, duration_seconds, settings)
+			if scan_confidence == None:
+				span.outcome = OUTCOME_FAILED
+				return (None, error_msg)
+			scan, confidence = scan_confidence
+	else:
+		scan, confidence = __scan_from_frame_totals(frame_totals)
+
+	return (('' if crop == None else crop, scan, confidence), None)
+
+### FUNCTIONS ###
@@ -0,0 +1,237 @@
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+ROOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(os.path.join(ROOT_DIR, 'Common'))
+from encode_data import *
+from encode_farm import *
+from encode_jobs import *
+
+#### DICTIONARIES/STATICS ####
+WORKER_COUNT = 3
+JOB_COUNT = 6
+TIMEOUT_SECONDS = 60
+
+# Stands in for ffmpeg on the workers: writes the output file (last argument), along with the
+# arguments it got (one per line) and reports progress like ffmpeg -progress pipe:1 does.
+FAKE_FFMPEG = '''#!{python}
+import sys
+import time
+time.sleep(0.5)
+with open(sys.argv[-1], 'w') as f:
+	f.write('\\n'.join(sys.argv[1:]))
+print('out_time_us=1000000')
+print('progress=end', flush=True)
+'''
+
+#### DICTIONARIES/STATICS ####
+
+### FUNCTIONS ####
+# Returns: EncodeJob of a new source file in temp_dir (audio language as given)
+def make_job(temp_dir, i, language='eng'):
+	source = os.path.join(temp_dir, f'movie_{i}.mkv')
+	with open(source, 'w') as f:
+		f.write('source')
+
+	encode_data = EncodeData()
+	encode_data.source_file_full_path = source
+	encode_data.duration_seconds = 1.0
+	encode_data.video_data.encoder = VideoEncoder.LIBX264
+	encode_data.video_data.scan = VideoScan.PROGRESSIVE
+	audio = AudioData()
+	audio.index = 0
+	audio.language = language
+	audio.encode_process = AudioEncodeProcess.AAC_STEREO
+	encode_data.audio_data = [audio]
+
+	return EncodeJob(source, os.path.join(temp_dir, f'movie_{i} (encoded).mkv'), None, encode_data)
+
+### FUNCTIONS ###
+
+#### CLASSES ####
+# Class: OneBoxFarmTest
+# Description: Runs a coordinator and WORKER_COUNT farm_worker.py processes on this host (unix socket,
+# default working directories) with a stand-in ffmpeg, and checks the jobs get spread over the workers.
+class OneBoxFarmTest(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		bin_dir = os.path.join(self.temp_dir, 'bin')
+		os.makedirs(bin_dir)
+		ffmpeg_path = os.path.join(bin_dir, 'ffmpeg')
+		with open(ffmpeg_path, 'w') as f:
+			f.write(FAKE_FFMPEG.format(python=sys.executable))
+		os.chmod(ffmpeg_path, 0o755)
+		# The modules sit next to farm_worker.py once installed
+		self.env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get('PATH', ''), PYTHONPATH=os.path.join(ROOT_DIR, 'Common'))
+
+		self.address = f'unix:{os.path.join(self.temp_dir, "farm.sock")}'
+		self.completed = []
+		self.all_completed = threading.Event()
+		self.coordinator = EncodeFarmCoordinator(self.address, self.__on_complete, JOB_COUNT + 1, lease_seconds=30)
+
+		self.worker_names = [f'one-box-test-{os.getpid()}-{i}' for i in range(0, WORKER_COUNT)]
+		self.workers = [subprocess.Popen([sys.executable, os.path.join(ROOT_DIR, 'farm_worker.py'), '-c', self.address, '-n', name, '-s', '1'],
+			env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) for name in self.worker_names]
+
+	def tearDown(self):
+		for worker in self.workers:
+			worker.terminate()
+		for worker in self.workers:
+			worker.wait()
+
+		self.coordinator.kill_all()
+		self.coordinator.server.shutdown()
+		self.coordinator.server.server_close()
+		shutil.rmtree(self.temp_dir, ignore_errors=True)
+		for name in self.worker_names:
+			shutil.rmtree(f'/tmp/automated_ffmpeg/farm_working_{name}', ignore_errors=True)
+			try:
+				os.remove(f'/tmp/automated_ffmpeg/farm_worker_{name}.log')
+			except OSError:
+				pass
+
+	def __on_complete(self, job):
+		self.completed.append(job)
+		if len(self.completed) == self.expected_count:
+			self.all_completed.set()
+
+	def test_jobs_are_spread_over_the_workers(self):
+		self.expected_count = JOB_COUNT
+		jobs = [self.coordinator.submit(make_job(self.temp_dir, i)) for i in range(0, JOB_COUNT)]
+
+		self.assertTrue(self.all_completed.wait(TIMEOUT_SECONDS), 'Farm jobs did not complete in time.')
+		for job in jobs:
+			self.assertEqual(job.returncode, 0, job.error_msg)
+			with open(job.encoded_file_full_path, 'r') as f:
+				args = f.read().split('\n')
+			# Built by the worker from the encode data; the quoted options arrive as one argument each
+			self.assertEqual(args[args.index('-i') + 1], job.source_file_full_path)
+			self.assertIn('title=Stereo (eng)', args)
+
+		self.assertGreater(len({job.worker for job in jobs}), 1, 'Every job went to the same worker.')
+		# The attempt files were renamed to the encoded files
+		self.assertEqual([name for name in os.listdir(self.temp_dir) if name.startswith('.')], [])
+		for name in self.worker_names:
+			self.assertTrue(os.path.isdir(f'/tmp/automated_ffmpeg/farm_working_{name}'))
+
+	def test_worker_rejects_unsafe_encode_data(self):
+		self.expected_count = 1
+		job = self.coordinator.submit(make_job(self.temp_dir, 0, 'eng" -y "/tmp/injected.mkv'))
+
+		self.assertTrue(self.all_completed.wait(TIMEOUT_SECONDS), 'Farm job did not complete in time.')
+		self.assertEqual(job.returncode, -1)
+		self.assertFalse(os.path.exists(job.encoded_file_full_path))
+
+# Class: CoordinatorListenTest
+# Description: Where the coordinator is willing to listen
+class CoordinatorListenTest(unittest.TestCase):
+	def test_refuses_non_loopback_without_token(self):
+		with self.assertRaises(ValueError):
+			EncodeFarmCoordinator('0.0.0.0:0')
+
+	def test_listens_on_loopback_without_token(self):
+		coordinator = EncodeFarmCoordinator('127.0.0.1:0')
+		coordinator.server.shutdown()
+		coordinator.server.server_close()
+
+	def test_unix_socket_is_owner_and_group_only(self):
+		temp_dir = tempfile.mkdtemp()
+		try:
+			path = os.path.join(temp_dir, 'farm.sock')
+			coordinator = EncodeFarmCoordinator(f'unix:{path}')
+			self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o770)
+			coordinator.server.shutdown()
+			coordinator.server.server_close()
+		finally:
+			shutil.rmtree(temp_dir, ignore_errors=True)
+
+	def test_rejects_wrong_token(self):
+		temp_dir = tempfile.mkdtemp()
+		try:
+			address = f'unix:{os.path.join(temp_dir, "farm.sock")}'
+			coordinator = EncodeFarmCoordinator(address, token='secret')
+			with self.assertRaises(ValueError):
+				FarmConnection(address, 'test', 'wrong').call({'type' : 'request_job'})
+			self.assertEqual(FarmConnection(address, 'test', 'secret').call({'type' : 'request_job'}).get('type'), 'no_job')
+			coordinator.server.shutdown()
+			coordinator.server.server_close()
+		finally:
+			shutil.rmtree(temp_dir, ignore_errors=True)
+
+# Class: LeaseTest
+# Description: Messages of leases that were handed out again, and invalid messages, from workers
+# talking to the coordinator directly
+class LeaseTest(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.address = f'unix:{os.path.join(self.temp_dir, "farm.sock")}'
+		self.completed = []
+		self.requeued = threading.Event()
+		self.coordinator = EncodeFarmCoordinator(self.address, self.completed.append, 1, lease_seconds=5, on_requeue=lambda job: self.requeued.set())
+		self.first = FarmConnection(self.address, 'first')
+		self.second = FarmConnection(self.address, 'second')
+
+	def tearDown(self):
+		self.first.close()
+		self.second.close()
+		self.coordinator.server.shutdown()
+		self.coordinator.server.server_close()
+		shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+	def test_requeued_lease_fences_the_first_attempt(self):
+		self.coordinator.submit(make_job(self.temp_dir, 0))
+		first_job = self.first.call({'type' : 'request_job'})
+		self.assertEqual(first_job.get('type'), 'job')
+
+		# Let the lease of the first worker expire
+		with self.coordinator.condition:
+			self.coordinator.leases[first_job['job_id']][2] = 0
+		self.assertTrue(self.requeued.wait(TIMEOUT_SECONDS), 'Expired lease was not requeued.')
+
+		second_job = self.second.call({'type' : 'request_job'})
+		self.assertEqual(second_job['job_id'], first_job['job_id'])
+		self.assertNotEqual(second_job['attempt'], first_job['attempt'])
+
+		first_attempt = {'job_id' : first_job['job_id'], 'attempt' : first_job['attempt']}
+		reply = self.first.call({'type' : 'heartbeat', 'jobs' : [dict(first_attempt, progress={})]})
+		self.assertEqual(reply['cancel'], [first_attempt])
+		reply = self.first.call(dict(first_attempt, type='result', returncode=0, error_msg=[]))
+		self.assertEqual(reply, {'type' : 'ok', 'accepted' : False})
+
+		# Even from the second worker, only its own attempt counts
+		reply = self.second.call(dict(first_attempt, type='result', returncode=0, error_msg=[]))
+		self.assertEqual(reply['accepted'], False)
+		reply = self.second.call({'type' : 'result', 'job_id' : second_job['job_id'], 'attempt' : second_job['attempt'], 'returncode' : 1, 'error_msg' : ['failed']})
+		self.assertEqual(reply['accepted'], True)
+
+		for i in range(0, TIMEOUT_SECONDS * 10):
+			if self.completed:
+				break
+			time.sleep(0.1)
+		self.assertEqual([(job.returncode, job.error_msg) for job in self.completed], [(1, ['failed'])])
+
+	def test_invalid_messages_get_an_error(self):
+		for msg in ({'type' : 'heartbeat', 'jobs' : {'1' : {}}},
+				{'type' : 'heartbeat', 'jobs' : [{'job_id' : 'x', 'attempt' : 1}]},
+				{'type' : 'result', 'job_id' : 'x', 'attempt' : 1, 'returncode' : 0},
+				{'type' : 'result', 'job_id' : 1, 'returncode' : 0},
+				{'type' : 'result', 'job_id' : 1, 'attempt' : 1, 'returncode' : None}):
+			self.assertEqual(self.first.call(msg).get('type'), 'error', msg)
+
+		# The connection is still usable
+		self.assertEqual(self.first.call({'type' : 'heartbeat', 'jobs' : []}), {'type' : 'ok', 'cancel' : []})
+
+#### CLASSES ####
+
+### MAIN ###
+if __name__ == '__main__':
+	unittest.main()
+
+### MAIN ###
@@ -0,0 +1,156 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import os
+import socketserver
+import sys
+import threading
+import unittest
+from urllib.parse import urlparse, parse_qs
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'plex_interactor'))
+try:
+	from plex_interactor import *
+except ImportError:
+	# plexapi/requests not installed (pip3 install -r Tests/requirements.txt)
+	PlexInteractor = None
+
+#### DICTIONARIES/STATICS ####
+SECTION_KEY = '1'
+SECTION_TITLE = 'Movies'
+
+SERVER_XML = '<MediaContainer friendlyName="stand-in" machineIdentifier="stand-in" version="1.20.0.0" />'
+LIBRARY_XML = '<MediaContainer title1="Plex Library" />'
+SECTIONS_XML = ('<MediaContainer size="1"><Directory key="{key}" type="movie" title="{title}" agent="com.plexapp.agents.imdb" '
+	'scanner="Plex Movie Scanner" language="en" refreshing="{refreshing}"><Location id="1" path="/movies" /></Directory></MediaContainer>')
+
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: PlexStandInHandler
+# Description: Answers the few plex API calls PlexInteractor makes (/, /library, /library/sections and the
+# refresh of a section) over keep-alive connections. Every connection and refresh call is recorded on the server.
+# The server's drop_refreshes first refresh calls get the connection closed without an answer, and the
+# section shows as refreshing for the refreshing_polls /library/sections calls after a refresh.
+class PlexStandInHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def setup(self):
+		super().setup()
+		with self.server.lock:
+			self.server.connections += 1
+
+	def log_message(self, format, *args):
+		pass
+
+	def do_GET(self):
+		url = urlparse(self.path)
+		if url.path == f'/library/sections/{SECTION_KEY}/refresh':
+			with self.server.lock:
+				drop = self.server.drop_refreshes > 0
+				if drop == True:
+					self.server.drop_refreshes -= 1
+				else:
+					self.server.refreshes.append(parse_qs(url.query).get('path', [None])[0])
+					self.server.refreshing = self.server.refreshing_polls
+			if drop == True:
+				self.close_connection = True
+				return
+			self.__reply('')
+		elif url.path == '/':
+			self.__reply(SERVER_XML)
+		elif url.path == '/library':
+			self.__reply(LIBRARY_XML)
+		elif url.path == '/library/sections':
+			with self.server.lock:
+				refreshing = self.server.refreshing > 0
+				self.server.refreshing = max(self.server.refreshing - 1, 0)
+			self.__reply(SECTIONS_XML.format(key=SECTION_KEY, title=SECTION_TITLE, refreshing='1' if refreshing == True else '0'))
+		else:
+			self.send_error(404)
+
+	def __reply(self, body):
+		data = body.encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'text/xml')
+		self.send_header('Content-Length', str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+class PlexStandInServer(socketserver.ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+	def __init__(self):
+		super().__init__(('127.0.0.1', 0), PlexStandInHandler)
+		self.lock = threading.Lock()
+		self.connections = 0
+		self.refreshes = []
+		self.drop_refreshes = 0
+		self.refreshing_polls = 0
+		self.refreshing = 0
+
+# Class: PlexInteractorTest
+# Description: PlexInteractor/PlexRefreshQueue against the plex stand-in
+@unittest.skipIf(PlexInteractor == None, 'plexapi/requests are not installed (pip3 install -r Tests/requirements.txt)')
+class PlexInteractorTest(unittest.TestCase):
+	def setUp(self):
+		self.server = PlexStandInServer()
+		threading.Thread(target=self.server.serve_forever, daemon=True).start()
+		self.interactor = PlexInteractor(f'http://127.0.0.1:{self.server.server_address[1]}', 'token', timeout=5)
+
+	def tearDown(self):
+		self.server.shutdown()
+		self.server.server_close()
+
+	def test_connection_is_reused(self):
+		for i in range(0, 3):
+			self.interactor.update(SECTION_TITLE)
+		self.assertEqual(self.interactor.is_refreshing(SECTION_TITLE), False)
+
+		self.assertEqual(self.server.refreshes, [None, None, None])
+		self.assertEqual(self.server.connections, 1)
+
+	def test_requests_within_window_are_one_refresh(self):
+		refreshed = threading.Event()
+		results = []
+		def on_refresh(section, movies, paths, start, end, scan_seconds, error):
+			results.append((section, movies, paths, error))
+			refreshed.set()
+
+		refresh_queue = PlexRefreshQueue(self.interactor, window_seconds=1, on_refresh=on_refresh)
+		for i in range(0, 5):
+			refresh_queue.request(SECTION_TITLE, movie=f'/movies/movie_{i}.mkv')
+
+		self.assertTrue(refreshed.wait(10), 'Section was not refreshed.')
+		refresh_queue.close()
+		self.assertEqual(results, [(SECTION_TITLE, [f'/movies/movie_{i}.mkv' for i in range(0, 5)], [], None)])
+		self.assertEqual(self.server.refreshes, [None])
+
+	def test_partial_scan_refreshes_each_path(self):
+		paths = ['/movies/A Movie (2001)', '/movies/B&B: 100%']
+		self.interactor.update(SECTION_TITLE, paths)
+
+		self.assertEqual(self.server.refreshes, paths)
+
+	def test_scan_time_only_when_seen_scanning(self):
+		# Done before the first poll: unknown
+		self.assertEqual(self.interactor.update(SECTION_TITLE, wait_seconds=10, poll_seconds=0.1), None)
+
+		self.server.refreshing_polls = 3
+		scan_seconds = self.interactor.update(SECTION_TITLE, wait_seconds=10, poll_seconds=0.1)
+		self.assertNotEqual(scan_seconds, None)
+		self.assertGreaterEqual(scan_seconds, 0.3)
+
+	def test_dropped_connection_reconnects_and_retries(self):
+		self.interactor.update(SECTION_TITLE)
+		self.server.drop_refreshes = 1
+		self.interactor.update(SECTION_TITLE)
+
+		self.assertEqual(self.server.refreshes, [None, None])
+		self.assertEqual(self.server.connections, 2)
+
+#### CLASSES ####
+
+### MAIN ###
+if __name__ == '__main__':
+	unittest.main()
+
+### MAIN ###
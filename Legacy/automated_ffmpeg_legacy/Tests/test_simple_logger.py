@@ -0,0 +1,59 @@
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import pytz
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Common'))
+from simple_logger import *
+
+#### CLASSES ####
+# Class: AsyncLoggerTest
+# Description: The writer thread of AsyncLogger keeps going on bad messages, and flush/close
+# don't hang if it is gone.
+class AsyncLoggerTest(unittest.TestCase):
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.log_file = os.path.join(self.temp_dir, 'test.log')
+		self.logger = AsyncLogger(pytz.timezone('US/Central'), self.log_file, queue_size=2)
+
+	def tearDown(self):
+		self.logger.close()
+		shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+	def __read_log(self):
+		with open(self.log_file, 'r') as f:
+			return f.read()
+
+	def test_unformattable_message_is_logged_and_writer_keeps_going(self):
+		self.logger.log(Severity.INFO, [])
+		self.logger.log(Severity.INFO, 'after the bad message')
+		self.logger.flush()
+
+		self.assertTrue(self.logger.writer.is_alive())
+		log = self.__read_log()
+		self.assertIn('Unable to format log message []', log)
+		self.assertIn('after the bad message', log)
+
+	def test_close_does_not_block_without_writer(self):
+		# Stop the writer, then fill the queue past its size
+		self.logger.queue.put(None)
+		self.logger.writer.join()
+		for i in range(0, 5):
+			self.logger.log(Severity.INFO, f'message {i}')
+
+		closer = threading.Thread(target=self.logger.close, daemon=True)
+		closer.start()
+		closer.join(10)
+		self.assertFalse(closer.is_alive(), 'close blocked with the writer thread gone.')
+
+#### CLASSES ####
+
+### MAIN ###
+if __name__ == '__main__':
+	unittest.main()
+
+### MAIN ###
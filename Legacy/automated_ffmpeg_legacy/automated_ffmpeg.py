@@ -7,22 +7,40 @@ from signal import *
 from stat import *
 import subprocess
 import sys
+import threading
 import time
 import traceback
 
+from analysis_cache import *
+from chunked_encode import *
+from copy_engine import *
+from directory_watcher import *
 from encode_data import *
+from encode_farm import *
+from encode_history import *
+from encode_jobs import *
+from encode_scheduler import *
+from ffmpeg_progress import *
 from ffmpeg_tools_utilities import *
+from library_catalog import *
 from list_builders import *
+from metrics import *
 from plex_interactor import *
 from simple_logger import *
+from tracing import *
 
 ### GLOBALS ###
-ffmpeg_proc = None
+encode_pool = None
 logger = None
+# Merges the plex library updates of movies copied close together (None if plex is not enabled)
+plex_refresh = None
+# Copies the encoded movies to plex in the background (None if plex is not enabled)
+plex_copier = None
 
 config_path = '/usr/local/bin/automated_ffmpeg_config.ini'
-current_working_movie = None
-working_movie_path = '/tmp/automated_ffmpeg/working_movie.txt' 
+working_dir = '/tmp/automated_ffmpeg/working'
+# Waits for new movies between scans; woken up when an encode finishes
+watcher = None
 ### GLOBALS ###
 
 ### FUNCTIONS ###
@@ -30,26 +48,296 @@ def log(severity, msg):
 	global logger
 	logger.log(severity, msg)
 
-	if severity == Severity.FATAL:
+	# Only the main thread exits; on a worker thread sys.exit would just end that thread
+	# (errors there are reported through the job, see EncodeWorkerPool)
+	if (severity == Severity.FATAL) and (threading.current_thread() == threading.main_thread()):
 		sys.exit(1)
 
 def exit_cleanup(*args):
 	global logger
-	global ffmpeg_proc
-	global current_working_movie
+	global encode_pool
+	active_jobs = encode_pool.active_jobs() if encode_pool != None else []
 	if logger != None:
-		if current_working_movie == None:
+		if not active_jobs:
 			log(Severity.INFO, 'Program exited/terminated. Cleaning up.')
 		else:
-			msg = ['Program exited/terminated. Cleaning up.',
-				f'Movie being encoded when terminated: {current_working_movie}']
+			msg = ['Program exited/terminated. Cleaning up.'] + [f'Movie being encoded when terminated: {job.source_file_full_path}' for job in active_jobs]
 			log(Severity.INFO, msg)
 
-	if ffmpeg_proc != None:
-		ffmpeg_proc.kill()
+	if encode_pool != None:
+		encode_pool.kill_all()
+
+	if plex_copier != None:
+		not_copied = plex_copier.cancel_all()
+		if (logger != None) and not_copied:
+			log(Severity.ERROR, ['Encoded movie(s) not copied to plex when terminated:'] + [task.source for task in not_copied])
+
+	# Don't leave copied movies out of plex
+	if plex_refresh != None:
+		plex_refresh.flush()
 
 	sys.exit(0)
 
+# Analysis stage of a movie: builds its encode data (probe, crop, scan) and the
+# ffmpeg command to encode it. The movie should already be ready (see readiness).
+# i is the index of the directory pair the movie was found in.
+# Returns: EncodeJob ready to be encoded (None if the movie can't be encoded right now)
+def analyze_movie(movie, i):
+	# CHECK ANALYSIS CACHE
+	encode_data = None
+	if analysis_cache != None:
+		try:
+			with tracer.span('cache_lookup', movie) as span:
+				encode_data, msg = get_cached_encode_data(analysis_cache, movie, animated[i])
+				span.attrs['hit'] = encode_data != None
+		except Exception as error:
+			msg = [f'Error reading analysis cache for {movie}'] + traceback.format_exc().split('\n')
+			log(Severity.ERROR, msg)
+		else:
+			if encode_data != None:
+				log(Severity.INFO, msg)
+
+	if encode_data == None:
+		# PROBE
+		probe, msg = probe_video_data(movie)
+		if probe == None:
+			metrics.inc('automated_ffmpeg_failures_total', labels={'stage' : 'analysis'})
+			log(Severity.ERROR, msg)
+			return None
+		else:
+			log(Severity.INFO, msg)
+
+		# BUILD ENCODE DATA
+		with tracer.span('build_encode_data', movie) as span:
+			encode_data, msg = build_automated_encode_data(probe, movie, animated[i], analysis_cache, analysis_settings)
+			if encode_data == None:
+				span.outcome = OUTCOME_FAILED
+		if encode_data == None:
+			metrics.inc('automated_ffmpeg_failures_total', labels={'stage' : 'analysis'})
+			log(Severity.ERROR, msg)
+			return None
+		else:
+			log(Severity.INFO, msg)
+
+		# CACHE ENCODE DATA
+		if analysis_cache != None:
+			try:
+				analysis_cache.set_encode_data(movie, encode_data)
+			except Exception as error:
+				msg = [f'Error writing analysis cache for {movie}'] + traceback.format_exc().split('\n')
+				log(Severity.ERROR, msg)
+
+	# BUILD CHUNKED ENCODE (falls back to a single ffmpeg command if the movie can't be split)
+	if chunked_encode == True:
+		chunk_plan, encoded_movie_path, msg = build_chunk_plan(encode_data, movie_dirs[i], movie_encoded_dirs[i], chunk_roots[i], chunk_seconds, chunk_workers, chunk_threads)
+		if chunk_plan != None:
+			if msg != None:
+				log(Severity.ERROR, msg)
+			return EncodeJob(movie, encoded_movie_path, chunk_plan.concat_cmd, encode_data, i, chunk_plan)
+		else:
+			log(Severity.INFO, [f'Not using a chunked encode for {movie}.'] + (msg if isinstance(msg, list) else [msg]))
+
+	# BUILD COMMAND
+	with tracer.span('build_encode_command', movie) as span:
+		cmd, encoded_movie_path, msg = build_encode_command(encode_data, movie_dirs[i], movie_encoded_dirs[i], encode_threads)
+		if cmd == None:
+			span.outcome = OUTCOME_FAILED
+	if cmd == None:
+		metrics.inc('automated_ffmpeg_failures_total', labels={'stage' : 'analysis'})
+		log(Severity.ERROR, msg)
+		return None
+	elif msg != None:
+		log(Severity.ERROR, msg)
+
+	return EncodeJob(movie, encoded_movie_path, cmd, encode_data, i)
+
+# Called by the encode worker pool (on the worker thread) right before ffmpeg is started.
+def encode_started(job):
+	if job.chunk_plan != None:
+		plan = job.chunk_plan
+		msg = [f'STARTING CHUNKED ENCODING FOR: {job.source_file_full_path} ({len(plan.chunk_cmds)} chunks, {plan.workers} at a time)',
+			f'FFMPEG CHUNK CMD: {plan.chunk_cmds[0]}', f'FFMPEG CONCAT CMD: {plan.concat_cmd}']
+	elif job.worker != None:
+		msg = [f'STARTING ENCODING FOR: {job.source_file_full_path} (FARM WORKER: {job.worker})', f'FFMPEG CMD: {job.cmd}']
+	else:
+		msg = [f'STARTING ENCODING FOR: {job.source_file_full_path}', f'FFMPEG CMD: {job.cmd}']
+	log(Severity.INFO, msg)
+
+# Called by the encode farm coordinator when the farm worker of a job stopped sending heartbeats.
+def encode_requeued(job):
+	log(Severity.ERROR, f'Lost the farm worker encoding {job.source_file_full_path}. Queued it for encoding again.')
+
+# Called by the encode worker pool (on the worker thread) once the ffmpeg process of a job exits.
+# Logs the result and copies the encoded movie over to plex.
+def encode_complete(job):
+	try:
+		i = job.dir_index
+		movie = job.source_file_full_path
+		encoded_movie_path = job.encoded_file_full_path
+
+		# ENCODE HISTORY (used to predict how long queued movies will take)
+		if encode_history != None:
+			try:
+				encode_history.add(build_encode_record(job))
+			except Exception as error:
+				log(Severity.ERROR, [f'Error adding {movie} to the encode history.'] + traceback.format_exc().split('\n'))
+
+		encoded_size = os.path.getsize(encoded_movie_path) if (job.returncode == 0) and (os.path.exists(encoded_movie_path) == True) else 0
+		if (job.start_time != None) and (job.stop_time != None):
+			tracer.record('encode', movie, job.start_time.timestamp(), job.stop_time.timestamp(), OUTCOME_OK if job.returncode == 0 else OUTCOME_FAILED,
+				encoded_size, returncode=job.returncode, chunks=len(job.chunk_plan.chunk_cmds) if job.chunk_plan != None else 0, worker=job.worker)
+
+		if job.returncode != 0:
+			metrics.inc('automated_ffmpeg_encodes_total', labels={'result' : 'failure'})
+			metrics.inc('automated_ffmpeg_failures_total', labels={'stage' : 'encode'})
+			msg = f'Error running ffmpeg for {movie}. Details below'
+			log(Severity.ERROR, [msg] + job.error_msg)
+			return
+
+		msg = [f'COMPLETED ENCODING FOR {movie}', f'Time Elapsed: {str(job.elapsed_time())}']
+		log(Severity.INFO, msg)
+
+		metrics.inc('automated_ffmpeg_encodes_total', labels={'result' : 'success'})
+		metrics.observe('automated_ffmpeg_encode_duration_seconds', job.elapsed_time().total_seconds())
+		metrics.inc('automated_ffmpeg_encoded_bytes_total', encoded_size)
+
+		# PLEX INTERACT SECTION
+		if plex_enabled == True:
+			# COPY FILE OVER TO PLEX MEDIA DIRECTORIES (in the background, see plex_copy_complete)
+			# Get encoded_movie_path from building encode command
+			encoded_movie_plex_dest = encoded_movie_path.replace(movie_encoded_dirs[i], plex_dirs[i]).replace(os.path.basename(encoded_movie_path), '')
+			try:
+				if os.path.exists(encoded_movie_plex_dest) == False:
+					os.makedirs(encoded_movie_plex_dest, mode=0o777, exist_ok=True)
+			except Exception as error:
+				metrics.inc('automated_ffmpeg_failures_total', labels={'stage' : 'plex_copy'})
+				msg = [f'Error creating {encoded_movie_plex_dest} (Details below). Will not copy {encoded_movie_path} or attempt to update plex server.'] + traceback.format_exc().split('\n')
+				log(Severity.ERROR, msg)
+				return
+
+			plex_copier.submit(encoded_movie_path, encoded_movie_plex_dest, (movie, i, encoded_movie_plex_dest))
+			log(Severity.INFO, f'Queued {encoded_movie_path} to be copied to {encoded_movie_plex_dest}')
+
+	except Exception as error:
+		msg = [f'Error after encoding {job.source_file_full_path}'] + traceback.format_exc().split('\n')
+		log(Severity.ERROR, msg)
+	finally:
+		if watcher != None:
+			watcher.wake()
+
+# Called by the plex copy engine (on its thread) once an encoded movie was copied to plex.
+# Queues the plex library update of the directory it was copied to.
+def plex_copy_complete(task):
+	movie, i, encoded_movie_plex_dest = task.context
+	tracer.record('plex_copy', movie, task.start, task.end, OUTCOME_OK if task.error == None else OUTCOME_ERROR, task.bytes, method=task.method)
+	if task.error != None:
+		metrics.inc('automated_ffmpeg_failures_total', labels={'stage' : 'plex_copy'})
+		msg = [f'Error copying {task.source} to {encoded_movie_plex_dest} (Details below). Will not attempt to update plex server.'] + task.error
+		log(Severity.ERROR, msg)
+		return
+
+	copy_seconds = task.seconds()
+	metrics.observe('automated_ffmpeg_plex_copy_seconds', copy_seconds)
+	metrics.inc('automated_ffmpeg_plex_copy_bytes_total', task.bytes)
+	if copy_seconds > 0:
+		metrics.set('automated_ffmpeg_plex_copy_bytes_per_second', task.bytes / copy_seconds)
+	log(Severity.INFO, f'Successfully copied {task.source} to {encoded_movie_plex_dest} ({copy_seconds:.1f}s, {task.method})')
+
+	# Updated by the plex refresh queue along with the other movies copied within refresh_window
+	# (only the directory the movie was copied to is scanned if partial_scan is enabled)
+	plex_refresh.request(plex_sections[i], encoded_movie_plex_dest, movie)
+
+# Called by the plex refresh queue (on its thread) after a library section was updated.
+# movies are the copied movies the update was merged from, paths the directories
+# that were scanned (empty if the whole section was) and scan_seconds how long plex took to scan them
+# (None unless plex was seen scanning and then done).
+def plex_refreshed(section, movies, paths, start, end, scan_seconds, error):
+	tracer.record('plex_update', section, start, end, OUTCOME_OK if error == None else OUTCOME_ERROR, movies=movies, paths=paths, scan_seconds=scan_seconds)
+	if error != None:
+		metrics.inc('automated_ffmpeg_failures_total', labels={'stage' : 'plex_update'})
+		msg = [f'Failed to update Plex Server.', f'Server URL: {plex_baseurl}', f'Section: {section}'] + (['Paths:'] + paths if paths else []) + error
+		log(Severity.ERROR, msg)
+		return
+
+	if scan_seconds != None:
+		metrics.observe('automated_ffmpeg_plex_scan_seconds', scan_seconds)
+	scan = f'Scanned {len(paths)} path(s)' if paths else 'Scanned whole section'
+	if scan_seconds != None:
+		scan += f' in {scan_seconds:.1f}s'
+	elif plex_refresh.wait_seconds > 0:
+		scan += ' (scan time unknown)'
+	msg = [f'Updated Plex Server. Server URL: {plex_baseurl} | Section: {section} | Movies: {len(movies)} | {scan}'] + paths
+	log(Severity.INFO, msg)
+
+# Logs the live progress (fps, speed, ETA) of every job being encoded every interval seconds.
+def log_progress(interval):
+	while True:
+		time.sleep(interval)
+		try:
+			msg = []
+			for job in encode_pool.active_jobs():
+				if (job.start_time == None) or (job.progress == None) or (job.progress.updated == None):
+					continue
+				worker = f' (FARM WORKER: {job.worker})' if job.worker != None else ''
+				msg.append(f'{os.path.basename(job.source_file_full_path)}{worker}: {job.progress.summary()}')
+
+			if msg:
+				log(Severity.INFO, ['ENCODE PROGRESS:'] + msg)
+		except Exception as error:
+			log(Severity.ERROR, ['Error logging encode progress.'] + traceback.format_exc().split('\n'))
+
+# Estimated encode time of a movie for the sjf queue policy: from its cached encode data if it was
+# analyzed before, otherwise from its source file size (see EncodeHistory).
+# Returns: Seconds (None if there is no encode history)
+def estimate_encode_seconds(movie, i):
+	if encode_history == None:
+		return None
+
+	try:
+		if analysis_cache != None:
+			encode_data, msg = get_cached_encode_data(analysis_cache, movie, animated[i])
+			prediction = encode_history.predict(encode_data) if encode_data != None else None
+			if prediction != None:
+				return prediction.seconds
+
+		return encode_history.predict_seconds_from_size(os.path.getsize(movie))
+	except Exception as error:
+		log(Severity.ERROR, [f'Error estimating the encode time of {movie}.'] + traceback.format_exc().split('\n'))
+		return None
+
+# Takes the waiting movies off the candidate queue in order, analyzes them and queues them for encoding.
+# encode_pool.submit blocks while every worker is busy and the ready queue is full, so the next movie is
+# only taken once it can be encoded soon; movies found by the scans meanwhile are merged into the order.
+def analysis_loop():
+	while True:
+		movie, i = candidate_queue.get()
+		try:
+			# May have been removed while waiting
+			if os.path.exists(movie) == False:
+				log(Severity.INFO, f'{movie} no longer exists. Not encoding it.')
+				continue
+
+			# ANALYSIS STAGE
+			job = analyze_movie(movie, i)
+			if job == None:
+				continue
+
+			# ENCODE STAGE (blocks while every worker is busy and the ready queue is full)
+			prediction = encode_history.predict(job.encode_data) if encode_history != None else None
+			encode_pool.submit(job)
+			log(Severity.INFO, f'QUEUED FOR ENCODING: {movie}' + (f' ({prediction.summary()})' if prediction != None else ''))
+
+		except Exception as error:
+			msg = [f'Error during processing/encoding {movie}'] + traceback.format_exc().split('\n')
+			log(Severity.ERROR, msg)
+		finally:
+			candidate_queue.done(movie)
+
+# Returns: Sum of attr (fps/speed) of the progress of every running encode (gauge callback for the metrics endpoint)
+def running_encodes_total(attr):
+	return sum(getattr(job.progress, attr) for job in encode_pool.active_jobs()
+		if (job.start_time != None) and (job.progress != None) and (job.progress.finished == False))
+
 ### FUNCTIONS ###
 
 ### MAIN ###
@@ -74,25 +362,47 @@ else:
 
 os.chmod('/tmp/automated_ffmpeg', 0o777)
 
-logger = SimpleLoggerWithRollover(timezone, log_file, max_bytes=max_bytes, backup_count=backup_count)
+if config['Logger'].getboolean('async_writer', True) == True:
+	# Messages are written by a background thread; rolls over as soon as max_bytes is reached
+	logger = AsyncLogger(timezone, log_file, max_bytes=max_bytes, backup_count=backup_count, queue_size=config['Logger'].getint('queue_size', 10000))
+else:
+	logger = SimpleLoggerWithRollover(timezone, log_file, max_bytes=max_bytes, backup_count=backup_count)
 
 # Set cleanup function for potential termination
 for sig in (SIGABRT, SIGALRM, SIGBUS, SIGILL, SIGINT, SIGTERM):
 	signal(sig, exit_cleanup)
 
 try:
-	if os.path.exists(working_movie_path):
-		with open(working_movie_path, 'r') as f:
-			file_to_delete = f.readline()
-			if os.path.exists(file_to_delete):
-				os.remove(file_to_delete)
-		os.remove(working_movie_path)
+	removed_files = remove_partial_encodes(working_dir)
+	if removed_files:
+		log(Severity.INFO, ['Deleted partially encoded movie(s) from previous run.'] + removed_files)
 except Exception as error:
-	msg = ['Error deleting previous working movie or working_movie file.'] + traceback.format_exc().split('\n')
+	msg = ['Error deleting previous working movie(s) or working files.'] + traceback.format_exc().split('\n')
 	log(Severity.ERROR, msg)
 
 plex_enabled = config['DEFAULT'].getboolean('plex_enabled', False)
 
+# Crop/scan analysis settings
+analysis_settings = load_analysis_settings(config)
+
+# Analysis cache (shared with ffmpeg_guided)
+analysis_cache = None
+if config['DEFAULT'].getboolean('analysis_cache_enabled', True) == True:
+	analysis_cache, msg = open_analysis_cache(config['DEFAULT'].get('analysis_cache', None), get_analysis_settings_key(analysis_settings))
+	log(Severity.INFO if analysis_cache != None else Severity.ERROR, msg)
+
+# Encode history (predicts how long queued movies will take)
+encode_history = None
+if config['DEFAULT'].getboolean('history_enabled', True) == True:
+	encode_history, msg = open_encode_history(config['DEFAULT'].get('history_path', None))
+	log(Severity.INFO if encode_history != None else Severity.ERROR, msg)
+
+# Library catalog (falls back to globbing the directories if not enabled/can't be opened)
+catalog = None
+if config['DEFAULT'].getboolean('catalog', True) == True:
+	catalog, msg = open_library_catalog(config['DEFAULT'].get('catalog_path', None), config['DEFAULT'].getint('catalog_workers', 4))
+	log(Severity.INFO if catalog != None else Severity.ERROR, msg)
+
 # Config - Directory Info
 try:
 	directories = config['Directories']
@@ -108,13 +418,33 @@ except Exception as error:
 	msg = ['Error getting directory info from config file. Exiting.'] + traceback.format_exc().split('\n')
 	log(Severity.FATAL, msg)
 
+# Queue policy (order new movies are analyzed and queued for encoding in) and directory pair priorities
+queue_policy = config['DEFAULT'].get('queue_policy', 'path').lower()
+if queue_policy not in QUEUE_POLICIES:
+	log(Severity.ERROR, f'Unknown queue_policy "{queue_policy}" (one of {", ".join(QUEUE_POLICIES)}). Using path.')
+	queue_policy = 'path'
+dir_priorities, msg = parse_priorities(directories.get('priority', ''))
+if dir_priorities == None:
+	log(Severity.ERROR, msg)
+	dir_priorities = []
+scheduler = EncodeScheduler(queue_policy, dir_priorities, estimate_encode_seconds)
+# Movies waiting to be analyzed and encoded, in scheduler order (taken by analysis_loop)
+candidate_queue = CandidateQueue(scheduler)
+
 # Config - Plex Info
 if plex_enabled == True:
 	try:
 		plex_baseurl = config['Plex']['baseurl']
 		plex_token = config['Plex']['token']
 
-		plex_interact = PlexInteractor(plex_baseurl, plex_token)
+		plex_interact = PlexInteractor(plex_baseurl, plex_token, config['Plex'].getint('timeout', 30))
+		# Library updates requested within refresh_window seconds of each other are merged into one
+		# Only the directories movies were copied to are scanned (partial_scan), optionally waiting for plex to finish (scan_wait)
+		plex_refresh = PlexRefreshQueue(plex_interact, config['Plex'].getint('refresh_window', 60), plex_refreshed, config['Plex'].getboolean('partial_scan', True),
+			config['Plex'].getint('scan_wait', 0), config['Plex'].getint('scan_poll_interval', 2))
+		# Encoded movies are copied to plex in the background (copy_workers at a time, limited to copy_max_mb_per_second together)
+		plex_copier = CopyEngine(config['DEFAULT'].getint('copy_workers', 2), config['DEFAULT'].getint('copy_buffer_mb', 64) * 1024 * 1024,
+			int(config['DEFAULT'].getfloat('copy_max_mb_per_second', 0) * 1000000), plex_copy_complete)
 
 		min_len = len(min(movie_dirs, movie_encoded_dirs, plex_dirs, plex_sections, key=len))
 		max_len = len(max(movie_dirs, movie_encoded_dirs, plex_dirs, plex_sections, key=len))
@@ -145,156 +475,196 @@ except Exception as error:
 msg = ['AUTOMATED_FFMPEG INITIALIZED.',
 	f'TIMEZONE: {tz}',
 	f'MOVIE DIRECTORIES: {movie_dirs[:min_len]}',
-	f'MOVIE ENCODED DIRECTORIES: {movie_encoded_dirs[:min_len]}']
+	f'MOVIE ENCODED DIRECTORIES: {movie_encoded_dirs[:min_len]}',
+	f'QUEUE POLICY: {queue_policy}' + (f' | DIRECTORY PRIORITIES: {dir_priorities[:min_len]}' if dir_priorities else ''),
+	f'ANALYSIS MODE: {analysis_settings.mode} (WINDOW: {analysis_settings.window_seconds}s/{analysis_settings.window_frames} frames) | CROP METHOD: {analysis_settings.crop_method} | SCAN METHOD: {analysis_settings.scan_method}']
 
 if plex_enabled == True:
 	msg += [f'PLEX DIRECTORIES: {plex_dirs[:min_len]}',
 	f'PLEX LIBRARY SECTIONS: {plex_sections[:min_len]}',
-	f'PLEX SERVER: {plex_baseurl}']
+	f'PLEX SERVER: {plex_baseurl} | REFRESH WINDOW: {plex_refresh.window_seconds}s | PARTIAL SCAN: {plex_refresh.partial_scan}',
+	f'PLEX COPY WORKERS: {plex_copier.worker_count} | BANDWIDTH LIMIT: ' + (f'{plex_copier.limiter.bytes_per_second / 1000000:g} MB/s' if plex_copier.limiter.bytes_per_second > 0 else 'none')]
 
 msg += ['FFMPEG VERSION INFO:'] + ffmpeg_version
 log(Severity.INFO, msg)
 
 sleep_time = config['DEFAULT'].getint('sleep', 1800) # Defaults to 30 minutes
 
+# Encode workers
+encode_workers = max(config['DEFAULT'].getint('encode_workers', 1), 1)
+encode_threads = config['DEFAULT'].getint('encode_threads', 0)
+if (encode_threads <= 0) and (encode_workers > 1):
+	# Split the machine between the workers
+	encode_threads = max(os.cpu_count() // encode_workers, 1)
+
+# Chunked encoding: each movie is split at keyframes into chunks that are encoded in parallel
+chunked_encode = config['DEFAULT'].getboolean('chunked_encode', False)
+chunk_seconds = max(config['DEFAULT'].getint('chunk_seconds', 300), 1)
+chunk_workers = max(config['DEFAULT'].getint('chunk_workers', 4), 1)
+# Split the threads of an encode between its chunks
+chunk_threads = max(encode_threads // chunk_workers, 1) if encode_threads > 0 else max(os.cpu_count() // (encode_workers * chunk_workers), 1)
+# Directory the chunks are written to (a directory next to each movie_encoded directory if not given)
+chunk_dir = config['DEFAULT'].get('chunk_dir', '').strip()
+chunk_roots = [chunk_dir if chunk_dir else get_default_chunk_root(movie_encoded_dir) for movie_encoded_dir in movie_encoded_dirs[:min_len]]
+if chunked_encode == True:
+	log(Severity.INFO, f'CHUNKED ENCODE: {chunk_seconds}s chunks, {chunk_workers} at a time | CHUNK DIRECTORIES: {sorted(set(chunk_roots))}')
+
+try:
+	removed_dirs = [removed_dir for chunk_root in sorted(set(chunk_roots)) for removed_dir in remove_chunk_dirs(chunk_root)]
+	if removed_dirs:
+		log(Severity.INFO, ['Deleted chunk directories of chunked encodes from previous run.'] + removed_dirs)
+except Exception as error:
+	msg = ['Error deleting chunk directories from previous run.'] + traceback.format_exc().split('\n')
+	log(Severity.ERROR, msg)
+
+# Watch the movie directories for new movies instead of only sleeping between scans
+watch_enabled = config['DEFAULT'].getboolean('watch', True)
+poll_min_interval = config['DEFAULT'].getint('poll_min_interval', 60)
+watcher, msg = create_directory_watcher(movie_dirs[:min_len], watch_enabled, min(poll_min_interval, sleep_time), sleep_time)
+log(Severity.INFO, msg)
+
+# Movies are encoded once they have not changed for ready_quiet_seconds (checked every scan, no blocking sleeps)
+readiness = FileReadinessTracker(config['DEFAULT'].getint('ready_quiet_seconds', 30))
+not_ready_logged = set()
+
+# Number of analyzed movies that can wait for a free encode worker
+analysis_queue_size = max(config['DEFAULT'].getint('analysis_queue_size', 1), 0)
+
+# Encode farm: farm workers (farm_worker.py) on other hosts pull the jobs instead of encoding them here
+farm_enabled = config.has_section('Farm') and config['Farm'].getboolean('enabled', False)
+if farm_enabled == True:
+	farm_listen = config['Farm'].get('listen', '127.0.0.1:8765')
+	try:
+		encode_pool = EncodeFarmCoordinator(farm_listen, encode_complete, analysis_queue_size, encode_started,
+			config['Farm'].getint('lease_seconds', 120), config['Farm'].get('token', None) or None, encode_requeued)
+	except Exception as error:
+		msg = [f'Error starting encode farm coordinator on {farm_listen}. Exiting.'] + traceback.format_exc().split('\n')
+		log(Severity.FATAL, msg)
+
+	log(Severity.INFO, f'ENCODE FARM COORDINATOR LISTENING ON: {farm_listen}')
+	if chunked_encode == True:
+		# The chunks are planned in the local working dir, which farm workers can't see
+		chunked_encode = False
+		log(Severity.ERROR, 'Chunked encoding is not supported with the encode farm. Encoding movies in one piece.')
+else:
+	encode_pool = EncodeWorkerPool(encode_workers, working_dir, encode_complete, analysis_queue_size, encode_started, config['DEFAULT'].getint('error_log_lines', 200))
+log(Severity.INFO, f'ENCODE WORKERS: {encode_workers} | THREADS PER ENCODE: {encode_threads if encode_threads > 0 else "encoder default"} | ANALYSIS QUEUE SIZE: {analysis_queue_size}')
+if chunked_encode == True:
+	log(Severity.INFO, f'CHUNKED ENCODING: {chunk_seconds}s chunks | CHUNK WORKERS PER ENCODE: {chunk_workers} | THREADS PER CHUNK: {chunk_threads}')
+
+# Log the live progress of the encodes
+progress_log_interval = config['DEFAULT'].getint('progress_log_interval', 300)
+if progress_log_interval > 0:
+	threading.Thread(target=log_progress, args=(progress_log_interval,), name='progress_logger', daemon=True).start()
+
+# Prometheus metrics endpoint (disabled if metrics_port is 0)
+metrics_port = config['DEFAULT'].getint('metrics_port', 0)
+if metrics_port > 0:
+	metrics.set_gauge_callback('automated_ffmpeg_queue_depth', encode_pool.queued_count)
+	metrics.set_gauge_callback('automated_ffmpeg_encodes_active', lambda: len([job for job in encode_pool.active_jobs() if job.start_time != None]))
+	metrics.set_gauge_callback('automated_ffmpeg_encode_fps', lambda: running_encodes_total('fps'))
+	metrics.set_gauge_callback('automated_ffmpeg_encode_speed', lambda: running_encodes_total('speed'))
+	if plex_copier != None:
+		metrics.set_gauge_callback('automated_ffmpeg_plex_copies_pending', plex_copier.pending_count)
+	metrics_server, msg = start_metrics_server(config['DEFAULT'].get('metrics_address', '127.0.0.1'), metrics_port)
+	log(Severity.INFO if metrics_server != None else Severity.ERROR, msg)
+
+# Per stage timing spans of every movie (see trace_summary.py), disabled if trace_file is empty
+trace_file = config['DEFAULT'].get('trace_file', '')
+if trace_file:
+	try:
+		tracer.open(trace_file)
+		log(Severity.INFO, f'WRITING TRACE SPANS TO: {trace_file}')
+	except Exception as error:
+		log(Severity.ERROR, [f'Unable to open trace file {trace_file}. Not tracing.'] + traceback.format_exc().split('\n'))
+
+# Analyze and queue the movies found by the scans for encoding, in scheduler order
+threading.Thread(target=analysis_loop, name='analysis', daemon=True).start()
+
 # Get into what should be a never ending loop
 while True:
-	found_movies_to_encode = False
+	candidates = []
+	# (movie, directory index) of the new movies that are ready to be encoded
+	ready_movies = []
 	for i in range(0, min_len):
 
-		movie_files, movie_files_base = build_movie_lists(movie_dirs[i])
+		movie_files = None
+		scan_start = time.monotonic()
+		scan_start_wall = time.time()
+		if catalog != None:
+			try:
+				catalog.scan(movie_dirs[i])
+				catalog.scan(movie_encoded_dirs[i])
+				movie_files, movie_files_base = build_movie_lists_from_catalog(catalog, movie_dirs[i])
+				movie_encoded_files, movie_encoded_files_base = build_movie_encoded_lists_from_catalog(catalog, movie_encoded_dirs[i])
+			except Exception as error:
+				msg = [f'Error updating library catalog for {movie_dirs[i]}. Falling back to searching the directories.'] + traceback.format_exc().split('\n')
+				log(Severity.ERROR, msg)
+				movie_files = None
+
+		if movie_files == None:
+			movie_files, movie_files_base = build_movie_lists(movie_dirs[i])
+			movie_encoded_files, movie_encoded_files_base = build_movie_encoded_lists(movie_encoded_dirs[i])
+
+		metrics.observe('automated_ffmpeg_scan_duration_seconds', time.monotonic() - scan_start)
+		tracer.record('dir_scan', movie_dirs[i], scan_start_wall, time.time(), files=len(movie_files or []), encoded_files=len(movie_encoded_files or []))
+		for kind, files in (('movie', movie_files), ('encoded', movie_encoded_files)):
+			metrics.set('automated_ffmpeg_scan_files', len(files or []), {'directory' : kind, 'index' : i})
+			metrics.inc('automated_ffmpeg_scan_files_total', len(files or []), {'directory' : kind})
 
 		if (not movie_files) or (not movie_files_base):
 			#msg = f'No movies found in {movie_dirs[i]}.'
 			#log(Severity.ERROR, msg)
 			continue
 
-		movie_encoded_files, movie_encoded_files_base = build_movie_encoded_lists(movie_encoded_dirs[i])
 		to_encode = build_to_encode_list(movie_files, movie_files_base, movie_encoded_files_base)
+		# Skip movies that are already waiting/queued/being encoded
+		to_encode = [movie for movie in to_encode if (encode_pool.is_active(movie) == False) and (candidate_queue.is_queued(movie) == False)]
+		candidates.extend(to_encode)
+
+		# FILE READY CHECK (stats every new movie at once; movies still being written are checked again next scan)
+		# Traced per movie; every movie of the batch gets the time of the whole check
+		ready_check_start = time.time()
+		to_encode, not_ready = readiness.observe(to_encode)
+		ready_check_end = time.time()
+		for movies, ready in ((to_encode, True), (not_ready, False)):
+			for movie in movies:
+				tracer.record('ready_check', movie, ready_check_start, ready_check_end, ready=ready, batch=len(to_encode) + len(not_ready))
+		# Only log movies that were not already waiting last scan
+		newly_not_ready = [movie for movie in not_ready if movie not in not_ready_logged]
+		not_ready_logged.update(not_ready)
+		if newly_not_ready:
+			msg = [f'{len(newly_not_ready)} movie(s) in {movie_dirs[i]} are being written to (file size/mtime changing). May still be ripping. Will check again.'] + [os.path.basename(movie) for movie in newly_not_ready]
+			log(Severity.INFO, msg)
 
 		if len(to_encode) > 0:
 			msg = [f'Found {len(to_encode)} new movie(s) to encode in {movie_dirs[i]}.'] + [os.path.basename(movie) for movie in to_encode]
 			log(Severity.INFO, msg)
-			found_movies_to_encode = True
-			# Encode each new movie
-			for movie in to_encode:
-				try:
-					# FILE READY CHECK
-					is_ready, msg = check_file_ready(movie)
-					# If not ready, move on to next movie
-					if is_ready == False:
-						log(Severity.ERROR, msg)
-						# If any movies come after this one, it'll flip back to true.
-						# If this is the last movie/only movie, it needs more time so 
-						# force the script to sleep.
-						found_movies_to_encode = False
-						continue
-
-					# CREATE XML
-					xml_file_path, msg = create_video_data_xml(movie)
-					if xml_file_path == None:
-						log(Severity.ERROR, msg)
-						found_movies_to_encode = False
-						continue
-					else:
-						log(Severity.INFO, msg)
-
-					# BUILD ENCODE DATA
-					encode_data, msg = build_automated_encode_data(xml_file_path, movie, animated[i])
-					if encode_data == None:
-						log(Severity.ERROR, msg)
-						# Don't delete xml file here in case it needs to be looked at.
-						# Set this so if it is the last movie, it doesn't spin
-						# and fill up the log.  It'll at least have to wait
-						# the sleep time before trying again.
-						found_movies_to_encode = False
-						continue
-					else:
-						log(Severity.INFO, msg)
-
-					# DELETE XML
-					try:
-						os.remove(xml_file_path)
-					except OSError as error:
-						msg = [f'Error deleting {xml_file_path}', error]
-						log(Severity.ERROR, msg)
-					else:
-						log(Severity.INFO, f'Deleted {xml_file_path}')
-
-					# BUILD COMMAND
-					cmd, encoded_movie_path, msg = build_encode_command(encode_data, movie_dirs[i], movie_encoded_dirs[i])
-					if cmd == None:
-						log(Severity.ERROR, msg)
-						continue
-					elif msg != None:
-						log(Severity.ERROR, msg)
-
-					msg = [f'STARTING ENCODING FOR: {movie}', f'FFMPEG CMD: {cmd}']
-					log(Severity.INFO, msg)
-
-					current_working_movie = movie
-					with open(working_movie_path, 'w') as f:
-						f.write(encoded_movie_path)
-					start_time = dt.now()
-
-					ffmpeg_proc = subprocess.run('exec ' + cmd, shell=True, stderr=subprocess.PIPE)
-
-					stop_time = dt.now()
-					current_working_movie = None
-
-					if ffmpeg_proc.returncode != 0:
-						error_msg = ffmpeg_proc.stderr.decode('utf-8').split('\n')
-						error_msg[:] = [x for x in error_msg if not x.startswith('frame=')]
-						msg = f'Error running ffmpeg for {movie}. Details below'
-						error_msg.insert(0, msg)
-						log(Severity.ERROR, error_msg)
-						ffmpeg_proc = None
-
-						try:
-							os.remove(working_movie_path)
-						except Exception as error:
-							msg = [f'Error deleting {working_movie_path}'] + traceback.format_exc().split('\n')
-							log(Severity.ERROR, msg)
-					else:
-						elapsed_time = stop_time - start_time
-						msg = [f'COMPLETED ENCODING FOR {movie}', f'Time Elapsed: {str(elapsed_time)}']
-						log(Severity.INFO, msg)
-						ffmpeg_proc = None
-
-						try:
-							os.remove(working_movie_path)
-						except Exception as error:
-							msg = [f'Error deleting {working_movie_path}'] + traceback.format_exc().split('\n')
-							log(Severity.ERROR, msg)
-
-						# PLEX INTERACT SECTION
-						if plex_enabled == True:
-							# COPY FILE OVER TO PLEX MEDIA DIRECTORIES
-							# Get encoded_movie_path from building encode command
-							encoded_movie_plex_dest = encoded_movie_path.replace(movie_encoded_dirs[i], plex_dirs[i]).replace(os.path.basename(encoded_movie_path), '')
-							try:
-								if os.path.exists(encoded_movie_plex_dest) == False:
-									os.makedirs(encoded_movie_plex_dest, mode=0o777)
-
-								shutil.copy2(encoded_movie_path, encoded_movie_plex_dest)
-							except Exception as error:
-								msg = [f'Error copying {encoded_movie_path} to {encoded_movie_plex_dest} (Details below). Will not attempt to update plex server.'] + traceback.format_exc().split('\n')
-								log(Severity.ERROR, msg)
-								continue
-							else:
-								log(Severity.INFO, f'Successfully copied {encoded_movie_path} to {encoded_movie_plex_dest}')
-
-							try:
-								plex_interact.update(plex_sections[i])
-								msg = f'Updated Plex Server. Server URL: {plex_baseurl} | Section: {plex_sections[i]}'
-								log(Severity.INFO, msg)
-							except Exception as error:
-								msg = [f'Failed to update Plex Server.', f'Server URL: {plex_baseurl}', f'Section: {plex_sections[i]}'] + traceback.format_exc().split('\n')
-								log(Severity.ERROR, msg)
-
-				except Exception as error:
-					msg = [f'Error during processing/encoding {movie}'] + traceback.format_exc().split('\n')
-					log(Severity.ERROR, msg)
+			ready_movies.extend((movie, i) for movie in to_encode)
+
+	# MERGE THE NEW MOVIES OF EVERY DIRECTORY INTO THE WAITING MOVIES (ordered by queue policy/priorities; see analysis_loop)
+	if ready_movies:
+		try:
+			waiting = candidate_queue.merge(ready_movies)
+			if len(waiting) > 1:
+				log(Severity.INFO, [f'ENCODE ORDER ({queue_policy}):'] + [os.path.basename(movie) for movie, i in waiting])
+		except Exception as error:
+			msg = ['Error ordering the waiting movies. Encoding the new ones after them in path order.'] + traceback.format_exc().split('\n')
+			log(Severity.ERROR, msg)
+
+	# End of for loop - drop cache entries of files that are gone
+	if analysis_cache != None:
+		try:
+			evicted = analysis_cache.evict_missing()
+			if evicted > 0:
+				log(Severity.INFO, f'Evicted {evicted} stale entries from the analysis cache.')
+		except Exception as error:
+			msg = ['Error evicting stale analysis cache entries.'] + traceback.format_exc().split('\n')
+			log(Severity.ERROR, msg)
+
+	# End of for loop - forget movies that were encoded/removed
+	readiness.prune(candidates)
+	not_ready_logged.intersection_update(readiness.observations)
 
 	# End of for loop - do rollover check
 	try:
@@ -303,12 +673,24 @@ while True:
 		msg = ['Error doing log file rollover.'] + traceback.format_exc().split('\n')
 		log(Severity.ERROR, msg)
 
-	if found_movies_to_encode == False:
-		movie_files = []
-		movie_files_base = []
-		movie_encoded_files = []
-		movie_encoded_files_base = []
-		to_encode = []
-		time.sleep(sleep_time) # Wait a while before checking for more work
+	if ready_movies:
+		watcher.reset()
+
+	movie_files = []
+	movie_files_base = []
+	movie_encoded_files = []
+	movie_encoded_files_base = []
+	to_encode = []
+	# Wait a while before checking for more work (returns early on new movies or when an encode finishes).
+	# The movies found are analyzed and encoded meanwhile (see analysis_loop).
+	# Movies still being written to are checked again as soon as they could be ready.
+	wait_time = sleep_time
+	seconds_until_ready = readiness.seconds_until_ready()
+	if seconds_until_ready != None:
+		wait_time = min(wait_time, max(seconds_until_ready, 1))
+
+	changed_files = watcher.wait(wait_time)
+	if changed_files:
+		log(Severity.INFO, ['Detected new/changed movie file(s).'] + changed_files)
 
 ### MAIN ###
\ No newline at end of file
@@ -0,0 +1,111 @@
+from argparse import ArgumentParser
+import json
+import os
+import statistics
+import sys
+import time
+
+from encode_history import *
+
+#### DICTIONARIES/STATICS ####
+# period => strftime format of the group a finished encode falls in
+PERIOD_FORMATS = {
+	'day' : '%Y-%m-%d',
+	'week' : '%Y-W%W',
+	'month' : '%Y-%m',
+}
+
+#### DICTIONARIES/STATICS ####
+
+### FUNCTIONS ####
+# Returns: Median of the values (None if there are none)
+def median(values):
+	values = [value for value in values if value != None]
+	return statistics.median(values) if values else None
+
+# Groups the records by period (and encoder if by_encoder) and sums up their throughput.
+# speed is how many seconds of video are encoded per second.
+# Returns: List of (group, summary dict) in order
+def summarize(records, period, by_encoder):
+	groups = {}
+	for record in records:
+		group = time.strftime(PERIOD_FORMATS[period], time.localtime(record.finished))
+		if by_encoder == True:
+			group += f' {record.encoder}'
+		groups.setdefault(group, []).append(record)
+
+	summary = []
+	for group, group_records in sorted(groups.items()):
+		successful = [record for record in group_records if record.returncode == 0]
+		summary.append((group, {
+			'encodes' : len(group_records),
+			'failed' : len(group_records) - len(successful),
+			'encode_hours' : sum(record.encode_seconds for record in group_records) / 3600,
+			'video_hours' : sum(record.duration_seconds or 0 for record in successful) / 3600,
+			'median_fps' : median(record.fps for record in successful),
+			'median_speed' : median(((record.duration_seconds or 0) / record.encode_seconds) if record.encode_seconds else None for record in successful),
+			'median_mpixels_per_second' : median(record.megapixels_per_second() for record in successful),
+			'output_ratio' : (sum(record.output_size for record in successful) / sum(record.source_size for record in successful)) if sum(record.source_size for record in successful) > 0 else None,
+		}))
+
+	return summary
+
+# Returns: value formatted with fmt ('-' if None)
+def format_value(value, fmt):
+	return '-' if value == None else format(value, fmt)
+
+def print_summary(summary):
+	print(f'{"PERIOD":<24}{"ENCODES":>8}{"FAILED":>8}{"ENC HRS":>9}{"VID HRS":>9}{"FPS":>8}{"SPEED":>8}{"MPIX/S":>9}{"OUT/IN":>8}')
+	for group, values in summary:
+		print(f'{group:<24}{values["encodes"]:>8}{values["failed"]:>8}{values["encode_hours"]:>9.1f}{values["video_hours"]:>9.1f}'
+			f'{format_value(values["median_fps"], ".1f"):>8}{format_value(values["median_speed"], ".2f"):>8}'
+			f'{format_value(values["median_mpixels_per_second"], ".1f"):>9}{format_value(values["output_ratio"], ".2f"):>8}')
+
+def print_recent(records, count):
+	print(f'\nLAST {count} ENCODES:')
+	for record in records[-count:]:
+		finished = time.strftime('%Y-%m-%d %H:%M', time.localtime(record.finished))
+		seconds = int(record.encode_seconds)
+		result = 'ok' if record.returncode == 0 else f'failed ({record.returncode})'
+		print(f'{finished}  {record.encoder:<8}{record.width}x{record.height}{" HDR" if record.hdr == True else ""}  '
+			f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}  {record.fps:.1f} fps  {record.output_size / 1073741824:.2f} GiB  {result}  {os.path.basename(record.source_path)}')
+
+def main():
+	parser = ArgumentParser(description='Reports encode throughput trends from the automated_ffmpeg encode history.')
+	parser.add_argument('--db', default=None, help='Encode history database (history_path in the config; default location if not given)')
+	parser.add_argument('--period', choices=sorted(PERIOD_FORMATS), default='month', help='Group encodes by this period')
+	parser.add_argument('--by-encoder', action='store_true', help='Also group by video encoder')
+	parser.add_argument('--encoder', default=None, help='Only encodes with this video encoder (e.g. libx265)')
+	parser.add_argument('--days', type=float, default=None, help='Only encodes finished in the last this many days')
+	parser.add_argument('--recent', type=int, default=0, help='Also list the most recent encodes')
+	parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+	args = parser.parse_args()
+
+	encode_history, msg = open_encode_history(args.db)
+	if encode_history == None:
+		print(msg, file=sys.stderr)
+		sys.exit(1)
+
+	since = (time.time() - (args.days * 86400)) if args.days != None else None
+	records = encode_history.records(since, args.encoder)
+	encode_history.close()
+	if not records:
+		print('No encodes found.', file=sys.stderr)
+		sys.exit(1)
+
+	summary = summarize(records, args.period, args.by_encoder)
+	if args.json == True:
+		print(json.dumps(dict(summary), indent=2, sort_keys=True))
+		return
+
+	print_summary(summary)
+	if args.recent > 0:
+		print_recent(records, args.recent)
+
+### FUNCTIONS ###
+
+### MAIN ###
+if __name__ == '__main__':
+	main()
+
+### MAIN ###
@@ -0,0 +1,230 @@
+from configparser import ConfigParser
+from getopt import getopt, GetoptError
+import os
+import pytz
+from signal import *
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from encode_farm import *
+from encode_jobs import *
+from ffmpeg_progress import *
+from simple_logger import *
+
+### GLOBALS ###
+config_path = '/usr/local/bin/automated_ffmpeg_config.ini'
+logger = None
+encode_pool = None
+connection = None
+
+# EncodeJob => Tuple(farm job id, attempt, encoded file path) of the jobs being encoded
+farm_jobs = {}
+farm_jobs_lock = threading.Lock()
+# Results that could not be sent yet (resent with the next heartbeat)
+unsent_results = []
+unsent_results_lock = threading.Lock()
+### GLOBALS ###
+
+### FUNCTIONS ###
+def usage():
+	print(f'Usage: python3 {sys.argv[0]} [-c coordinator (host:port | unix:/path)] [-n name] [-s slots] [-w working_dir]')
+
+def log(severity, msg):
+	logger.log(severity, msg)
+
+	# Only the main thread exits; on a worker thread sys.exit would just end that thread
+	# (errors there are reported through the job, see EncodeWorkerPool)
+	if (severity == Severity.FATAL) and (threading.current_thread() == threading.main_thread()):
+		sys.exit(1)
+
+def exit_cleanup(*args):
+	if logger != None:
+		log(Severity.INFO, 'Farm worker exited/terminated. Cleaning up.')
+
+	if encode_pool != None:
+		encode_pool.kill_all()
+
+	sys.exit(0)
+
+# Sends the result of a job to the coordinator (kept for later if the coordinator can't be reached)
+def send_result(result):
+	try:
+		reply = connection.call(result)
+	except (OSError, ValueError) as error:
+		with unsent_results_lock:
+			unsent_results.append(result)
+		log(Severity.ERROR, f'Unable to send result of farm job {result["job_id"]} to the coordinator ({error}). Will retry.')
+		return
+
+	log_reply(result, reply)
+
+# Logs the reply of the coordinator to a result if it was not taken
+def log_reply(result, reply):
+	if reply.get('type') == 'error':
+		log(Severity.ERROR, f'Coordinator rejected the result of farm job {result["job_id"]}: {reply.get("error")}')
+	elif reply.get('accepted') == False:
+		log(Severity.INFO, f'Coordinator dropped the result of farm job {result["job_id"]} (attempt {result["attempt"]}); the job was handed out again.')
+
+# Called by the local encode pool once ffmpeg exits. The encode of the attempt is renamed to
+# the encoded file if it succeeded, otherwise it is removed.
+def encode_complete(job):
+	with farm_jobs_lock:
+		farm_job = farm_jobs.pop(job, None)
+
+	if farm_job == None:
+		return
+
+	job_id, attempt, encoded_file_full_path = farm_job
+	if job.returncode == 0:
+		try:
+			os.replace(job.encoded_file_full_path, encoded_file_full_path)
+		except OSError as error:
+			job.returncode = -1
+			job.error_msg = [f'Unable to rename {job.encoded_file_full_path} to {encoded_file_full_path} ({error}).']
+
+	if job.returncode == 0:
+		log(Severity.INFO, [f'COMPLETED FARM JOB {job_id}: {job.source_file_full_path}', f'Time Elapsed: {str(job.elapsed_time())}'])
+	else:
+		if os.path.exists(job.encoded_file_full_path):
+			os.remove(job.encoded_file_full_path)
+		log(Severity.ERROR, [f'FARM JOB {job_id} FAILED: {job.source_file_full_path}'] + job.error_msg)
+
+	send_result({'type' : 'result', 'job_id' : job_id, 'attempt' : attempt, 'returncode' : job.returncode, 'error_msg' : job.error_msg})
+
+# Sends a heartbeat (with the progress of the jobs being encoded) every lease_seconds / 3
+# and kills the jobs the coordinator cancelled.
+def heartbeat_loop():
+	while True:
+		time.sleep(max((connection.lease_seconds or 30) / 3, 1))
+		try:
+			while True:
+				with unsent_results_lock:
+					if not unsent_results:
+						break
+					result = unsent_results[0]
+				reply = connection.call(result)
+				with unsent_results_lock:
+					unsent_results.remove(result)
+				log_reply(result, reply)
+
+			jobs = []
+			for job in encode_pool.active_jobs():
+				with farm_jobs_lock:
+					farm_job = farm_jobs.get(job)
+				if farm_job != None:
+					jobs.append({'job_id' : farm_job[0], 'attempt' : farm_job[1], 'progress' : job.progress.to_dict() if job.progress != None else {}})
+
+			reply = connection.call({'type' : 'heartbeat', 'jobs' : jobs})
+		except (OSError, ValueError) as error:
+			log(Severity.ERROR, f'Unable to send heartbeat to the coordinator ({error}).')
+			continue
+
+		if reply.get('type') == 'error':
+			log(Severity.ERROR, f'Coordinator rejected the heartbeat: {reply.get("error")}')
+			continue
+
+		for cancel in reply.get('cancel', []):
+			with farm_jobs_lock:
+				jobs = [job for job, farm_job in farm_jobs.items() if (farm_job[0], farm_job[1]) == (cancel.get('job_id'), cancel.get('attempt'))]
+			for job in jobs:
+				log(Severity.INFO, f'Coordinator cancelled farm job {cancel.get("job_id")} (attempt {cancel.get("attempt")}): {job.source_file_full_path}')
+				encode_pool.kill(job.source_file_full_path)
+
+### FUNCTIONS ###
+
+### MAIN ###
+config = ConfigParser()
+config.read(config_path)
+farm_config = config['Farm'] if config.has_section('Farm') else config['DEFAULT']
+
+coordinator = farm_config.get('coordinator', None)
+worker_name = f'{socket.gethostname()}-{os.getpid()}'
+slots = farm_config.getint('worker_slots', 1)
+# Defaults to a directory of its own (by worker name) so workers on the same host don't remove each other's partial encodes
+worker_working_dir = None
+
+try:
+	opts, args = getopt(sys.argv[1:], 'c:n:s:w:', ['coordinator=', 'name=', 'slots=', 'working_dir='])
+	for opt, arg in opts:
+		if opt in ('-c', '--coordinator'):
+			coordinator = arg
+		elif opt in ('-n', '--name'):
+			worker_name = arg
+		elif opt in ('-s', '--slots'):
+			slots = int(arg)
+		elif opt in ('-w', '--working_dir'):
+			worker_working_dir = arg
+except (GetoptError, ValueError):
+	usage()
+	sys.exit(2)
+
+if not coordinator:
+	usage()
+	sys.exit(2)
+
+if worker_working_dir == None:
+	worker_working_dir = f'/tmp/automated_ffmpeg/farm_working_{worker_name.replace(os.sep, "_")}'
+
+threads = farm_config.getint('worker_threads', 0)
+if (threads <= 0) and (slots > 1):
+	threads = max(os.cpu_count() // slots, 1)
+
+tz = config['Logger'].get('timezone', 'US/Central') if config.has_section('Logger') else 'US/Central'
+os.umask(0)
+os.makedirs('/tmp/automated_ffmpeg', mode=0o777, exist_ok=True)
+logger = SimpleLogger(pytz.timezone(tz), f'/tmp/automated_ffmpeg/farm_worker_{worker_name}.log')
+
+for sig in (SIGABRT, SIGALRM, SIGBUS, SIGILL, SIGINT, SIGTERM):
+	signal(sig, exit_cleanup)
+
+try:
+	removed_files = remove_partial_encodes(worker_working_dir)
+	if removed_files:
+		log(Severity.INFO, ['Deleted partially encoded movie(s) from previous run.'] + removed_files)
+except Exception as error:
+	log(Severity.ERROR, ['Error deleting previous working movie(s) or working files.'] + traceback.format_exc().split('\n'))
+
+poll_interval = farm_config.getint('worker_poll_interval', 30)
+connection = FarmConnection(coordinator, worker_name, farm_config.get('token', None) or None)
+encode_pool = EncodeWorkerPool(slots, worker_working_dir, encode_complete, error_lines=farm_config.getint('error_log_lines', 200))
+threading.Thread(target=heartbeat_loop, name='farm_heartbeat', daemon=True).start()
+
+log(Severity.INFO, [f'FARM WORKER {worker_name} INITIALIZED.', f'COORDINATOR: {coordinator}', f'SLOTS: {slots}', f'WORKING DIR: {worker_working_dir}'])
+
+# Pull jobs while there is a free slot
+while True:
+	if len(encode_pool.active_jobs()) >= slots:
+		time.sleep(1)
+		continue
+
+	try:
+		reply = connection.call({'type' : 'request_job'})
+	except (OSError, ValueError) as error:
+		log(Severity.ERROR, f'Unable to reach the coordinator at {coordinator} ({error}). Retrying in {poll_interval} seconds.')
+		time.sleep(poll_interval)
+		continue
+
+	if reply.get('type') != 'job':
+		time.sleep(poll_interval)
+		continue
+
+	# The command is built here from the job's encode data, never taken from the coordinator.
+	# It encodes to a file of this attempt that is renamed once the encode succeeded (see encode_complete).
+	cmd, attempt_path, msg = build_farm_job_command(reply, threads)
+	if cmd == None:
+		log(Severity.ERROR, [f'FARM JOB {reply.get("job_id")} REJECTED: {reply.get("source")}', msg])
+		if is_job_attempt(reply) == True:
+			send_result({'type' : 'result', 'job_id' : reply['job_id'], 'attempt' : reply['attempt'], 'returncode' : -1, 'error_msg' : [f'Farm worker {worker_name} rejected the job.', msg]})
+		continue
+
+	job = EncodeJob(reply['source'], attempt_path, cmd)
+	job.progress = EncodeProgress(reply.get('duration_seconds'))
+	with farm_jobs_lock:
+		farm_jobs[job] = (reply['job_id'], reply['attempt'], reply['encoded'])
+	log(Severity.INFO, [f'STARTING FARM JOB {reply["job_id"]} (attempt {reply["attempt"]}): {job.source_file_full_path}', f'FFMPEG CMD: {job.cmd}'])
+	encode_pool.submit(job)
+
+### MAIN ###
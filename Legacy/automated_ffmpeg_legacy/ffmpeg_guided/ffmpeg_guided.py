@@ -1,3 +1,4 @@
+from collections import deque
 from colorama import init
 from configparser import ConfigParser
 from datetime import datetime as dt
@@ -9,10 +10,14 @@ from stat import *
 from subprocess import Popen
 import subprocess
 import sys
+import threading
 import traceback
 import xml.etree.ElementTree as ET
 
+from analysis_cache import *
+from copy_engine import *
 from encode_data import *
+from ffmpeg_progress import *
 from ffmpeg_tools_utilities import *
 from list_builders import *
 from plex_interactor import *
@@ -37,37 +42,50 @@ config_lookup = {
 }
 
 current_working_file = None
+# Copies the encoded files to plex in the background (None if plex is not enabled)
+copy_engine = None
 ### GLOBALS ###
 ### FUNCTIONS ###
 def usage():
 	print(f'Usage: python3 {sys.argv[0]} [-m movie | -t tv_show | -a anime | -am anime_movie]')
 
-def run_encode_command(cmd, current_file):
+# Runs the ffmpeg command, showing its live progress (-progress output on stdout) on one line.
+# duration_seconds (of the source) is used for the percent/ETA.
+def run_encode_command(cmd, current_file, duration_seconds=None):
 	global current_working_file
 
 	current_working_file = current_file
 	start_time = dt.now()
-	map_flag = False
-	with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, bufsize=1, universal_newlines=True, shell=True) as p:
-		for line in p.stdout:
+	stderr_tail = deque(maxlen=200)
+
+	# Prints the stream mapping section of ffmpeg's output and keeps the tail of the rest for errors
+	def read_stderr(stderr):
+		map_flag = False
+		for line in stderr:
 			print_line = line.strip('\n')
 			if 'Stream mapping:' in line:
 				print(print_line)
 				map_flag = True
 			elif map_flag and 'Stream #' in line:
 				print(print_line)
-			elif map_flag and 'Stream #' not in line:
-				map_flag = False
-			elif line.startswith('frame='):
-				print(print_line, end='\r', flush=True)
 			else:
-				continue
+				map_flag = False
+				if not line.startswith(FFMPEG_STATUS_PREFIXES):
+					stderr_tail.append(line)
+
+	progress = EncodeProgress(duration_seconds)
+	with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, bufsize=1, universal_newlines=True, shell=True) as p:
+		stderr_reader = threading.Thread(target=read_stderr, args=(p.stderr,), daemon=True)
+		stderr_reader.start()
+		read_progress(p.stdout, progress, lambda updated: print(updated.summary().ljust(120), end='\r', flush=True))
+		stderr_reader.join()
+	print()
 
 	stop_time = dt.now()
 	current_working_file = None
 
 	if p.returncode != 0:
-		error_msg = p.stderr.decode('utf-8')
+		error_msg = ''.join(stderr_tail)
 		error(f'Error running ffmpeg for {current_file}. Details below.', False)
 		error(error_msg, False)
 		p = None
@@ -76,53 +94,50 @@ def run_encode_command(cmd, current_file):
 	elapsed_time = stop_time - start_time
 	return elapsed_time
 
+# Starts copying the encoded file over to its plex directory in the background (see copy_engine),
+# so the next episode can be encoded in the meantime.
+# Returns: CopyTask (None if the plex directory couldn't be created)
 def copy_to_plex(file, dest_dir, plex_dir):
-	copy_count = 0
 	plex_dest = file.replace(dest_dir, plex_dir).replace(os.path.basename(file), '')
 	try:
 		os.umask(0)
 		os.makedirs(plex_dest, mode=0o777, exist_ok=True)
-	except Exception as error:
-		error(f'Failed to create plex directory: {plex_dest}. Not copying to plex directory.', False)
-		return copy_count
-
-	try:
-		shutil.copy2(file, plex_dest)
-		copy_count += 1
-	except Exception as error:
-		msg = [f'Error copying {file} to {plex_dest} (Details below).'] + traceback.format_exc().split('\n')
-		error(msg, False)
-	else:
-		info(f'Successfully copied {file} to {plex_dest}')
+	except Exception:
+		error(f'Failed to create plex directory: {plex_dest}. Not copying {file} to plex directory.', False)
+		return None
 
-	return copy_count
+	return copy_engine.submit(file, plex_dest)
 
-def copy_to_plex_list(file_list, dest_dir, plex_dir):
+# Waits for the copies started by copy_to_plex (None for the ones that couldn't be started)
+# Returns: Number of files copied
+def wait_for_plex_copies(copy_tasks):
 	copy_count = 0
-	plex_dest = file_list[0].replace(dest_dir, plex_dir).replace(os.path.basename(file_list[0]), '')
-	try:
-		os.umask(0)
-		os.makedirs(plex_dest, mode=0o777, exist_ok=True)
-	except Exception as error:
-		error(f'Failed to create plex directory: {plex_dest}. Not copying to plex directory.', False)
-		return copy_count
+	for task in copy_tasks:
+		if task == None:
+			continue
 
-	for file in file_list:
-		try:
-			shutil.copy2(file, plex_dest)
+		plex_dest = os.path.dirname(task.dest)
+		if task.wait() == True:
 			copy_count += 1
-		except Exception as error:
-			msg = [f'Error copying {file} to {plex_dest} (Details below).'] + traceback.format_exc().split('\n')
-			error(msg, False)
-			continue
+			info(f'Successfully copied {task.source} to {plex_dest}')
 		else:
-			info(f'Successfully copied {file} to {plex_dest}')
+			msg = [f'Error copying {task.source} to {plex_dest} (Details below).'] + task.error
+			error(msg, False)
 
 	return copy_count
 
+# Copies the files over to their plex directory (several at a time)
+# Returns: Number of files copied
+def copy_to_plex_list(file_list, dest_dir, plex_dir):
+	return wait_for_plex_copies([copy_to_plex(file, dest_dir, plex_dir) for file in file_list])
+
 def exit_cleanup(*args):
 	global current_working_file
 
+	# Don't leave partially copied files in the plex directory
+	if copy_engine != None:
+		copy_engine.cancel_all()
+
 	if current_working_file == None:
 		print('\n## Program exited/terminated. Cleaning up. ##')
 	else:
@@ -163,6 +178,16 @@ config.read(config_path)
 
 plex_enabled = config['DEFAULT'].getboolean('plex_enabled', False)
 
+# Crop/scan analysis settings
+analysis_settings = load_analysis_settings(config)
+
+# Analysis cache (shared with automated_ffmpeg)
+analysis_cache = None
+if config['DEFAULT'].getboolean('analysis_cache_enabled', True) == True:
+	analysis_cache, msg = open_analysis_cache(config['DEFAULT'].get('analysis_cache', None), get_analysis_settings_key(analysis_settings))
+	if analysis_cache == None:
+		warning(msg)
+
 config_field, video_type, option_str = config_lookup.get(opt, None)
 if config_field == None:
 	error(f'Unable to find directories in {config_path} for option {opt}. Exiting.')
@@ -182,7 +207,13 @@ if plex_enabled == True:
 		plex_baseurl = config['Plex']['baseurl']
 		plex_token = config['Plex']['token']
 
-		plex_interact = PlexInteractor(plex_baseurl, plex_token)
+		plex_interact = PlexInteractor(plex_baseurl, plex_token, config['Plex'].getint('timeout', 30))
+		plex_partial_scan = config['Plex'].getboolean('partial_scan', True)
+		plex_scan_wait = config['Plex'].getint('scan_wait', 0)
+		plex_scan_poll_interval = max(config['Plex'].getint('scan_poll_interval', 2), 1)
+
+		copy_engine = CopyEngine(config['DEFAULT'].getint('copy_workers', 2), config['DEFAULT'].getint('copy_buffer_mb', 64) * 1024 * 1024,
+			int(config['DEFAULT'].getfloat('copy_max_mb_per_second', 0) * 1000000))
 	except Exception as error:
 		msg = ['Error getting Plex info from config file. Exiting.'] + traceback.format_exc().split('\n')
 		error(msg)
@@ -217,12 +248,14 @@ elif video_type == VideoType.SHOW:
 		if is_ready == False:
 			error(msg)
 		info('First episode is ready.')
-		encode_data, msg = select_encoding_options(episodes[0])
+		encode_data, msg = select_encoding_options(episodes[0], analysis_cache, analysis_settings)
 		if encode_data == None:
 			if msg != None:
 				error(msg)
 
 		encoded_file_path_list = []
+		# Each episode is copied to plex while the next one encodes
+		copy_tasks = []
 
 		for episode in episodes:
 			is_ready, msg = check_file_ready(episode)
@@ -240,27 +273,33 @@ elif video_type == VideoType.SHOW:
 
 			info(f'STARTED ENCODING FOR {episode}')
 			info(f'CMD USED: {cmd}\n')
-			elapsed_time = run_encode_command(cmd, episode)
+			elapsed_time = run_encode_command(cmd, episode, encode_data.duration_seconds)
 			if elapsed_time != None:
 				encoded_file_path_list.append(encoded_file_path)
+				if plex_enabled == True:
+					copy_tasks.append(copy_to_plex(encoded_file_path, destination_dir, plex_dir))
 				info(f'COMPLETED ENCODING FOR {episode}', complete=True)
 				info(f'TIME ELAPSED: {str(elapsed_time)}')
 
 		info(f'COMPLETED ENCODING WHOLE SEASON', complete=True)
 
 		if plex_enabled == True:
-			copy_count = copy_to_plex_list(encoded_file_path_list, destination_dir, plex_dir)
+			copy_count = wait_for_plex_copies(copy_tasks)
 			# If the returned count does not equal the length of the list passed, something went
 			# wrong and we won't update plex
 			if copy_count == len(encoded_file_path_list):
 				info(f'Successfully copied all files to plex destination.', complete=True)
+				# Only scan the season's directory (where copy_to_plex_list put the episodes)
+				plex_paths = [os.path.dirname(encoded_file_path_list[0].replace(destination_dir, plex_dir))] if (plex_partial_scan == True) and encoded_file_path_list else []
 				try:
-					plex_interact.update(plex_section)
+					scan_seconds = plex_interact.update(plex_section, plex_paths, plex_scan_wait, plex_scan_poll_interval)
 				except Exception as error:
 					msg = [f'Failed to update Plex Server.', f'Server URL: {plex_baseurl}', f'Section: {plex_section}'] + traceback.format_exc().split('\n')
 					error(msg)
 				else:
-					msg = f'Updated Plex Server. Server URL: {plex_baseurl} | Section: {plex_section}'
+					msg = f'Updated Plex Server. Server URL: {plex_baseurl} | Section: {plex_section}' + (f' | Path: {plex_paths[0]}' if plex_paths else '')
+					if scan_seconds != None:
+						msg += f' | Scan took {scan_seconds:.1f}s'
 					info(msg)
 			else:
 				error(f'Only {copy_count} out of {len(encoded_file_path_list)} files copied. Plex will not be updated.', False)
@@ -272,7 +311,7 @@ elif video_type == VideoType.SHOW:
 			error(msg)
 
 		info(f'Episode {episode} is ready.')
-		encode_data, msg = select_encoding_options(episode)
+		encode_data, msg = select_encoding_options(episode, analysis_cache, analysis_settings)
 		if encode_data == None:
 			if msg != None:
 				error(msg)
@@ -285,7 +324,7 @@ elif video_type == VideoType.SHOW:
 
 		info(f'STARTED ENCODING FOR {episode}')
 		info(f'CMD USED: {cmd}\n')
-		elapsed_time = run_encode_command(cmd, episode)
+		elapsed_time = run_encode_command(cmd, episode, encode_data.duration_seconds)
 		if elapsed_time != None:
 			info(f'COMPLETED ENCODING FOR {episode}', complete=True)
 			info(f'TIME ELAPSED: {str(elapsed_time)}', complete=True)
@@ -24,7 +24,7 @@ def __select_video_options(video_stream_data, source_file_path):
 		'RESOLUTION' : video_stream_data.orig_resolution,
 		'CROP' : video_stream_data.crop,
 		'HDR' : video_stream_data.hdr != None,
-		'SCAN' : video_stream_data.scan.name
+		'SCAN' : video_stream_data.scan.name if video_stream_data.scan_confidence == None else f'{video_stream_data.scan.name} ({video_stream_data.scan_confidence:.1%})'
 	}
 	print_formatted_info(50, 'VIDEO DATA', source_file, video_details)
 
@@ -174,34 +174,39 @@ def select_show_season_episode(show_path):
 		episode_path = f'{season_path}/{episode}'
 		return episode_path
 
-def select_encoding_options(file_path):
+def select_encoding_options(file_path, analysis_cache=None, analysis_settings=None):
 	msg = None
-	xml_file_path, msg = create_video_data_xml(file_path)
+	stream_data = analysis_cache.get_stream_data(file_path) if analysis_cache != None else None
 
-	if xml_file_path == None:
-		return (None, msg)
+	if stream_data != None:
+		info(f'Using cached stream data for {file_path}')
+	else:
+		probe, msg = probe_video_data(file_path)
+
+		if probe == None:
+			return (None, msg)
+
+		info(msg)
+		info('Building Stream Data')
+
+		stream_data, msg = build_stream_data(probe, file_path, analysis_cache, analysis_settings)
 
-	info(msg)
-	info('Building Stream Data')
+		if stream_data == None:
+			return (None, msg)
+
+		if analysis_cache != None:
+			analysis_cache.set_stream_data(file_path, stream_data)
 
-	stream_data = build_stream_data(xml_file_path, file_path)
 	encode_data = EncodeData()
 	encode_data.source_file_full_path = file_path
+	encode_data.duration_seconds = stream_data.duration_seconds
+	encode_data.start_seconds = stream_data.start_seconds
 	encode_data.video_data = __select_video_options(stream_data.video_stream, stream_data.source_file_full_path)
 	encode_data.audio_data = __select_audio_options(stream_data.audio_streams, stream_data.source_file_full_path)
 	subtitle, subtitle_forced = __select_subtitle_options(stream_data.subtitle_streams, stream_data.source_file_full_path)
 	encode_data.subtitle_data = subtitle
 	encode_data.subtitle_forced_data = subtitle_forced
 
-	# DELETE XML
-	try:
-		os.remove(xml_file_path)
-	except OSError as error:
-		error(f'Error deleting {xml_file_path}', False)
-		print(error)
-	else:
-		info(f'Deleted {xml_file_path}')
-
 	return (encode_data, msg)
 
 # Print info function
@@ -5,7 +5,8 @@
 # to /usr/local/bin
 
 arg=$1
-auto_ffmpeg_files=(./automated_ffmpeg.py ./Common/encode_data.py ./Common/ffmpeg_tools_utilities.py ./Common/list_builders.py ./Common/simple_logger.py ./plex_interactor/plex_interactor.py)
+auto_ffmpeg_files=(./automated_ffmpeg.py ./encode_history_report.py ./trace_summary.py ./Common/analysis_cache.py ./Common/chunked_encode.py ./Common/copy_engine.py ./Common/directory_watcher.py ./Common/encode_data.py ./Common/encode_farm.py ./Common/encode_history.py ./Common/encode_jobs.py ./Common/encode_scheduler.py ./Common/ffmpeg_progress.py ./Common/ffmpeg_tools_utilities.py ./Common/library_catalog.py ./Common/list_builders.py ./Common/metrics.py ./Common/probe_model.py ./Common/simple_logger.py ./Common/tracing.py ./Common/video_analysis.py ./plex_interactor/plex_interactor.py)
+farm_worker_files=(./farm_worker.py ./Common/encode_data.py ./Common/encode_farm.py ./Common/encode_jobs.py ./Common/ffmpeg_progress.py ./Common/ffmpeg_tools_utilities.py ./Common/metrics.py ./Common/probe_model.py ./Common/simple_logger.py ./Common/tracing.py ./Common/video_analysis.py)
 
 if [[ $arg = "automated_ffmpeg" ]]
 then
@@ -17,10 +18,19 @@ then
 	done
 	echo "##### Completed installing automated_ffmpeg #####"
 	echo -e "Make sure to run this command: systemctl daemon-reload\n"
+elif [[ $arg = "farm_worker" ]]
+then
+	echo -e "\n##### Installing farm_worker #####"
+	for file in ${farm_worker_files[*]}
+	do
+		cp "$file" /usr/local/bin
+		echo "Copied $file to /usr/local/bin"
+	done
+	echo -e "##### Completed installing farm_worker #####\n"
 elif [[ $arg = "ffmpeg" ]]
 then
 	echo "Installing ffmpeg"
 	sh ./ffmpeg_build/ffmpeg_build.sh
 else
-	echo "Usage: bash install.sh [automated_ffmpeg | ffmpeg]"
+	echo "Usage: bash install.sh [automated_ffmpeg | farm_worker | ffmpeg]"
 fi
\ No newline at end of file
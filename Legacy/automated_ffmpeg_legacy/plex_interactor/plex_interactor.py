@@ -1,27 +1,216 @@
 # Requires python plexapi (https://github.com/pkkid/python-plexapi)
 # Install: pip3 install plexapi
 
+import os
+import threading
+import time
+import traceback
+
 from plexapi.server import PlexServer
+import requests
+
+#### DICTIONARIES/STATICS ####
+# More paths than this waiting for a section are scanned with one update of the whole section
+PARTIAL_SCAN_MAX_PATHS = 25
 
+#### DICTIONARIES/STATICS ####
+
+#### CLASSES ####
+# Class: PlexInteractor
+# Description: Talks to a plex server. The server (and the HTTP session under it, which keeps the
+# connection alive) is connected to once and reused by every call, as are the library sections.
+# If a call fails because the connection went away, it connects again and retries once.
+# baseurl can be any server that speaks the plex API (e.g. a local stand-in for testing).
 class PlexInteractor:
-	def __init__(self, baseurl, token):
+	def __init__(self, baseurl, token, timeout=30, session=None):
 		self.baseurl = baseurl
 		self.token = token
+		self.timeout = timeout
+		self.session = session if session != None else requests.Session()
+		self.lock = threading.Lock()
+		self.server = None
+		self.sections = {}
 
-	# Connect to plex server
+	# Connect to plex server (only the first time, or after reset)
 	# Return: PlexServer Instance
 	def __get_server(self):
-		plex = PlexServer(self.baseurl, self.token)
-		return plex
+		with self.lock:
+			if self.server == None:
+				self.server = PlexServer(self.baseurl, self.token, session=self.session, timeout=self.timeout)
+			return self.server
+
+	# Return: LibrarySection of the given section title (only looked up the first time)
+	def __get_section(self, section):
+		with self.lock:
+			library_section = self.sections.get(section)
+
+		if library_section == None:
+			library_section = self.__get_server().library.section(section)
+			with self.lock:
+				self.sections[section] = library_section
+
+		return library_section
+
+	# Runs call, connecting again and retrying once if the connection failed
+	# Return: Whatever call returns
+	def __call(self, call):
+		try:
+			return call()
+		except requests.exceptions.RequestException:
+			self.reset()
+			return call()
 
-	# Calls plex library update which scans for new files 
-	# in that library section (or deleted files)
-	def update(self, section):
-		plex = self.__get_server()
-		plex.library.section(section).update()
+	# Drops the connection and the looked up sections (the next call connects again)
+	def reset(self):
+		with self.lock:
+			self.server = None
+			self.sections = {}
+
+	# Returns: True if plex is scanning the library section
+	def is_refreshing(self, section):
+		key = str(self.__call(lambda: self.__get_section(section)).key)
+		data = self.__call(lambda: self.__get_server().query('/library/sections'))
+		for directory in data:
+			if directory.get('key') == key:
+				return directory.get('refreshing') == '1'
+
+		return False
+
+	# Calls plex library update which scans for new files (or deleted files) in that library
+	# section. If paths are given, only those directories (under the folders of the section, as
+	# plex sees them) are scanned. If wait_seconds > 0, polls every poll_seconds until plex is done
+	# scanning (up to wait_seconds).
+	# Returns: Seconds the scan took. None if not waited for, or if plex was not seen scanning and then done
+	# (finished before the first poll, never started or still scanning after wait_seconds).
+	def update(self, section, paths=None, wait_seconds=0, poll_seconds=2):
+		start = time.monotonic()
+		if paths:
+			for path in paths:
+				self.__call(lambda: self.__get_section(section).update(path=path))
+		else:
+			self.__call(lambda: self.__get_section(section).update())
+
+		if wait_seconds <= 0:
+			return None
+
+		started = False
+		while time.monotonic() - start < wait_seconds:
+			time.sleep(poll_seconds)
+			if self.is_refreshing(section) == True:
+				started = True
+			elif started == True:
+				return time.monotonic() - start
+			elif time.monotonic() - start >= poll_seconds * 2:
+				# Plex can take a moment to start the scan; not scanning after two polls means it was
+				# already done (or never started), so how long it took is unknown
+				return None
+
+		return None
 
 	# Cleans bundles and empties trash of given section
 	def clean(self, section):
-		plex = self.__get_server()
-		plex.library.cleanBundles()
-		plex.libary.section(section).emptyTrash()
+		self.__call(lambda: self.__get_server().library.cleanBundles())
+		self.__call(lambda: self.__get_section(section).emptyTrash())
+
+# Class: PlexRefreshQueue
+# Description: Debounces library updates. Every update requested for a section within window_seconds
+# of its first request is merged into one PlexInteractor.update call, made on a background thread.
+# The update only scans the paths that were requested (partial_scan), unless one request was for the
+# whole section or more than PARTIAL_SCAN_MAX_PATHS paths are waiting. With wait_seconds > 0 the thread
+# waits for plex to finish scanning (see PlexInteractor.update) before the next update.
+# on_refresh(section, movies, paths, start, end, scan_seconds, error) is called after each update with the
+# movies of the requests merged (one entry per request, None if not given), the paths scanned (empty for the whole section), the start/end time (epoch seconds),
+# how long plex took to scan (None if not waited for/unknown, see PlexInteractor.update) and error (None, or the traceback lines if it failed).
+class PlexRefreshQueue:
+	def __init__(self, interactor, window_seconds=60, on_refresh=None, partial_scan=True, wait_seconds=0, poll_seconds=2):
+		self.interactor = interactor
+		self.window_seconds = max(window_seconds, 0)
+		self.on_refresh = on_refresh
+		self.partial_scan = partial_scan
+		self.wait_seconds = wait_seconds
+		self.poll_seconds = max(poll_seconds, 1)
+		self.condition = threading.Condition()
+		# section => [time it is due (time.monotonic()), movies of the requests merged, set of paths (None = whole section)]
+		self.pending = {}
+		self.stopping = False
+		self.thread = threading.Thread(target=self.__run, name='plex_refresh', daemon=True)
+		self.thread.start()
+
+	# Queues an update of the path of the section (the whole section if path is None), merged with
+	# the one already waiting, if any. movie is the movie the update is for (passed on to on_refresh).
+	def request(self, section, path=None, movie=None):
+		path = os.path.normpath(path) if (path != None) and (self.partial_scan == True) else None
+		with self.condition:
+			pending = self.pending.get(section)
+			if pending == None:
+				self.pending[section] = [time.monotonic() + self.window_seconds, [movie], {path} if path != None else None]
+				self.condition.notify()
+				return
+
+			pending[1].append(movie)
+			if (path == None) or (pending[2] == None):
+				pending[2] = None
+			else:
+				pending[2].add(path)
+				if len(pending[2]) > PARTIAL_SCAN_MAX_PATHS:
+					pending[2] = None
+
+	# Returns: Number of sections waiting to be updated
+	def pending_count(self):
+		with self.condition:
+			return len(self.pending)
+
+	# Updates every waiting section right away (on the calling thread)
+	def flush(self):
+		with self.condition:
+			due = [(section, pending[1], pending[2]) for section, pending in self.pending.items()]
+			self.pending.clear()
+
+		for section, movies, paths in due:
+			self.__refresh(section, movies, paths)
+
+	# Stops the background thread and updates the sections that are still waiting
+	def close(self):
+		with self.condition:
+			self.stopping = True
+			self.condition.notify()
+		self.thread.join()
+		self.flush()
+
+	def __run(self):
+		while True:
+			with self.condition:
+				while True:
+					if self.stopping == True:
+						return
+
+					now = time.monotonic()
+					due = [section for section, pending in self.pending.items() if pending[0] <= now]
+					if due:
+						break
+
+					timeout = min(pending[0] for pending in self.pending.values()) - now if self.pending else None
+					self.condition.wait(timeout)
+
+				refreshes = [(section, *self.pending.pop(section)[1:]) for section in due]
+
+			for section, movies, paths in refreshes:
+				self.__refresh(section, movies, paths)
+
+	def __refresh(self, section, movies, paths):
+		paths = sorted(paths) if paths != None else []
+		start = time.time()
+		scan_seconds = None
+		error = None
+		try:
+			scan_seconds = self.interactor.update(section, paths, self.wait_seconds, self.poll_seconds)
+		except Exception:
+			error = traceback.format_exc().split('\n')
+
+		if self.on_refresh != None:
+			try:
+				self.on_refresh(section, movies, paths, start, time.time(), scan_seconds, error)
+			except Exception:
+				pass
+
+#### CLASSES ####
@@ -0,0 +1,163 @@
+from argparse import ArgumentParser
+import json
+import sys
+
+#### DICTIONARIES/STATICS ####
+PERCENTILES = (50, 90, 95, 99)
+
+#### DICTIONARIES/STATICS ####
+
+### FUNCTIONS ####
+# Reads the spans of JSONL trace files (written by automated_ffmpeg, see Common/tracing.py).
+# Lines that aren't valid spans (e.g. cut off by a crash) are skipped.
+# Returns: Tuple(list of span dicts, number of skipped lines)
+def read_spans(paths):
+	spans = []
+	skipped = 0
+	for path in paths:
+		with open(path, 'r', encoding='utf-8') as trace_file:
+			for line in trace_file:
+				if not line.strip():
+					continue
+				try:
+					span = json.loads(line)
+					span['seconds'] = float(span['seconds'])
+					span['stage']
+				except (ValueError, KeyError, TypeError):
+					skipped += 1
+					continue
+				spans.append(span)
+
+	return (spans, skipped)
+
+# Returns: The pct percentile (0 - 100) of sorted_values, linearly interpolated
+def percentile(sorted_values, pct):
+	if not sorted_values:
+		return None
+
+	rank = (len(sorted_values) - 1) * pct / 100
+	lower = int(rank)
+	upper = min(lower + 1, len(sorted_values) - 1)
+	return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+# Returns: Dict of stage => summary (count, failures, total/max/percentile seconds, bytes, MB/s)
+def summarize(spans):
+	stages = {}
+	for span in spans:
+		stages.setdefault(span['stage'], []).append(span)
+
+	summary = {}
+	for stage, stage_spans in stages.items():
+		seconds = sorted(span['seconds'] for span in stage_spans)
+		sized = [span for span in stage_spans if span.get('bytes')]
+		sized_seconds = sum(span['seconds'] for span in sized)
+		summary[stage] = {
+			'count' : len(stage_spans),
+			'failures' : len([span for span in stage_spans if span.get('outcome', 'ok') != 'ok']),
+			'total_seconds' : sum(seconds),
+			'max_seconds' : seconds[-1],
+			'percentiles' : {str(pct) : percentile(seconds, pct) for pct in PERCENTILES},
+			'bytes' : sum(span['bytes'] for span in sized),
+			'mb_per_second' : (sum(span['bytes'] for span in sized) / 1000000 / sized_seconds) if sized_seconds > 0 else None,
+		}
+
+	return summary
+
+# Spans of a batch of movies (a plex_update lists its movies) count for every movie of the batch.
+# Returns: Dict of title (movie) => Dict(total_seconds, stages : Dict of stage => seconds)
+def summarize_titles(spans):
+	titles = {}
+	for span in spans:
+		movies = span.get('movies')
+		for title in (movies if isinstance(movies, list) else [span.get('title', '')]):
+			title_summary = titles.setdefault(title, {'total_seconds' : 0.0, 'stages' : {}})
+			title_summary['total_seconds'] += span['seconds']
+			title_summary['stages'][span['stage']] = title_summary['stages'].get(span['stage'], 0.0) + span['seconds']
+
+	return titles
+
+# Returns: Time formatted as seconds (or h:mm:ss once over a minute)
+def format_seconds(seconds):
+	if seconds == None:
+		return '-'
+	if seconds < 60:
+		return f'{seconds:.3f}s'
+
+	seconds = int(seconds)
+	return f'{seconds // 3600}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}'
+
+def print_summary(summary, spans, slowest, titles=0):
+	# Stages in the order they first ran
+	order = []
+	for span in sorted(spans, key=lambda span: span.get('start', 0)):
+		if span['stage'] not in order:
+			order.append(span['stage'])
+
+	header = f'{"STAGE":<22}{"COUNT":>7}{"FAILED":>8}{"TOTAL":>12}' + ''.join(f'{"P" + str(pct):>11}' for pct in PERCENTILES) + f'{"MAX":>11}{"MB/s":>9}'
+	print(header)
+	print('-' * len(header))
+	for stage in order:
+		stage_summary = summary[stage]
+		mb_per_second = stage_summary['mb_per_second']
+		print(f'{stage:<22}{stage_summary["count"]:>7}{stage_summary["failures"]:>8}{format_seconds(stage_summary["total_seconds"]):>12}'
+			+ ''.join(f'{format_seconds(stage_summary["percentiles"][str(pct)]):>11}' for pct in PERCENTILES)
+			+ f'{format_seconds(stage_summary["max_seconds"]):>11}' + (f'{mb_per_second:>9.1f}' if mb_per_second != None else f'{"-":>9}'))
+
+	if slowest > 0:
+		print(f'\nSLOWEST {slowest} SPANS:')
+		for span in sorted(spans, key=lambda span: span['seconds'], reverse=True)[:slowest]:
+			print(f'{format_seconds(span["seconds"]):>11}  {span["stage"]:<22}{span.get("outcome", "ok"):<8}{span.get("title", "")}')
+
+	if titles > 0:
+		print(f'\nSLOWEST {titles} TITLES:')
+		title_summaries = summarize_titles(spans)
+		for title in sorted(title_summaries, key=lambda title: title_summaries[title]['total_seconds'], reverse=True)[:titles]:
+			title_summary = title_summaries[title]
+			print(f'{format_seconds(title_summary["total_seconds"]):>11}  {title}')
+			for stage in order:
+				if stage in title_summary['stages']:
+					print(f'{"":>13}{format_seconds(title_summary["stages"][stage]):>11}  {stage}')
+
+def main():
+	parser = ArgumentParser(description='Per stage timing percentiles of automated_ffmpeg trace files (trace_file in the config).')
+	parser.add_argument('trace_files', nargs='+', help='JSONL trace file(s)')
+	parser.add_argument('--stages', nargs='+', help='Only summarize these stages')
+	parser.add_argument('--since', type=float, default=None, help='Only spans that started within this many hours of the last span')
+	parser.add_argument('--slowest', type=int, default=0, help='Also list the slowest spans')
+	parser.add_argument('--titles', type=int, default=0, help='Also list the titles (movies) with the most time spent on them, by stage')
+	parser.add_argument('--json', action='store_true', help='Print the summary as JSON')
+	args = parser.parse_args()
+
+	try:
+		spans, skipped = read_spans(args.trace_files)
+	except OSError as error:
+		print(f'Unable to read trace file: {error}', file=sys.stderr)
+		sys.exit(1)
+
+	if args.stages:
+		spans = [span for span in spans if span['stage'] in args.stages]
+	if args.since != None:
+		latest = max((span.get('start', 0) for span in spans), default=0)
+		spans = [span for span in spans if span.get('start', 0) >= latest - (args.since * 3600)]
+
+	if skipped > 0:
+		print(f'Skipped {skipped} invalid line(s).', file=sys.stderr)
+	if not spans:
+		print('No spans found.', file=sys.stderr)
+		sys.exit(1)
+
+	summary = summarize(spans)
+	if args.json == True:
+		if args.titles > 0:
+			summary = {'stages' : summary, 'titles' : summarize_titles(spans)}
+		print(json.dumps(summary, indent=2, sort_keys=True))
+	else:
+		print_summary(summary, spans, args.slowest, args.titles)
+
+### FUNCTIONS ###
+
+### MAIN ###
+if __name__ == '__main__':
+	main()
+
+### MAIN ###